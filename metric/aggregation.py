@@ -0,0 +1,123 @@
+import heapq
+import math
+import re
+
+from django.db.models import Avg, Count, Max, Min, Sum
+from django.db.models.functions import TruncDay, TruncHour, TruncMinute, TruncMonth
+from django.utils.timezone import utc
+
+from .models import Rollup, Value, ValueBlock
+from .utils import (RESOLUTION_DAY, RESOLUTION_HOUR, RESOLUTION_MINUTE, RESOLUTION_MONTH, RESOLUTION_WEEK,
+                    ROLLUP_RESOLUTIONS, truncate_time)
+
+BUCKETS = (RESOLUTION_MINUTE, RESOLUTION_HOUR, RESOLUTION_DAY, RESOLUTION_WEEK, RESOLUTION_MONTH)
+
+SOURCE_ROLLUP = 'rollup'
+SOURCE_DATABASE = 'database'
+SOURCE_PYTHON = 'python'
+
+DB_AGGREGATES = {'avg': Avg, 'min': Min, 'max': Max, 'sum': Sum, 'count': Count}
+DB_TRUNCS = {RESOLUTION_MINUTE: TruncMinute,
+             RESOLUTION_HOUR: TruncHour,
+             RESOLUTION_DAY: TruncDay,
+             RESOLUTION_MONTH: TruncMonth}
+
+PERCENTILE_RE = re.compile(r'^p(\d+(\.\d+)?)$')
+
+
+def percentile(values, rank):
+    """Return the ``rank`` percentile (0-100) of values, interpolated linearly."""
+    values = sorted(values)
+    position = (len(values) - 1) * rank / 100.0
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def get_reducer(aggregate):
+    """Return a function reducing a list of values for an aggregate name, or raise ValueError."""
+    reducers = {'avg': lambda values: float(sum(values)) / len(values),
+                'min': min,
+                'max': max,
+                'sum': sum,
+                'count': len}
+    if aggregate in reducers:
+        return reducers[aggregate]
+    match = PERCENTILE_RE.match(aggregate)
+    if match and float(match.group(1)) <= 100:
+        rank = float(match.group(1))
+        return lambda values: percentile(values, rank)
+    raise ValueError("Unknown aggregate: {}".format(aggregate))
+
+
+def reduce_rows(rows, bucket, reducer):
+    """Reduce ``(item_id, time, value)`` rows ordered by item and time into buckets.
+
+    Only the values of the current bucket are held in memory.
+    """
+    current, values = None, []
+    for item_id, time, value in rows:
+        key = (item_id, truncate_time(time, bucket))
+        if key != current:
+            if values:
+                yield current + (reducer(values), )
+            current, values = key, []
+        values.append(value)
+    if values:
+        yield current + (reducer(values), )
+
+
+def is_aligned(time, bucket):
+    return truncate_time(time, bucket) == time
+
+
+def get_source(items, start, end, bucket, aggregate):
+    """Return where the buckets are computed.
+
+    Rollups cover whole buckets, so they are only read if ``start`` and
+    ``end`` fall on bucket boundaries; otherwise the first and last buckets
+    are computed from the values in the range. Archived values can only be
+    reduced in Python.
+    """
+    aligned = is_aligned(start, bucket) and is_aligned(end, bucket)
+    if aggregate in DB_AGGREGATES and bucket in ROLLUP_RESOLUTIONS and aligned:
+        return SOURCE_ROLLUP
+    archived = ValueBlock.objects.filter(item__in=items).overlapping(start, end).exists()
+    if aggregate in DB_AGGREGATES and bucket in DB_TRUNCS and not archived:
+        return SOURCE_DATABASE
+    return SOURCE_PYTHON
+
+
+def aggregate_values(items, start, end, bucket, aggregate, source=None):
+    """Yield ``(item_id, bucket start, result)`` ordered by item and bucket.
+
+    Rollups are read where they match the bucket, otherwise the values are
+    grouped with ``Trunc*`` in the database, and percentiles, weeks and
+    archived values are reduced in Python from a streamed cursor. Buckets
+    are aligned to UTC.
+    """
+    if bucket not in BUCKETS:
+        raise ValueError("Unknown bucket: {}".format(bucket))
+    reducer = get_reducer(aggregate)
+    source = source or get_source(items, start, end, bucket, aggregate)
+    if source == SOURCE_ROLLUP:
+        qs = Rollup.objects.filter(item__in=items, resolution=bucket, time__gte=start, time__lt=end)
+        for item_id, time, total, count, low, high in qs.order_by('item_id', 'time').values_list(
+                'item_id', 'time', 'sum', 'count', 'min', 'max').iterator():
+            yield item_id, time, {'avg': float(total) / count if count else None,
+                                  'min': low,
+                                  'max': high,
+                                  'sum': total,
+                                  'count': count}[aggregate]
+        return
+
+    qs = Value.objects.filter(item__in=items, time__gte=start, time__lt=end)
+    if source == SOURCE_DATABASE:
+        qs = qs.annotate(bucket=DB_TRUNCS[bucket]('time', tzinfo=utc)).order_by('item_id', 'bucket')
+        for row in qs.values_list('item_id', 'bucket').annotate(result=DB_AGGREGATES[aggregate]('value')):
+            yield row
+    else:
+        rows = heapq.merge(qs.order_by('item_id', 'time').values_list('item_id', 'time', 'value').iterator(),
+                           ValueBlock.objects.filter(item__in=items).rows(start, end))
+        for row in reduce_rows(rows, bucket, reducer):
+            yield row
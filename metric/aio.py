@@ -0,0 +1,83 @@
+"""Collection of metrics on an asyncio event loop, requires Python 3.5+."""
+import asyncio
+import threading
+
+from monotonic import monotonic
+
+
+def run_sync(coroutine):
+    """Run a coroutine to completion on a new event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def set_outcome(future, outcome):
+    if not future.done():
+        future.set_result(outcome)
+
+
+def call_in_thread(loop, import_path):
+    """Call a plain collector in a daemon thread and return a future of its outcome.
+
+    A thread of a timed out collector is abandoned and does not keep the
+    interpreter from exiting, unlike the threads of an executor.
+    """
+    from .collection import call_metric_in_worker
+
+    future = loop.create_future()
+
+    def run():
+        outcome = call_metric_in_worker(import_path)
+        try:
+            loop.call_soon_threadsafe(set_outcome, future, outcome)
+        except RuntimeError:
+            # The loop is closed, the collector timed out long ago.
+            pass
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+async def call_metric_async(import_path, loop, semaphore, timeout):
+    """Await an ``async def`` collector, or call a plain one in a daemon thread.
+
+    Returns ``(value, duration, error)`` like :func:`metric.collection.call_metric`.
+    """
+    from .collection import load_metric
+
+    async with semaphore:
+        start = monotonic()
+        try:
+            func = load_metric(import_path)
+            if asyncio.iscoroutinefunction(func):
+                value = await asyncio.wait_for(func(), timeout)
+            else:
+                return await asyncio.wait_for(call_in_thread(loop, import_path), timeout)
+        except asyncio.TimeoutError:
+            return None, monotonic() - start, "Timed out after {} seconds.".format(timeout)
+        except Exception as e:
+            return None, monotonic() - start, "{}: {}".format(e.__class__.__name__, e)
+        return value, monotonic() - start, None
+
+
+async def gather_metrics(metrics, loop, workers, timeout):
+    semaphore = asyncio.Semaphore(workers or len(metrics) or 1)
+    return await asyncio.gather(*[call_metric_async(import_path, loop, semaphore, timeout)
+                                  for import_path in metrics.values()])
+
+
+def collect_async(metrics, workers=None, timeout=None):
+    """Call collectors concurrently, at most ``workers`` at once, and return their outcomes in order.
+
+    Coroutine collectors run on the event loop, the others in daemon threads.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(gather_metrics(metrics, loop, workers, timeout))
+    finally:
+        loop.close()
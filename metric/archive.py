@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from django.db import transaction
+
+from .cache import invalidate_all
+from .models import Value, ValueBlock
+from .settings import STAT_ARCHIVE_PERIOD
+from .utils import RESOLUTION_DAY, RESOLUTION_WEEK, truncate_time
+
+PERIODS = {RESOLUTION_DAY: timedelta(days=1),
+           RESOLUTION_WEEK: timedelta(weeks=1)}
+
+
+def archive_item(item, before, period=STAT_ARCHIVE_PERIOD):
+    """Move values of an item older than ``before`` into compressed blocks of a day or a week.
+
+    Only whole periods are archived and values with a comment are kept as
+    rows. Values falling into an existing block are merged into it. Each
+    period is written and deleted in one transaction, with all of its values
+    and those of the existing block loaded into memory at once, so the
+    period should be chosen to keep that within bounds.
+    Returns the number of values archived.
+    """
+    if period not in PERIODS:
+        raise ValueError("Unknown archive period {!r}, expected one of {}.".format(period, ", ".join(PERIODS)))
+    cutoff = truncate_time(before, period)
+    qs = Value.objects.filter(item=item, time__lt=cutoff, comment='')
+    count = 0
+    first = qs.order_by('time').values_list('time', flat=True).first()
+    start = truncate_time(first, period) if first else cutoff
+    while start < cutoff:
+        end = start + PERIODS[period]
+        values = qs.filter(time__gte=start, time__lt=end)
+        samples = list(values.values_list('time', 'value'))
+        if samples:
+            with transaction.atomic():
+                block, _ = ValueBlock.objects.select_for_update().get_or_create(
+                    item=item, start=start, defaults={'period': period, 'end': end})
+                if block.count:
+                    samples.extend(block.samples())
+                block.set_samples(samples)
+                block.save()
+                count += values.delete()[0]
+        start = qs.filter(time__gte=end).order_by('time').values_list('time', flat=True).first()
+        start = truncate_time(start, period) if start else cutoff
+    if count:
+        invalidate_all()
+    return count
@@ -0,0 +1,98 @@
+import hashlib
+
+from django.core.cache import caches
+from django.utils.datetime_safe import date
+from django.utils.encoding import force_bytes
+
+from .settings import STAT_CACHE_ALIAS, STAT_CACHE_HISTORY_TIMEOUT, STAT_CACHE_TIMEOUT
+from .utils import RESOLUTION_MONTH, truncate_time
+
+CURRENT_GENERATION_KEY = 'metric:generation:current'
+HISTORY_GENERATION_KEY = 'metric:generation:history'
+
+
+def get_cache():
+    return caches[STAT_CACHE_ALIAS]
+
+
+def get_generation(key):
+    cache = get_cache()
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, 1, None)
+        generation = cache.get(key, 1)
+    return generation
+
+
+def bump_generation(key):
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 2, None)
+
+
+def invalidate(times=()):
+    """Drop cached current periods, and past ones too if any of ``times`` falls before this month."""
+    if STAT_CACHE_ALIAS is None:
+        return
+    bump_generation(CURRENT_GENERATION_KEY)
+    month = date.today().replace(day=1)
+    if any(truncate_time(time, RESOLUTION_MONTH).date() < month for time in times):
+        bump_generation(HISTORY_GENERATION_KEY)
+
+
+def invalidate_all():
+    """Drop cached responses of every period."""
+    if STAT_CACHE_ALIAS is None:
+        return
+    bump_generation(CURRENT_GENERATION_KEY)
+    bump_generation(HISTORY_GENERATION_KEY)
+
+
+class CacheMixin(object):
+    """Cache successful GET responses per URL and user visibility if ``STAT_CACHE_ALIAS`` is set.
+
+    Responses of past periods are kept until a value is written into the past
+    or ``STAT_CACHE_HISTORY_TIMEOUT``, those of the current period until the
+    next write or ``STAT_CACHE_TIMEOUT``. Changes of items and graphs drop
+    both. Writes are made by other processes than the views, so the cache
+    must be shared by all of them, not a per-process ``LocMemCache``.
+    Responses of the current period read from a replica by
+    :class:`~metric.replica.ReplicaMixin` may lag behind the last write and
+    are not kept. Requires ``end`` of :class:`~metric.views.TimeMixin`.
+    """
+
+    def is_past_period(self):
+        return self.end <= date.today()
+
+    def is_cacheable(self, response):
+        if response.status_code != 200 or response.streaming:
+            return False
+        return self.is_past_period() or getattr(self, 'read_database', None) is None
+
+    def get_cache_key(self):
+        past = self.is_past_period()
+        generation = get_generation(HISTORY_GENERATION_KEY if past else CURRENT_GENERATION_KEY)
+        visibility = 'staff' if self.request.user.is_staff else 'public'
+        parts = [self.__class__.__name__, visibility, generation,
+                 sorted(self.kwargs.items()), sorted(self.request.GET.lists())]
+        return 'metric:view:{}'.format(hashlib.md5(force_bytes(repr(parts))).hexdigest())
+
+    def dispatch(self, request, *args, **kwargs):
+        if STAT_CACHE_ALIAS is None or request.method != 'GET':
+            return super(CacheMixin, self).dispatch(request, *args, **kwargs)
+        cache = get_cache()
+        key = self.get_cache_key()
+        response = cache.get(key)
+        if response is not None:
+            return response
+
+        response = super(CacheMixin, self).dispatch(request, *args, **kwargs)
+        if self.is_cacheable(response):
+            timeout = STAT_CACHE_HISTORY_TIMEOUT if self.is_past_period() else STAT_CACHE_TIMEOUT
+            if hasattr(response, 'add_post_render_callback'):
+                response.add_post_render_callback(lambda r: cache.set(key, r, timeout))
+            else:
+                cache.set(key, response, timeout)
+        return response
@@ -1,22 +1,81 @@
-from django.core.checks import Error, register
-from django.utils.module_loading import import_string
+from django.conf import settings
+from django.core.checks import Error, Warning, register
 
-from .settings import STAT_METRICS
+from .collection import MODES
+from .registry import get_registry
+from .settings import STAT_CACHE_ALIAS, STAT_COLLECT_MODE, STAT_INSTRUMENT, STAT_METRICS, STAT_REPLICA_DATABASE
 
 
 @register()
 def stat_metrics_check(app_configs, **kwargs):
     errors = []
-    for key, value in STAT_METRICS.items():
-        try:
-            import_string(value)
-        except ImportError:
-            errors.append(
-                Error(
-                    'I can not load {} as a statistical metric.'.format(value),
-                    hint='Update STAT_METRICS[\"{}\"] settings .'.format(key),
-                    obj=key,
-                    id='metric.E001',
-                )
+    for key in get_registry(STAT_METRICS).errors:
+        errors.append(
+            Error(
+                'I can not load {} as a statistical metric.'.format(STAT_METRICS[key]),
+                hint='Update STAT_METRICS[\"{}\"] settings .'.format(key),
+                obj=key,
+                id='metric.E001',
             )
+        )
     return errors
+
+
+@register()
+def stat_collect_mode_check(app_configs, **kwargs):
+    if STAT_COLLECT_MODE in MODES:
+        return []
+    return [
+        Error(
+            'Unknown statistical metric collect mode {}.'.format(STAT_COLLECT_MODE),
+            hint='Set STAT_COLLECT_MODE to one of: {}.'.format(", ".join(MODES)),
+            id='metric.E002',
+        )
+    ]
+
+
+def is_local_cache(alias):
+    backend = settings.CACHES.get(alias, {}).get('BACKEND', '')
+    return backend.endswith('.LocMemCache') or backend.endswith('.DummyCache')
+
+
+@register()
+def stat_cache_alias_check(app_configs, **kwargs):
+    if STAT_CACHE_ALIAS is None or not is_local_cache(STAT_CACHE_ALIAS):
+        return []
+    return [
+        Warning(
+            'Cache {} of STAT_CACHE_ALIAS is not shared between processes.'.format(STAT_CACHE_ALIAS),
+            hint='Values written by update_metric, run_metric_daemon or other workers will not invalidate '
+                 'cached responses. Use a shared cache backend such as memcached, redis or the database.',
+            id='metric.W001',
+        )
+    ]
+
+
+@register()
+def stat_instrument_check(app_configs, **kwargs):
+    if not STAT_INSTRUMENT or (STAT_CACHE_ALIAS is not None and not is_local_cache(STAT_CACHE_ALIAS)):
+        return []
+    return [
+        Error(
+            'STAT_INSTRUMENT needs a cache shared between processes.',
+            hint='View counters are kept in the cache of STAT_CACHE_ALIAS and read by update_metric. Set it to '
+                 'a shared cache backend such as memcached, redis or the database.',
+            id='metric.E003',
+        )
+    ]
+
+
+@register()
+def stat_replica_database_check(app_configs, **kwargs):
+    if STAT_REPLICA_DATABASE is None or (STAT_CACHE_ALIAS is not None and not is_local_cache(STAT_CACHE_ALIAS)):
+        return []
+    return [
+        Error(
+            'STAT_REPLICA_DATABASE needs a cache shared between processes.',
+            hint='Recent writes are marked in the cache of STAT_CACHE_ALIAS so views read them from the default '
+                 'database. Set it to a shared cache backend such as memcached, redis or the database.',
+            id='metric.E004',
+        )
+    ]
@@ -0,0 +1,155 @@
+import multiprocessing
+import sys
+import threading
+from collections import OrderedDict
+
+import six
+from six.moves import queue
+from six.moves.queue import Empty
+from django.db import connections
+from django.utils.module_loading import import_string
+from monotonic import monotonic
+
+MODE_SERIAL = 'serial'
+MODE_THREAD = 'thread'
+MODE_PROCESS = 'process'
+MODE_ASYNCIO = 'asyncio'
+
+POLL_INTERVAL = 1
+
+if sys.version_info >= (3, 5):
+    from inspect import iscoroutine
+    from .aio import collect_async, run_sync
+
+    MODES = (MODE_SERIAL, MODE_THREAD, MODE_PROCESS, MODE_ASYNCIO)
+else:
+    iscoroutine = run_sync = collect_async = None
+
+    MODES = (MODE_SERIAL, MODE_THREAD, MODE_PROCESS)
+
+
+class Result(object):
+    """Outcome of a single collector call."""
+
+    def __init__(self, key, value=None, duration=None, error=None):
+        self.key = key
+        self.value = value
+        self.duration = duration
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def load_metric(metric):
+    """Return the collector of an import path, or ``metric`` itself if it is already callable."""
+    return import_string(metric) if isinstance(metric, six.string_types) else metric
+
+
+def call_metric(import_path):
+    """Call a collector, given as callable or import path, and return ``(value, duration, error)``.
+
+    Exceptions are reported as text, so the tuple can be sent back from
+    a worker process. ``async def`` collectors run on their own event loop.
+    """
+    start = monotonic()
+    try:
+        value = load_metric(import_path)()
+        if iscoroutine and iscoroutine(value):
+            value = run_sync(value)
+    except Exception as e:
+        return None, monotonic() - start, "{}: {}".format(e.__class__.__name__, e)
+    return value, monotonic() - start, None
+
+
+def call_metric_in_worker(import_path):
+    try:
+        return call_metric(import_path)
+    finally:
+        # Workers outlive a single task, don't leave their connections open.
+        connections.close_all()
+
+
+def run_worker(key, import_path, results):
+    results.put((key, call_metric_in_worker(import_path)))
+
+
+def start_thread(key, import_path, results):
+    # Daemon threads of timed out collectors don't keep the interpreter from exiting.
+    worker = threading.Thread(target=run_worker, args=(key, import_path, results))
+    worker.daemon = True
+    worker.start()
+    return worker
+
+
+def start_process(key, import_path, results):
+    worker = multiprocessing.Process(target=run_worker, args=(key, import_path, results))
+    worker.daemon = True
+    worker.start()
+    return worker
+
+
+def collect_parallel(metrics, start, stop, results, workers, timeout):
+    """Run collectors in at most ``workers`` workers at once, each one started when a worker is free.
+
+    The ``timeout`` of a collector counts from its own start, a timed out
+    one is stopped, or abandoned, and frees its worker for the next one.
+    """
+    queued = list(metrics.items())
+    running = OrderedDict()
+    outcomes = {}
+    while queued or running:
+        while queued and len(running) < workers:
+            key, import_path = queued.pop(0)
+            running[key] = (start(key, import_path, results), monotonic())
+        wait = POLL_INTERVAL
+        if timeout is not None:
+            deadline = min(started for _worker, started in running.values()) + timeout
+            wait = min(max(deadline - monotonic(), 0), wait)
+        try:
+            key, outcome = results.get(timeout=wait)
+        except Empty:
+            pass
+        else:
+            if key in running:
+                outcomes[key] = outcome
+                running.pop(key)[0].join()
+            continue
+        now = monotonic()
+        for key, (worker, started) in list(running.items()):
+            if timeout is not None and now - started >= timeout:
+                stop(worker)
+                outcomes[key] = (None, timeout, "Timed out after {} seconds.".format(timeout))
+                del running[key]
+            elif not worker.is_alive() and results.empty():
+                outcomes[key] = (None, now - started, "Worker exited without a result.")
+                del running[key]
+    return [Result(key, *outcomes[key]) for key in metrics]
+
+
+def collect(metrics, mode=MODE_SERIAL, workers=None, timeout=None):
+    """Call every collector of ``metrics`` (key -> import path or callable).
+
+    A collector that raises or does not finish within ``timeout`` seconds
+    of its start is reported as an error result, the remaining ones are
+    collected anyway. Timeouts are not enforced in the serial mode. In the
+    parallel modes ``workers``, the number of CPUs by default, limits the
+    number of collectors running at once.
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown collect mode {!r}, expected one of {}.".format(mode, ", ".join(MODES)))
+    if mode == MODE_SERIAL:
+        return [Result(key, *call_metric(import_path)) for key, import_path in metrics.items()]
+    if mode == MODE_ASYNCIO:
+        return [Result(key, *outcome) for key, outcome in zip(metrics, collect_async(metrics, workers, timeout))]
+
+    workers = workers or multiprocessing.cpu_count()
+    if mode == MODE_PROCESS:
+        # Forked workers must not share the parent's database sockets.
+        connections.close_all()
+        # Hanging processes are killed.
+        return collect_parallel(metrics, start_process, lambda worker: worker.terminate(),
+                                multiprocessing.Queue(), workers, timeout)
+    # Hanging threads are abandoned.
+    return collect_parallel(metrics, start_thread, lambda worker: None, queue.Queue(), workers, timeout)
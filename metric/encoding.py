@@ -0,0 +1,169 @@
+"""Compact binary encoding of time series.
+
+A payload starts with :data:`MAGIC` and the number of series, followed by
+every series as:
+
+* key: varint length and UTF-8 bytes,
+* kind: one byte, :data:`KIND_INT` or :data:`KIND_FLOAT`,
+* count: varint,
+* times: first epoch second, first delta, then deltas of deltas, all zigzag varints,
+* values: integers XOR-ed with the previous value as zigzag varints; floats
+  XOR-ed with the previous IEEE 754 bits as one byte of trailing zero bits
+  (64 when unchanged) and a varint of the remaining bits.
+
+Regular intervals and repeated values cost one byte each.
+"""
+import struct
+
+import six
+
+MAGIC = b'MTS\x01'
+
+KIND_INT = 0
+KIND_FLOAT = 1
+
+
+def zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    return value // 2 if not value & 1 else -(value + 1) // 2
+
+
+def write_varint(buf, value):
+    while value > 0x7f:
+        buf.append(value & 0x7f | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def read_varint(data, position):
+    result = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def float_bits(value):
+    return struct.unpack('>Q', struct.pack('>d', value))[0]
+
+
+def bits_float(bits):
+    return struct.unpack('>d', struct.pack('>Q', bits))[0]
+
+
+def trailing_zeros(value):
+    return (value & -value).bit_length() - 1 if value else 64
+
+
+def write_times(buf, times):
+    previous, delta = 0, 0
+    for i, time in enumerate(times):
+        if i == 0:
+            write_varint(buf, zigzag(time))
+        elif i == 1:
+            delta = time - previous
+            write_varint(buf, zigzag(delta))
+        else:
+            write_varint(buf, zigzag(time - previous - delta))
+            delta = time - previous
+        previous = time
+
+
+def read_times(data, position, count):
+    times = []
+    time, delta = 0, 0
+    for i in range(count):
+        value, position = read_varint(data, position)
+        value = unzigzag(value)
+        if i == 0:
+            time = value
+        elif i == 1:
+            delta = value
+            time += delta
+        else:
+            delta += value
+            time += delta
+        times.append(time)
+    return times, position
+
+
+def write_values(buf, kind, values):
+    previous = 0
+    for value in values:
+        if kind == KIND_INT:
+            write_varint(buf, zigzag(value ^ previous))
+            previous = value
+        else:
+            bits = float_bits(value)
+            xor = bits ^ previous
+            zeros = trailing_zeros(xor)
+            buf.append(zeros)
+            if xor:
+                write_varint(buf, xor >> zeros)
+            previous = bits
+
+
+def read_values(data, position, kind, count):
+    values = []
+    previous = 0
+    for _ in range(count):
+        if kind == KIND_INT:
+            value, position = read_varint(data, position)
+            previous ^= unzigzag(value)
+            values.append(previous)
+        else:
+            zeros = data[position]
+            position += 1
+            if zeros < 64:
+                xor, position = read_varint(data, position)
+                previous ^= xor << zeros
+            values.append(bits_float(previous))
+    return values, position
+
+
+def get_kind(values):
+    if all(isinstance(value, six.integer_types) and not isinstance(value, bool) for value in values):
+        return KIND_INT
+    return KIND_FLOAT
+
+
+def encode(series):
+    """Encode ``(key, times, values)`` triples, with times in epoch seconds, to bytes."""
+    series = list(series)
+    buf = bytearray(MAGIC)
+    write_varint(buf, len(series))
+    for key, times, values in series:
+        key = key.encode('utf-8')
+        write_varint(buf, len(key))
+        buf.extend(key)
+        kind = get_kind(values)
+        buf.append(kind)
+        write_varint(buf, len(times))
+        write_times(buf, times)
+        write_values(buf, kind, values)
+    return bytes(buf)
+
+
+def decode(data):
+    """Decode bytes of :func:`encode` back to a list of ``(key, times, values)`` triples."""
+    if not data.startswith(MAGIC):
+        raise ValueError("Not an encoded time series.")
+    data = bytearray(data)
+    count, position = read_varint(data, len(MAGIC))
+    series = []
+    for _ in range(count):
+        length, position = read_varint(data, position)
+        key = bytes(data[position:position + length]).decode('utf-8')
+        kind = data[position + length]
+        position += length + 1
+        size, position = read_varint(data, position)
+        times, position = read_times(data, position, size)
+        values, position = read_values(data, position, kind, size)
+        series.append((key, times, values))
+    return series
@@ -24,3 +24,16 @@ class ValueFactory(factory.django.DjangoModelFactory):
 
     class Meta:
         model = 'metric.Value'
+
+
+class GraphFactory(factory.django.DjangoModelFactory):
+    name = factory.Sequence("graph-name-{0}".format)
+    description = factory.fuzzy.FuzzyText()
+
+    class Meta:
+        model = 'metric.Graph'
+
+    @factory.post_generation
+    def items(self, create, extracted, **kwargs):
+        if create and extracted:
+            self.items.add(*extracted)
@@ -0,0 +1,238 @@
+import atexit
+import json
+import logging
+import math
+import threading
+from time import sleep
+
+import six
+from django.db import InterfaceError, OperationalError, connections, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils.timezone import now
+from monotonic import monotonic
+
+from .models import Item, Value
+from .settings import (STAT_INGEST_BATCH_SIZE, STAT_INGEST_BUFFER_SIZE, STAT_INGEST_CREATE_ITEMS,
+                       STAT_INGEST_MAX_DELAY, STAT_INGEST_MAX_RETRIES)
+from .utils import VALUE_MAX, VALUE_MIN, from_epoch, is_value
+
+logger = logging.getLogger(__name__)
+
+
+class IngestError(ValueError):
+    pass
+
+
+class BufferFull(Exception):
+    pass
+
+
+def to_int(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, six.integer_types) and not isinstance(value, bool):
+        return value
+    if isinstance(value, six.string_types):
+        return int(value)
+    raise ValueError(value)
+
+
+def sample(key, value, time=None):
+    try:
+        value = to_int(value)
+    except (TypeError, ValueError):
+        raise IngestError("Value of {} must be an integer, got {!r}.".format(key, value))
+    if not is_value(value):
+        raise IngestError("Value of {} must be between {} and {}, got {}.".format(key, VALUE_MIN, VALUE_MAX, value))
+    try:
+        epoch = float(time) if time is not None else None
+        if epoch is not None and (math.isinf(epoch) or math.isnan(epoch)):
+            raise ValueError(time)
+        time = from_epoch(epoch) if epoch is not None else None
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise IngestError("Time of {} must be a unix timestamp, got {!r}.".format(key, time))
+    return key, value, time
+
+
+def parse_lines(text):
+    """Parse ``key value [unix timestamp]`` lines, skipping blank lines and ``#`` comments."""
+    samples = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) not in (2, 3):
+            raise IngestError("Line {}: expected key, value and optional timestamp.".format(number))
+        samples.append(sample(*fields))
+    return samples
+
+
+def parse_json(text):
+    """Parse a list of ``{"key": ..., "value": ..., "time": ...}`` objects, optionally under ``values``."""
+    try:
+        data = json.loads(text)
+    except ValueError as e:
+        raise IngestError("Invalid JSON: {}".format(e))
+    if isinstance(data, dict):
+        data = data.get('values')
+    if not isinstance(data, list):
+        raise IngestError("Expected a list of values.")
+    try:
+        return [sample(row['key'], row['value'], row.get('time')) for row in data]
+    except (KeyError, TypeError, AttributeError):
+        raise IngestError("Every value needs a key and a value.")
+
+
+class KeyCache(object):
+    """In-process mapping of item keys to ids, filled on demand."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = {}
+
+    def clear(self):
+        with self.lock:
+            self.ids = {}
+
+    def resolve(self, keys, create=False):
+        keys = set(keys)
+        missing = keys.difference(self.ids)
+        if missing:
+            found = dict(Item.objects.filter(key__in=missing).values_list('key', 'id'))
+            unknown = missing.difference(found)
+            if unknown and create:
+                Item.objects.bulk_create([Item(key=key, name=key) for key in unknown])
+                found.update(Item.objects.filter(key__in=unknown).values_list('key', 'id'))
+            elif unknown:
+                raise IngestError("Unknown keys: {}.".format(", ".join(sorted(unknown))))
+            with self.lock:
+                self.ids.update(found)
+        return {key: self.ids[key] for key in keys}
+
+
+class IngestBuffer(object):
+    """Thread-safe buffer of pending values, written with bulk_create in batches.
+
+    With a ``max_delay`` a daemon thread flushes values waiting longer than
+    that, and what is left is flushed when the interpreter exits.
+    """
+    transient_errors = (OperationalError, InterfaceError)
+
+    def __init__(self, batch_size, max_size, max_delay=0, max_retries=STAT_INGEST_MAX_RETRIES):
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.values = []
+        self.added = []
+        self.failures = 0
+        self.timer = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, values):
+        with self.lock:
+            if len(self.values) + len(values) > self.max_size:
+                raise BufferFull("Ingestion buffer is full.")
+            self.values.extend(values)
+            self.added.extend([monotonic()] * len(values))
+            if self.max_delay and self.timer is None:
+                self.start_timer()
+
+    def take(self, force):
+        with self.lock:
+            expired = self.values and monotonic() - self.added[0] >= self.max_delay
+            if len(self.values) < self.batch_size and not (force or expired):
+                return []
+            batch, self.values = self.values[:self.batch_size], self.values[self.batch_size:]
+            self.added = self.added[self.batch_size:]
+            return batch
+
+    def put_back(self, batch):
+        """Return a batch which could not be written to the front of the buffer, over ``max_size`` if needed."""
+        with self.lock:
+            self.values[:0] = batch
+            self.added[:0] = [monotonic() - self.max_delay] * len(batch)
+
+    def discard(self, values):
+        """Remove ``values`` still waiting in the buffer."""
+        discarded = set(map(id, values))
+        with self.lock:
+            kept = [(value, added) for value, added in zip(self.values, self.added) if id(value) not in discarded]
+            self.values = [value for value, _added in kept]
+            self.added = [added for _value, added in kept]
+
+    def flush(self, force=False):
+        """Write full batches, and the rest too if forced or older than ``max_delay`` seconds.
+
+        A batch failing with a transient database error is kept in the
+        buffer and the error raised, up to ``max_retries`` times in a row.
+        Batches failing otherwise, or once more, are logged and dropped, so
+        they do not hold up the values behind them.
+        """
+        count = 0
+        batch = self.take(force)
+        while batch:
+            try:
+                with transaction.atomic():
+                    Value.objects.record(batch)
+            except self.transient_errors:
+                self.failures += 1
+                if self.failures <= self.max_retries:
+                    self.put_back(batch)
+                    raise
+                logger.exception("Dropped %d ingested values after %d failed writes.", len(batch), self.failures)
+            except Exception:
+                logger.exception("Dropped %d ingested values the database rejected.", len(batch))
+            else:
+                count += len(batch)
+            self.failures = 0
+            batch = self.take(force)
+        return count
+
+    def start_timer(self):
+        self.timer = threading.Thread(target=self.run_timer)
+        self.timer.daemon = True
+        self.timer.start()
+        atexit.register(self.flush, True)
+
+    def run_timer(self):
+        while True:
+            sleep(self.max_delay)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Writing ingested values failed, they are kept for the next flush.")
+            finally:
+                connections.close_all()
+
+
+key_cache = KeyCache()
+
+buffer = IngestBuffer(STAT_INGEST_BATCH_SIZE, STAT_INGEST_BUFFER_SIZE, STAT_INGEST_MAX_DELAY)
+
+
+@receiver(post_delete, sender=Item)
+def forget_deleted_item(sender, **kwargs):
+    key_cache.clear()
+
+
+def ingest(samples):
+    """Queue parsed samples and flush what is due. Returns the number of values written.
+
+    If the flush fails, the samples not written yet are taken out of the
+    buffer again, so a client sending them once more does not store them twice.
+    """
+    ids = key_cache.resolve([key for key, _, _ in samples], create=STAT_INGEST_CREATE_ITEMS)
+    time = now()
+    values = [Value(item_id=ids[key], value=value, time=sample_time or time) for key, value, sample_time in samples]
+    buffer.add(values)
+    try:
+        return buffer.flush()
+    except buffer.transient_errors:
+        buffer.discard(values)
+        raise
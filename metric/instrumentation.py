@@ -0,0 +1,195 @@
+from collections import deque
+
+from django.db import connections, router
+from django.utils.translation import ugettext as _
+from monotonic import monotonic
+
+from .cache import get_cache
+from .models import Value
+from .registry import register_items
+from .settings import STAT_CACHE_ALIAS, STAT_INSTRUMENT, STAT_INSTRUMENT_HEADER
+
+VIEWS_KEY = 'metric:instrument:views'
+TAKE_LOCK_KEY = 'metric:instrument:take'
+TAKE_LOCK_TIMEOUT = 60
+
+COUNTERS = ('requests', 'queries', 'db_us', 'serialize_us', 'rows')
+
+HEADER = 'X-Metric-Instrumentation'
+
+
+class Measurement(object):
+    """Number of queries and time spent in the database and outside of it, summed over start/stop phases.
+
+    Queries are counted on the database metric values are read from when it is created.
+    While a phase runs they are logged to an unbounded log of their own, so
+    none are lost when the bounded ``queries_log`` of the connection wraps;
+    they are appended to it when the phase stops.
+    """
+
+    def __init__(self):
+        self.connection = connections[router.db_for_read(Value)]
+        self.query_count = 0
+        self.db_time = 0.0
+        self.duration = 0.0
+
+    def start(self):
+        self.force_debug_cursor = self.connection.force_debug_cursor
+        self.connection.force_debug_cursor = True
+        self.connection.ensure_connection()
+        self.queries_log = self.connection.queries_log
+        self.connection.queries_log = deque()
+        self.started = monotonic()
+
+    def stop(self):
+        self.duration += monotonic() - self.started
+        queries = self.connection.queries_log
+        self.connection.queries_log = self.queries_log
+        self.queries_log.extend(queries)
+        self.connection.force_debug_cursor = self.force_debug_cursor
+        self.query_count += len(queries)
+        self.db_time += sum(float(query['time']) for query in queries)
+
+    @property
+    def serialize_time(self):
+        return max(self.duration - self.db_time, 0)
+
+
+def counter_key(view, counter):
+    return 'metric:instrument:{}:{}'.format(view, counter)
+
+
+def add_counters(view, measurement, rows):
+    """Add a request of ``view`` to the counters kept in the cache of ``STAT_CACHE_ALIAS``."""
+    if STAT_CACHE_ALIAS is None:
+        return
+    cache = get_cache()
+    views = cache.get(VIEWS_KEY, ())
+    if view not in views:
+        cache.set(VIEWS_KEY, sorted(set(views) | {view}), None)
+    counts = {'requests': 1,
+              'queries': measurement.query_count,
+              'db_us': int(measurement.db_time * 1000000),
+              'serialize_us': int(measurement.serialize_time * 1000000),
+              'rows': rows}
+    for counter, count in counts.items():
+        key = counter_key(view, counter)
+        if not cache.add(key, count, None):
+            try:
+                cache.incr(key, count)
+            except ValueError:
+                cache.set(key, count, None)
+
+
+def take_counters():
+    """Return the counters of every view by name and subtract them from the cache.
+
+    Requests only ever increment the counters, so subtracting what was read
+    keeps those counted in between. Takers exclude each other with a lock
+    in the cache, a taker finding it held gets no counters.
+    """
+    if STAT_CACHE_ALIAS is None:
+        return {}
+    cache = get_cache()
+    if not cache.add(TAKE_LOCK_KEY, 1, TAKE_LOCK_TIMEOUT):
+        return {}
+    try:
+        totals = {}
+        for view in cache.get(VIEWS_KEY, ()):
+            keys = [counter_key(view, counter) for counter in COUNTERS]
+            found = cache.get_many(keys)
+            totals[view] = {counter: found.get(key, 0) for counter, key in zip(COUNTERS, keys)}
+            for key, count in found.items():
+                if count:
+                    try:
+                        cache.decr(key, count)
+                    except ValueError:
+                        pass
+        return totals
+    finally:
+        cache.delete(TAKE_LOCK_KEY)
+
+
+def get_item_defaults(view):
+    return {
+        'stats.view.{}.requests'.format(view): {
+            'name': _("Requests of {}").format(view),
+            'description': _("Number of requests served by view {}.").format(view)},
+        'stats.view.{}.queries'.format(view): {
+            'name': _("Queries of {}").format(view),
+            'description': _("Average number of database queries per request of view {}.").format(view)},
+        'stats.view.{}.db_time'.format(view): {
+            'name': _("Database time of {}").format(view),
+            'description': _("Average time (milliseconds) spent in the database per request of view {}.").format(
+                view)},
+        'stats.view.{}.serialize_time'.format(view): {
+            'name': _("Serialization time of {}").format(view),
+            'description': _("Average time (milliseconds) spent outside of the database per request of "
+                             "view {}.").format(view)},
+        'stats.view.{}.rows'.format(view): {
+            'name': _("Rows of {}").format(view),
+            'description': _("Average number of values per request of view {}.").format(view)},
+    }
+
+
+def get_values(time):
+    """Return values of the view counters gathered since the last call, registering their items."""
+    totals = take_counters()
+    defaults = {}
+    for view in totals:
+        defaults.update(get_item_defaults(view))
+    if not defaults:
+        return []
+    ids, _created = register_items(defaults)
+    values = []
+    for view, counts in sorted(totals.items()):
+        requests = counts['requests']
+        averages = {'requests': requests}
+        if requests:
+            averages.update({'queries': counts['queries'] / requests,
+                             'db_time': counts['db_us'] / 1000 / requests,
+                             'serialize_time': counts['serialize_us'] / 1000 / requests,
+                             'rows': counts['rows'] / requests})
+        for name, value in sorted(averages.items()):
+            values.append(Value(item_id=ids['stats.view.{}.{}'.format(view, name)], time=time, value=int(value)))
+    return values
+
+
+class InstrumentMixin(object):
+    """Measure queries, database time, other time and rows of every request if ``STAT_INSTRUMENT`` is set.
+
+    Views add the number of values they serve to ``instrumented_rows``.
+    Streaming responses are measured until their content is consumed, so
+    the ``STAT_INSTRUMENT_HEADER`` debug header is only set on the others.
+    """
+    instrumented_rows = 0
+
+    def dispatch(self, request, *args, **kwargs):
+        if not STAT_INSTRUMENT:
+            return super(InstrumentMixin, self).dispatch(request, *args, **kwargs)
+        measurement = Measurement()
+        measurement.start()
+        try:
+            response = super(InstrumentMixin, self).dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+        finally:
+            measurement.stop()
+        if response.streaming:
+            response.streaming_content = self.measure_stream(response.streaming_content, measurement)
+            return response
+        add_counters(self.__class__.__name__, measurement, self.instrumented_rows)
+        if STAT_INSTRUMENT_HEADER:
+            response[HEADER] = "queries={}; db={:.1f}ms; serialize={:.1f}ms; rows={}".format(
+                measurement.query_count, measurement.db_time * 1000, measurement.serialize_time * 1000,
+                self.instrumented_rows)
+        return response
+
+    def measure_stream(self, content, measurement):
+        measurement.start()
+        try:
+            for chunk in content:
+                yield chunk
+        finally:
+            measurement.stop()
+            add_counters(self.__class__.__name__, measurement, self.instrumented_rows)
@@ -0,0 +1,30 @@
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+from django.utils.timezone import now
+
+from metric.archive import PERIODS, archive_item
+from metric.models import Item
+from metric.settings import STAT_ARCHIVE_AFTER, STAT_ARCHIVE_PERIOD
+
+
+class Command(BaseCommand):
+    help = "Move old metric values into compressed blocks, keeping values with a comment."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--key', action='append', dest='keys',
+                            help="Key of item to archive. May be repeated. All items by default.")
+        parser.add_argument('--days', type=int, default=STAT_ARCHIVE_AFTER,
+                            help="Archive values older than this number of days.")
+        parser.add_argument('--period', choices=sorted(PERIODS), default=STAT_ARCHIVE_PERIOD,
+                            help="Period of values stored in one block.")
+
+    def handle(self, *args, **options):
+        items = Item.objects.all()
+        if options.get('keys'):
+            items = items.filter(key__in=options['keys'])
+        before = now() - timedelta(days=options['days'])
+        for item in items.iterator():
+            count = archive_item(item, before, period=options['period'])
+            if count:
+                self.stdout.write("Archived {}: {} values.".format(item.key, count))
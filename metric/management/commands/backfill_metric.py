@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.utils.timezone import make_aware, utc
+
+from metric.models import Item, Rollup
+
+
+def parse_date(value):
+    return make_aware(datetime.strptime(value, "%Y-%m-%d"), utc)
+
+
+class Command(BaseCommand):
+    help = "Rebuild hourly, daily and monthly rollups of metric values."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--key', action='append', dest='keys',
+                            help="Key of item to rebuild. May be repeated. All items by default.")
+        parser.add_argument('--start', type=parse_date,
+                            help="First day (YYYY-MM-DD) to rebuild, widened to the start of month.")
+        parser.add_argument('--end', type=parse_date,
+                            help="Day (YYYY-MM-DD) to rebuild up to, widened to the end of month.")
+
+    def handle(self, *args, **options):
+        items = None
+        if options.get('keys'):
+            items = Item.objects.filter(key__in=options['keys'])
+        with transaction.atomic():
+            count = Rollup.objects.rebuild(items=items, start=options.get('start'), end=options.get('end'))
+        self.stdout.write("Registered {} rollups.".format(count))
@@ -0,0 +1,135 @@
+import json
+import random
+from datetime import datetime, timedelta
+
+from dateutil.relativedelta import relativedelta
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import BaseCommand
+from django.core.urlresolvers import resolve, reverse
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import make_aware, utc
+from monotonic import monotonic
+
+from metric import cache
+from metric.factories import GraphFactory, ItemFactory, ValueFactory
+from metric.models import Value
+
+
+class Command(BaseCommand):
+    help = ("Seed metric values and measure query count and latency of the item, graph and export views. "
+            "Responses are not cached while measuring. Seeded data is rolled back unless --keep is given.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=10, help="Number of items to seed.")
+        parser.add_argument('--values', type=int, default=100000, help="Number of values to seed per item.")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Number of values per INSERT.")
+        parser.add_argument('--repeat', type=int, default=5, help="Number of requests per endpoint.")
+        parser.add_argument('--explain', action='store_true', help="Print query plans of the value queries.")
+        parser.add_argument('--output', help="Write results as JSON to this file.")
+        parser.add_argument('--keep', action='store_true', help="Keep seeded data in the database.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            start = make_aware(datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0), utc)
+            start -= relativedelta(months=1)
+            items, graph = self.seed(start, options['items'], options['values'], options['batch_size'])
+            cache_alias = cache.STAT_CACHE_ALIAS
+            # Every request after the first would be a cache hit, measure the queries instead.
+            cache.STAT_CACHE_ALIAS = None
+            try:
+                results = [self.measure(name, url, options['repeat'])
+                           for name, url in self.get_urls(start, items[0], graph)]
+            finally:
+                cache.STAT_CACHE_ALIAS = cache_alias
+            if options['explain']:
+                self.explain(start, items)
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+        if cache_alias is None:
+            self.stdout.write("Response caching is off.")
+        else:
+            self.stdout.write("Response caching ({}) is on, it was bypassed while measuring.".format(cache_alias))
+        self.stdout.write("{:<20} {:>8} {:>10} {:>10} {:>10}".format("endpoint", "queries", "min ms", "median ms",
+                                                                        "max ms"))
+        for result in results:
+            self.stdout.write("{name:<20} {queries:>8} {min:>10.1f} {median:>10.1f} {max:>10.1f}".format(**result))
+        if options['output']:
+            with open(options['output'], 'w') as fp:
+                json.dump({'vendor': connection.vendor,
+                           'items': options['items'],
+                           'values': options['values'],
+                           'cache_alias': cache_alias,
+                           'results': results}, fp, indent=4)
+
+    def seed(self, start, item_count, value_count, batch_size):
+        seed_start = monotonic()
+        items = ItemFactory.create_batch(size=item_count, public=True)
+        step = timedelta(seconds=(start + relativedelta(months=1) - start).total_seconds() / value_count)
+        for item in items:
+            batch = []
+            for i in range(value_count):
+                batch.append(ValueFactory.build(item=item, time=start + step * i, value=random.randint(0, 10000)))
+                if len(batch) >= batch_size:
+                    Value.objects.bulk_create(batch)
+                    batch = []
+            Value.objects.bulk_create(batch)
+        graph = GraphFactory(items=items)
+        self.stdout.write("Seeded {} values in {:.1f} s.".format(item_count * value_count, monotonic() - seed_start))
+        return items, graph
+
+    def get_urls(self, start, item, graph):
+        period = {'month': start.month, 'year': start.year}
+        return [
+            ('item_detail', reverse('metric:item_detail', kwargs=dict(period, key=item.key))),
+            ('item_detail_csv', reverse('metric:item_detail_csv', kwargs=dict(period, key=item.key))),
+            ('item_detail_json', reverse('metric:item_detail_json', kwargs=dict(period, key=item.key))),
+            ('graph_detail_json', reverse('metric:graph_detail_json', kwargs=dict(period, pk=graph.pk))),
+        ]
+
+    def request(self, url):
+        request = RequestFactory().get(url)
+        request.user = AnonymousUser()
+        match = resolve(url)
+        response = match.func(request, *match.args, **match.kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        return response
+
+    def measure(self, name, url, repeat):
+        timings = []
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as queries:
+                start = monotonic()
+                self.request(url)
+                timings.append((monotonic() - start) * 1000)
+        timings.sort()
+        return {'name': name,
+                'url': url,
+                'queries': len(queries),
+                'min': timings[0],
+                'median': timings[len(timings) // 2],
+                'max': timings[-1]}
+
+    def explain(self, start, items):
+        end = start + relativedelta(months=1)
+        querysets = [
+            ('item values', Value.objects.filter(item=items[0], time__gte=start, time__lt=end).
+             values_list('time', 'value')),
+            ('graph values', Value.objects.filter(item__in=items, time__gte=start, time__lt=end).
+             order_by('item_id', 'time').values_list('item_id', 'time', 'value')),
+        ]
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        for name, qs in querysets:
+            sql, params = qs.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(prefix + sql, params)
+                plan = cursor.fetchall()
+            self.stdout.write("Query plan of {}:".format(name))
+            for row in plan:
+                self.stdout.write("    " + " ".join(str(column) for column in row))
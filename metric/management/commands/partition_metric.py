@@ -0,0 +1,47 @@
+from dateutil.relativedelta import relativedelta
+from django.core.management import BaseCommand
+from django.db import connection
+from django.utils.timezone import now
+
+from metric import partitioning
+from metric.settings import STAT_PARTITION_AHEAD, STAT_PARTITION_DETACH_AFTER
+from metric.utils import RESOLUTION_MONTH, truncate_time
+
+
+class Command(BaseCommand):
+    help = ("Manage monthly partitions of metric values on PostgreSQL 11+: create the months ahead and "
+            "detach or drop old ones. Does nothing on other databases.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true', default=False,
+                            help="Partition the value table if it is not partitioned yet.")
+        parser.add_argument('--ahead', type=int, default=STAT_PARTITION_AHEAD,
+                            help="Number of months to create partitions for ahead of the current one.")
+        parser.add_argument('--detach-after', type=int, default=STAT_PARTITION_DETACH_AFTER,
+                            help="Detach partitions of months older than this number of months. "
+                                 "Nothing is detached by default.")
+        parser.add_argument('--drop', action='store_true', default=False,
+                            help="Drop detached partitions instead of keeping them as tables.")
+
+    def handle(self, *args, **options):
+        if not partitioning.is_supported():
+            self.stdout.write("Partitioning requires PostgreSQL 11 or later, {} is used. Nothing to do.".format(
+                connection.vendor))
+            return
+        current = now()
+        with connection.cursor() as cursor:
+            partitioned = partitioning.is_partitioned(cursor)
+        if not partitioned:
+            if not options['convert']:
+                self.stdout.write("Table {} is not partitioned, run with --convert first.".format(
+                    partitioning.TABLE))
+                return
+            bound = partitioning.convert(current)
+            self.stdout.write("Partitioned {}, values before {:%Y-%m-%d} kept in {}.".format(
+                partitioning.TABLE, bound, partitioning.INITIAL_PARTITION))
+        for name in partitioning.create_partitions(current, options['ahead']):
+            self.stdout.write("Created {}.".format(name))
+        if options['detach_after'] is not None:
+            before = truncate_time(current, RESOLUTION_MONTH) - relativedelta(months=options['detach_after'])
+            for name in partitioning.detach_partitions(before, drop=options['drop']):
+                self.stdout.write("{} {}.".format("Dropped" if options['drop'] else "Detached", name))
@@ -0,0 +1,28 @@
+from django.core.management import BaseCommand
+from django.utils.timezone import now
+
+from metric.models import Item
+from metric.retention import get_policy, prune_item
+
+
+class Command(BaseCommand):
+    help = "Downsample and delete metric values older than the STAT_RETENTION policies."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--key', action='append', dest='keys',
+                            help="Key of item to prune. May be repeated. All items by default.")
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help="Maximum number of rows deleted in one transaction.")
+
+    def handle(self, *args, **options):
+        items = Item.objects.all()
+        if options.get('keys'):
+            items = items.filter(key__in=options['keys'])
+        time = now()
+        for item in items.iterator():
+            if not get_policy(item.key):
+                continue
+            deleted = prune_item(item, time, chunk_size=options['chunk_size'])
+            if any(deleted.values()):
+                self.stdout.write("Pruned {}: {}.".format(item.key, ", ".join(
+                    "{} {}".format(count, resolution) for resolution, count in sorted(deleted.items()))))
@@ -0,0 +1,22 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from metric.models import Item
+
+
+class Command(BaseCommand):
+    help = ("Recompute value counts, first and last values of items from their raw and archived values. "
+            "Run it after an interrupted prune_metric, which refreshes first values only once it is done.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--key', action='append', dest='keys',
+                            help="Key of item to reconcile. May be repeated. All items by default.")
+
+    def handle(self, *args, **options):
+        items = Item.objects.all()
+        if options.get('keys'):
+            items = items.filter(key__in=options['keys'])
+        with transaction.atomic():
+            items.refresh_last_value()
+            count = items.refresh_counters()
+        self.stdout.write("Reconciled {} items.".format(count))
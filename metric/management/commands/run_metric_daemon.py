@@ -0,0 +1,70 @@
+import time
+
+from django.core.management import BaseCommand
+from django.db import close_old_connections, transaction
+from django.utils import translation
+from django.utils.timezone import now
+from monotonic import monotonic
+
+from metric.collection import MODES, collect
+from metric.models import Value
+from metric.registry import get_registry
+from metric.settings import (STAT_COLLECT_MODE, STAT_COLLECT_TIMEOUT, STAT_COLLECT_WORKERS, STAT_DEFAULT_INTERVAL,
+                             STAT_METRICS)
+
+
+class Command(BaseCommand):
+    help = ("Collect configured metric stats in a resident process, each metric on its own interval "
+            "(the `interval` attribute of the collector in seconds, STAT_DEFAULT_INTERVAL otherwise).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=MODES, default=STAT_COLLECT_MODE,
+                            help="Call due metrics one after another, in a thread pool, in a process pool or on an "
+                                 "asyncio event loop.")
+        parser.add_argument('--workers', type=int, default=STAT_COLLECT_WORKERS,
+                            help="Number of threads or processes, or concurrent collectors in the asyncio mode.")
+        parser.add_argument('--timeout', type=float, default=STAT_COLLECT_TIMEOUT,
+                            help="Seconds to wait for each metric in the thread, process and asyncio modes.")
+        parser.add_argument('--iterations', type=int, default=None,
+                            help="Stop after this many collection rounds instead of running forever.")
+
+    def handle(self, *args, **options):
+        from django.conf import settings
+        translation.activate(settings.LANGUAGE_CODE)
+        registry = get_registry(STAT_METRICS)
+        for key, error in registry.errors.items():
+            self.stderr.write("Unable to load {}: {}".format(key, error))
+        metrics = registry.collectors
+        intervals = {key: getattr(f, 'interval', STAT_DEFAULT_INTERVAL) for key, f in metrics.items()}
+        self.stdout.write("Registered {} new items.".format(registry.register()))
+
+        next_run = {key: monotonic() for key in metrics}
+        iteration = 0
+        while metrics and (options['iterations'] is None or iteration < options['iterations']):
+            time.sleep(max(0, min(next_run.values()) - monotonic()))
+            # Keep the connection between rounds unless it is broken or older than CONN_MAX_AGE.
+            close_old_connections()
+            try:
+                self.run_due(registry, intervals, next_run, options)
+            except Exception as e:
+                # The due metrics are already rescheduled, a failed round is skipped rather than retried.
+                self.stderr.write("Collection round failed: {!r}".format(e))
+                close_old_connections()
+            iteration += 1
+        translation.deactivate()
+
+    def run_due(self, registry, intervals, next_run, options):
+        current = monotonic()
+        due = {key: f for key, f in registry.collectors.items() if next_run[key] <= current}
+        for key in due:
+            while next_run[key] <= current:
+                next_run[key] += intervals[key]
+
+        results = collect(due, mode=options['mode'], workers=options['workers'], timeout=options['timeout'])
+        values = registry.get_values(results, now())
+        for result in results:
+            if not result.ok:
+                self.stderr.write("Unable to collect {}: {}".format(result.key, result.error))
+        with transaction.atomic():
+            Value.objects.record(values)
+        self.stdout.write("Registered {} values of {} metrics.".format(len(values), len(due)))
@@ -1,13 +1,14 @@
 from django.core.management import BaseCommand
 from django.db import transaction
 from django.utils import translation
-from django.utils.module_loading import import_string
 from django.utils.timezone import now
-from django.utils.translation import ugettext as _
 from monotonic import monotonic
 
-from metric.models import Item, Value
-from metric.settings import STAT_METRICS
+from metric import instrumentation
+from metric.collection import MODES, collect
+from metric.models import Value
+from metric.registry import get_registry
+from metric.settings import STAT_COLLECT_MODE, STAT_COLLECT_TIMEOUT, STAT_COLLECT_WORKERS, STAT_METRICS
 
 
 class Command(BaseCommand):
@@ -17,37 +18,41 @@ class Command(BaseCommand):
         parser.add_argument('comment', nargs='?',
                             help="Additional comment to call",
                             default="Manual call statistics.")
+        parser.add_argument('--mode', choices=MODES, default=STAT_COLLECT_MODE,
+                            help="Call metrics one after another, in a thread pool, in a process pool or on an asyncio "
+                                 "event loop.")
+        parser.add_argument('--workers', type=int, default=STAT_COLLECT_WORKERS,
+                            help="Number of threads or processes, or concurrent collectors in the asyncio mode.")
+        parser.add_argument('--timeout', type=float, default=STAT_COLLECT_TIMEOUT,
+                            help="Seconds to wait for each metric in the thread, process and asyncio modes.")
 
     def handle(self, comment, *args, **options):
-        items = {}
-        created_count = 0
         from django.conf import settings
         translation.activate(settings.LANGUAGE_CODE)
-        for key, import_path in STAT_METRICS.items():
-            f = import_string(import_path)
-            name = getattr(f, 'name', key)
-            description = getattr(f, 'description', import_path)
-            item, created = Item.objects.get_or_create(key=key, defaults={'name': name, 'description': description})
-            if created:
-                created_count += 1
-            items[key] = item
+        measurement = instrumentation.Measurement()
+        measurement.start()
+        registry = get_registry(STAT_METRICS)
+        for key, error in registry.errors.items():
+            self.stderr.write("Unable to load {}: {}".format(key, error))
+        created_count = registry.register()
         self.stdout.write("Registered {} new items.".format(created_count))
 
-        values = []
         start = monotonic()
         time = now()
-        for key, import_path in STAT_METRICS.items():
-            f = import_string(import_path)
-            values.append(Value(item=items[key], time=time, value=f()))
-        end = int(monotonic() - start)
-        desc = _("Time (seconds) in which metric statistical information was collected.")
-        system_item, created = Item.objects.get_or_create(key='stats.collect_time',
-                                                          defaults={'name': _("Time to calculate statistics"),
-                                                                    'description': desc})
-        values.append(Value(item=system_item, time=time, value=end))
+        results = collect(registry.collectors,
+                          mode=options.get('mode', STAT_COLLECT_MODE),
+                          workers=options.get('workers', STAT_COLLECT_WORKERS),
+                          timeout=options.get('timeout', STAT_COLLECT_TIMEOUT))
+        values = registry.get_values(results, time)
+        for result in results:
+            if not result.ok:
+                self.stderr.write("Unable to collect {}: {}".format(result.key, result.error))
+        values.append(registry.get_total_value(monotonic() - start, time))
+        values.extend(instrumentation.get_values(time))
+        measurement.stop()
+        values.extend(registry.get_measurement_values(measurement, time))
 
         with transaction.atomic():
-            Value.objects.bulk_create(values)
-            Item.objects.filter(pk__in=[value.item.pk for value in values]).update(last_updated=now())
+            Value.objects.record(values)
         self.stdout.write("Registered {} values.".format(len(values)))
         translation.deactivate()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metric', '0005_auto_20170805_1307'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='item',
+            name='key',
+            field=models.CharField(db_index=True, max_length=100, verbose_name='Metric key'),
+        ),
+    ]
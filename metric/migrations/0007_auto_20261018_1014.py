@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metric', '0006_auto_20261018_1012'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('hour', 'Hourly'), ('day', 'Daily'), ('month', 'Monthly')], max_length=5, verbose_name='Resolution')),
+                ('time', models.DateTimeField(verbose_name='Start of period')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Count')),
+                ('sum', models.BigIntegerField(default=0, verbose_name='Sum')),
+                ('min', models.IntegerField(null=True, verbose_name='Minimum')),
+                ('max', models.IntegerField(null=True, verbose_name='Maximum')),
+                ('last', models.IntegerField(null=True, verbose_name='Last value')),
+                ('last_time', models.DateTimeField(null=True, verbose_name='Time of the last value')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='metric.Item')),
+            ],
+            options={
+                'verbose_name': 'Rollup',
+                'verbose_name_plural': 'Rollups',
+                'ordering': ['item_id', 'time'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='rollup',
+            unique_together=set([('item', 'resolution', 'time')]),
+        ),
+    ]
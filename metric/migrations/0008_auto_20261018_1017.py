@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_last_value(apps, schema_editor):
+    Item = apps.get_model('metric', 'Item')
+    Value = apps.get_model('metric', 'Value')
+    last = Value.objects.filter(item=OuterRef('pk')).order_by('-time', '-pk')
+    Item.objects.update(last_value=Subquery(last.values('value')[:1]),
+                        last_value_time=Subquery(last.values('time')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metric', '0007_auto_20261018_1014'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='last_value',
+            field=models.IntegerField(blank=True, editable=False, null=True, verbose_name='Last value'),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='last_value_time',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Time of the last value'),
+        ),
+        migrations.RunPython(fill_last_value, migrations.RunPython.noop),
+    ]
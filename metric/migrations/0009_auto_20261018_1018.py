@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:18
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metric', '0008_auto_20261018_1017'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='value',
+            index=models.Index(fields=['item', 'time', 'value'], name='metric_value_item_time_value'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metric', '0009_auto_20261018_1018'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ValueBlock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('day', 'Daily'), ('week', 'Weekly')], max_length=5, verbose_name='Period')),
+                ('start', models.DateTimeField(verbose_name='Start of period')),
+                ('end', models.DateTimeField(verbose_name='End of period')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Count')),
+                ('data', models.BinaryField(verbose_name='Data')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='metric.Item')),
+            ],
+            options={
+                'verbose_name': 'Value block',
+                'verbose_name_plural': 'Value blocks',
+                'ordering': ['item_id', 'start'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='valueblock',
+            unique_together=set([('item', 'start')]),
+        ),
+    ]
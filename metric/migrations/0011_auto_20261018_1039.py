@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:39
+from __future__ import unicode_literals
+
+import zlib
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models import Value as V
+from django.db.models.functions import Coalesce
+
+from metric import encoding
+from metric.utils import from_epoch
+
+
+def fill_counters(apps, schema_editor):
+    Item = apps.get_model('metric', 'Item')
+    Value = apps.get_model('metric', 'Value')
+    ValueBlock = apps.get_model('metric', 'ValueBlock')
+    values = Value.objects.filter(item=OuterRef('pk')).order_by().values('item')
+    blocks = ValueBlock.objects.filter(item=OuterRef('pk')).order_by().values('item')
+    first = Value.objects.filter(item=OuterRef('pk')).order_by('time')
+    Item.objects.update(
+        value_count=(Coalesce(Subquery(values.annotate(count=Count('pk')).values('count'),
+                                       output_field=models.BigIntegerField()), V(0)) +
+                     Coalesce(Subquery(blocks.annotate(count=Sum('count')).values('count'),
+                                       output_field=models.BigIntegerField()), V(0))),
+        first_value_time=Subquery(first.values('time')[:1]))
+    for item_id in ValueBlock.objects.order_by().values_list('item_id', flat=True).distinct():
+        block = ValueBlock.objects.filter(item_id=item_id).order_by('start').first()
+        [(_key, times, _values)] = encoding.decode(zlib.decompress(bytes(block.data)))
+        item = Item.objects.get(pk=item_id)
+        if times and (item.first_value_time is None or from_epoch(times[0]) < item.first_value_time):
+            Item.objects.filter(pk=item_id).update(first_value_time=from_epoch(times[0]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metric', '0010_auto_20261018_1032'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='first_value_time',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Time of the first value'),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='value_count',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='Number of values'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -1,37 +1,117 @@
 from __future__ import unicode_literals
 
-from django.db import models
-from django.db.models import QuerySet, Max
+import heapq
+import operator
+import zlib
+from collections import OrderedDict
+from functools import reduce
+
+from dateutil.relativedelta import relativedelta
 from django.core.urlresolvers import reverse
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, F, OuterRef, Q, QuerySet, Subquery, Sum, When
+from django.db.models import Value as V
+from django.db.models.functions import Coalesce, Greatest, Least
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from model_utils.models import TimeStampedModel
 
+from . import encoding
+from .cache import invalidate
+from .replica import mark_written
+from .utils import (RESOLUTION_DAY, RESOLUTION_HOUR, RESOLUTION_MONTH, RESOLUTION_WEEK, ROLLUP_RESOLUTIONS,
+                    from_epoch, to_epoch, truncate_time)
+
 
 class ItemQueryset(QuerySet):
     def for_user(self, user):
         return self if user.is_staff else self.filter(public=True)
 
-    def with_last_value(self):
-        items = Value.objects.get_last_value(self)
-        # result = []
-        for item in Value.objects.all():
-            item.last_value = items.get(item.pk, None)
-        # result.append(item)
-        yield item
-        # return result
+    def update_last_values(self, values):
+        """Store the newest of ``values`` as the last value of their items, unless an item has a newer one.
+
+        The value count and the time of the first value are updated in the same query.
+        """
+        latest = {}
+        first = {}
+        counts = {}
+        for value in values:
+            if value.item_id not in latest or value.time >= latest[value.item_id].time:
+                latest[value.item_id] = value
+            if value.item_id not in first or value.time < first[value.item_id]:
+                first[value.item_id] = value.time
+            counts[value.item_id] = counts.get(value.item_id, 0) + 1
+        if not latest:
+            return 0
+        whens = [(Q(pk=pk) & (Q(last_value_time__isnull=True) | Q(last_value_time__lte=value.time)), value)
+                 for pk, value in latest.items()]
+        first_whens = [When(Q(pk=pk) & (Q(first_value_time__isnull=True) | Q(first_value_time__gt=time)),
+                            then=V(time)) for pk, time in first.items()]
+        return self.filter(pk__in=latest.keys()).update(
+            last_value=Case(*[When(q, then=V(value.value)) for q, value in whens],
+                            default=F('last_value'), output_field=models.IntegerField()),
+            last_value_time=Case(*[When(q, then=V(value.time)) for q, value in whens],
+                                 default=F('last_value_time'), output_field=models.DateTimeField()),
+            value_count=F('value_count') + Case(*[When(pk=pk, then=V(count)) for pk, count in counts.items()],
+                                                default=V(0), output_field=models.BigIntegerField()),
+            first_value_time=Case(*first_whens, default=F('first_value_time'), output_field=models.DateTimeField()),
+            last_updated=now(),
+        )
+
+    def archived_bounds(self):
+        """Yield ``(item_id, first sample, last sample)`` of items with archived values."""
+        blocks = ValueBlock.objects.filter(item__in=self)
+        for item_id in blocks.order_by().values_list('item_id', flat=True).distinct():
+            item_blocks = blocks.filter(item_id=item_id).order_by('start')
+            yield item_id, item_blocks.first().samples()[0], item_blocks.last().samples()[-1]
+
+    def refresh_last_value(self):
+        """Recompute the last value of items from their raw and archived values."""
+        last = Value.objects.filter(item=OuterRef('pk')).order_by('-time', '-pk')
+        count = self.update(last_value=Subquery(last.values('value')[:1]),
+                            last_value_time=Subquery(last.values('time')[:1]))
+        for item_id, _first, (time, value) in self.archived_bounds():
+            Item.objects.filter(Q(last_value_time__isnull=True) | Q(last_value_time__lt=time), pk=item_id).update(
+                last_value=value, last_value_time=time)
+        return count
+
+    def refresh_first_value_time(self):
+        """Recompute the time of the first value of items from their raw and archived values."""
+        first = Value.objects.filter(item=OuterRef('pk')).order_by('time')
+        count = self.update(first_value_time=Subquery(first.values('time')[:1]))
+        for item_id, (time, _value), _last in self.archived_bounds():
+            Item.objects.filter(Q(first_value_time__isnull=True) | Q(first_value_time__gt=time), pk=item_id).update(
+                first_value_time=time)
+        return count
+
+    def refresh_counters(self):
+        """Recompute value counts, archived values included, and first value times of items."""
+        values = Value.objects.filter(item=OuterRef('pk')).order_by().values('item')
+        blocks = ValueBlock.objects.filter(item=OuterRef('pk')).order_by().values('item')
+        self.update(value_count=(
+            Coalesce(Subquery(values.annotate(count=Count('pk')).values('count'),
+                              output_field=models.BigIntegerField()), V(0)) +
+            Coalesce(Subquery(blocks.annotate(count=Sum('count')).values('count'),
+                              output_field=models.BigIntegerField()), V(0))))
+        return self.refresh_first_value_time()
 
 
 @python_2_unicode_compatible
 class Item(TimeStampedModel):
-    key = models.CharField(db_index=True, max_length=50, verbose_name=_("Metric key"))
+    key = models.CharField(db_index=True, max_length=100, verbose_name=_("Metric key"))
     name = models.CharField(max_length=100, verbose_name=_("Name"))
     description = models.TextField(verbose_name=_("Description"), blank=True)
     last_updated = models.DateTimeField(null=True, blank=True,
                                         verbose_name=_("Time to get the last value"))
     public = models.BooleanField(default=True, verbose_name=_("Public?"),
                                  help_text="Select to publish metric for everyone on-line.")
+    last_value = models.IntegerField(null=True, blank=True, editable=False, verbose_name=_("Last value"))
+    last_value_time = models.DateTimeField(null=True, blank=True, editable=False,
+                                           verbose_name=_("Time of the last value"))
+    first_value_time = models.DateTimeField(null=True, blank=True, editable=False,
+                                            verbose_name=_("Time of the first value"))
+    value_count = models.BigIntegerField(default=0, editable=False, verbose_name=_("Number of values"))
     objects = ItemQueryset.as_manager()
 
     class Meta:
@@ -48,7 +128,11 @@ class Item(TimeStampedModel):
         return {'key': self.key,
                 'name': self.name,
                 'description': self.description,
-                'last_updated': self.last_updated.strftime("%s"),
+                'last_updated': str(to_epoch(self.last_updated)) if self.last_updated else None,
+                'last_value': self.last_value,
+                'last_value_time': str(to_epoch(self.last_value_time)) if self.last_value_time else None,
+                'first_value_time': str(to_epoch(self.first_value_time)) if self.first_value_time else None,
+                'value_count': self.value_count,
                 'public': self.public}
 
     def get_absolute_url(self):
@@ -57,8 +141,24 @@ class Item(TimeStampedModel):
 
 class ValueQueryset(QuerySet):
     def get_last_value(self, items):
-        return dict(self.filter(item_id__in=items).values_list('item_id').
-                    annotate(Max('time')).values_list('item__id', 'value'))
+        last = self.filter(item=OuterRef('pk')).order_by('-time', '-pk')
+        return dict(Item.objects.filter(pk__in=items).
+                    annotate(last=Subquery(last.values('value')[:1])).values_list('pk', 'last'))
+
+    def record(self, values):
+        """Save new values together with the rollups and last values of their items."""
+        values = list(values)
+        self.bulk_create(values)
+        Rollup.objects.add_values(values)
+        Item.objects.update_last_values(values)
+        times = {value.time for value in values}
+
+        def committed():
+            # Mark first, so views filling the cache after invalidation read what was written.
+            mark_written(times)
+            invalidate(times)
+        transaction.on_commit(committed)
+        return values
 
 
 class Value(models.Model):
@@ -69,7 +169,7 @@ class Value(models.Model):
     objects = ValueQueryset.as_manager()
 
     def as_dict(self):
-        return {'time': self.time.strftime("%s"),
+        return {'time': str(to_epoch(self.time)),
                 'value': self.value,
                 'comment': self.comment}
 
@@ -77,6 +177,220 @@ class Value(models.Model):
         verbose_name = _("Value")
         verbose_name_plural = _("Values")
         ordering = ['item_id', 'time']
+        indexes = [
+            models.Index(fields=['item', 'time', 'value'], name='metric_value_item_time_value'),
+        ]
+
+
+class RollupQueryset(QuerySet):
+    def add_values(self, values, batch_size=50):
+        """Fold new values into the rollups of every resolution.
+
+        Rollups are looked up, updated and created ``batch_size`` at a time,
+        with up to three queries per batch whatever the number of items.
+        Rollups created by a concurrent writer between the lookup and the
+        insert make the insert fail in its savepoint, the batch is then
+        looked up again and added to them.
+        """
+        buckets = OrderedDict()
+        for value in values:
+            for resolution in ROLLUP_RESOLUTIONS:
+                key = (value.item_id, resolution, truncate_time(value.time, resolution))
+                if key not in buckets:
+                    buckets[key] = Rollup(item_id=key[0], resolution=key[1], time=key[2])
+                buckets[key].add(value.time, value.value)
+
+        keys = list(buckets)
+        for i in range(0, len(keys), batch_size):
+            batch = {key: buckets[key] for key in keys[i:i + batch_size]}
+            while batch:
+                existing = {pk: batch.pop(key) for key, pk in self.find(batch).items()}
+                if existing:
+                    self.filter(pk__in=existing).update(**self.get_increments(existing))
+                if not batch:
+                    break
+                try:
+                    with transaction.atomic():
+                        self.bulk_create(batch.values())
+                    break
+                except IntegrityError:
+                    if not self.find(batch):
+                        raise
+
+    def find(self, keys):
+        """Return the pks of stored rollups by ``(item_id, resolution, time)`` of ``keys``."""
+        lookup = reduce(operator.or_, (Q(item_id=item_id, resolution=resolution, time=time)
+                                       for item_id, resolution, time in keys))
+        return {(item_id, resolution, time): pk
+                for pk, item_id, resolution, time in self.filter(lookup).values_list('pk', 'item_id', 'resolution',
+                                                                                     'time')}
+
+    def get_increments(self, rollups):
+        """Return update expressions adding ``rollups`` (pk -> rollup of new values) to the stored ones."""
+        def case(attr, output_field):
+            return Case(*[When(pk=pk, then=V(getattr(rollup, attr))) for pk, rollup in rollups.items()],
+                        output_field=output_field)
+
+        return {
+            'count': F('count') + case('count', models.PositiveIntegerField()),
+            'sum': F('sum') + case('sum', models.BigIntegerField()),
+            'min': Least('min', case('min', models.IntegerField())),
+            'max': Greatest('max', case('max', models.IntegerField())),
+            'last': Case(*[When(Q(pk=pk) & Q(last_time__lte=rollup.last_time), then=V(rollup.last))
+                           for pk, rollup in rollups.items()],
+                         default=F('last'), output_field=models.IntegerField()),
+            'last_time': Greatest('last_time', case('last_time', models.DateTimeField())),
+        }
+
+    def rebuild(self, items=None, start=None, end=None, batch_size=1000):
+        """Recompute rollups from raw and archived values.
+
+        The range is widened to whole months, so no bucket is built from
+        a part of its values. Returns the number of rollups written.
+        """
+        if start:
+            start = truncate_time(start, RESOLUTION_MONTH)
+        if end and truncate_time(end, RESOLUTION_MONTH) != end:
+            end = truncate_time(end, RESOLUTION_MONTH) + relativedelta(months=1)
+        values = Value.objects.order_by('item_id', 'time')
+        rollups = self
+        if items is not None:
+            values = values.filter(item__in=items)
+            rollups = rollups.filter(item__in=items)
+        if start:
+            values = values.filter(time__gte=start)
+            rollups = rollups.filter(time__gte=start)
+        if end:
+            values = values.filter(time__lt=end)
+            rollups = rollups.filter(time__lt=end)
+        rollups.delete()
+
+        count = 0
+        batch = []
+        current = {}
+        blocks = ValueBlock.objects.all() if items is None else ValueBlock.objects.filter(item__in=items)
+        rows = heapq.merge(values.values_list('item_id', 'time', 'value').iterator(), blocks.rows(start, end))
+        for item_id, time, value in rows:
+            for resolution in ROLLUP_RESOLUTIONS:
+                bucket = truncate_time(time, resolution)
+                rollup = current.get(resolution)
+                if rollup is None or rollup.item_id != item_id or rollup.time != bucket:
+                    if rollup is not None:
+                        batch.append(rollup)
+                    rollup = current[resolution] = Rollup(item_id=item_id, resolution=resolution, time=bucket)
+                rollup.add(time, value)
+            if len(batch) >= batch_size:
+                self.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        batch.extend(current.values())
+        self.bulk_create(batch)
+        return count + len(batch)
+
+
+@python_2_unicode_compatible
+class Rollup(models.Model):
+    RESOLUTION_CHOICES = ((RESOLUTION_HOUR, _("Hourly")),
+                          (RESOLUTION_DAY, _("Daily")),
+                          (RESOLUTION_MONTH, _("Monthly")))
+    item = models.ForeignKey(Item)
+    resolution = models.CharField(max_length=5, choices=RESOLUTION_CHOICES, verbose_name=_("Resolution"))
+    time = models.DateTimeField(verbose_name=_("Start of period"))
+    count = models.PositiveIntegerField(default=0, verbose_name=_("Count"))
+    sum = models.BigIntegerField(default=0, verbose_name=_("Sum"))
+    min = models.IntegerField(null=True, verbose_name=_("Minimum"))
+    max = models.IntegerField(null=True, verbose_name=_("Maximum"))
+    last = models.IntegerField(null=True, verbose_name=_("Last value"))
+    last_time = models.DateTimeField(null=True, verbose_name=_("Time of the last value"))
+    objects = RollupQueryset.as_manager()
+
+    @property
+    def avg(self):
+        return float(self.sum) / self.count if self.count else None
+
+    @property
+    def value(self):
+        return self.avg
+
+    def add(self, time, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if self.last_time is None or time >= self.last_time:
+            self.last, self.last_time = value, time
+
+    def as_dict(self):
+        return {'time': str(to_epoch(self.time)),
+                'value': self.avg,
+                'min': self.min,
+                'max': self.max,
+                'sum': self.sum,
+                'count': self.count,
+                'last': self.last}
+
+    def __str__(self):
+        return "{} {} {}".format(self.item_id, self.resolution, self.time)
+
+    class Meta:
+        verbose_name = _("Rollup")
+        verbose_name_plural = _("Rollups")
+        ordering = ['item_id', 'time']
+        unique_together = ('item', 'resolution', 'time')
+
+
+class ValueBlockQueryset(QuerySet):
+    def overlapping(self, start=None, end=None):
+        qs = self
+        if start:
+            qs = qs.filter(end__gt=start)
+        if end:
+            qs = qs.filter(start__lt=end)
+        return qs
+
+    def rows(self, start=None, end=None):
+        """Yield ``(item_id, time, value)`` of archived samples in ``[start, end)``, ordered by item and time."""
+        for block in self.overlapping(start, end).order_by('item_id', 'start').iterator():
+            for time, value in block.samples():
+                if (start is None or time >= start) and (end is None or time < end):
+                    yield block.item_id, time, value
+
+
+@python_2_unicode_compatible
+class ValueBlock(models.Model):
+    """Values of an item in a day or a week, compressed with :mod:`metric.encoding` and zlib.
+
+    Times are kept with second precision and comments are not stored.
+    """
+    PERIOD_CHOICES = ((RESOLUTION_DAY, _("Daily")),
+                      (RESOLUTION_WEEK, _("Weekly")))
+    item = models.ForeignKey(Item)
+    period = models.CharField(max_length=5, choices=PERIOD_CHOICES, verbose_name=_("Period"))
+    start = models.DateTimeField(verbose_name=_("Start of period"))
+    end = models.DateTimeField(verbose_name=_("End of period"))
+    count = models.PositiveIntegerField(default=0, verbose_name=_("Count"))
+    data = models.BinaryField(verbose_name=_("Data"))
+    objects = ValueBlockQueryset.as_manager()
+
+    def samples(self):
+        """Return the ``(time, value)`` pairs of the block, ordered by time."""
+        [(_key, times, values)] = encoding.decode(zlib.decompress(bytes(self.data)))
+        return [(from_epoch(time), value) for time, value in zip(times, values)]
+
+    def set_samples(self, samples):
+        samples = sorted(samples)
+        self.data = zlib.compress(encoding.encode([('', [to_epoch(time) for time, _value in samples],
+                                                    [value for _time, value in samples])]))
+        self.count = len(samples)
+
+    def __str__(self):
+        return "{} {} {}".format(self.item_id, self.period, self.start)
+
+    class Meta:
+        verbose_name = _("Value block")
+        verbose_name_plural = _("Value blocks")
+        ordering = ['item_id', 'start']
+        unique_together = ('item', 'start')
 
 
 @python_2_unicode_compatible
@@ -0,0 +1,158 @@
+"""Monthly range partitions of the value table, PostgreSQL 11+ only.
+
+:func:`convert` turns the value table into a table partitioned by ``time``.
+Existing rows stay in an initial partition ending at the month after the
+newest value, rows outside of every month go to a default partition.
+:func:`create_partitions` adds the months ahead and :func:`detach_partitions`
+removes old ones. Queries filtered by a time range with constant bounds only
+scan the partitions of that range. Other databases are left untouched.
+"""
+import re
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+from django.db import connection, transaction
+from django.utils.timezone import utc
+
+from .models import Item, Rollup, Value
+from .utils import RESOLUTION_MONTH, truncate_time
+
+MIN_VERSION = 110000
+
+TABLE = Value._meta.db_table
+INITIAL_PARTITION = '{}_initial'.format(TABLE)
+DEFAULT_PARTITION = '{}_default'.format(TABLE)
+MONTH_RE = re.compile(r'^{}_y(\d{{4}})m(\d{{2}})$'.format(TABLE))
+
+
+def is_supported():
+    return connection.vendor == 'postgresql' and connection.pg_version >= MIN_VERSION
+
+
+def get_partition_name(month):
+    return '{0}_y{1:%Y}m{1:%m}'.format(TABLE, month)
+
+
+def get_month(name):
+    """Return the first day of the monthly partition ``name``, ``None`` for other partitions."""
+    match = MONTH_RE.match(name)
+    if not match:
+        return None
+    return datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=utc)
+
+
+def is_partitioned(cursor):
+    cursor.execute("SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+                   "WHERE c.relname = %s AND pg_table_is_visible(c.oid)", [TABLE])
+    return cursor.fetchone() is not None
+
+
+def get_partitions(cursor):
+    """Return the names of the partitions of the value table."""
+    cursor.execute("SELECT child.relname FROM pg_inherits i "
+                   "JOIN pg_class parent ON parent.oid = i.inhparent "
+                   "JOIN pg_class child ON child.oid = i.inhrelid "
+                   "WHERE parent.relname = %s AND pg_table_is_visible(parent.oid)", [TABLE])
+    return sorted(row[0] for row in cursor.fetchall())
+
+
+def get_months(cursor):
+    """Return the first days of the monthly partitions, ordered."""
+    return sorted(month for month in map(get_month, get_partitions(cursor)) if month)
+
+
+def add_partition(cursor, month):
+    """Create the partition of ``month``, moving its rows out of the default partition."""
+    qn = connection.ops.quote_name
+    name, end = get_partition_name(month), month + relativedelta(months=1)
+    cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(
+        qn(name), qn(TABLE)))
+    cursor.execute("WITH moved AS (DELETE FROM {} WHERE time >= %s AND time < %s RETURNING *) "
+                   "INSERT INTO {} SELECT * FROM moved".format(qn(DEFAULT_PARTITION), qn(name)), [month, end])
+    cursor.execute("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)".format(qn(TABLE), qn(name)),
+                   [month, end])
+    return name
+
+
+def convert(now):
+    """Partition the value table by month, keeping the current rows in the initial partition.
+
+    Indexes keep their names on the partitioned table, the primary key
+    becomes ``(id, time)`` as PostgreSQL requires the partition key in it.
+    Returns the first day of the first monthly partition.
+    """
+    qn = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE".format(qn(TABLE)))
+        cursor.execute("SELECT MAX(time) FROM {}".format(qn(TABLE)))
+        newest = cursor.fetchone()[0]
+        bound = truncate_time(max(newest, now) if newest else now, RESOLUTION_MONTH) + relativedelta(months=1)
+
+        # Index names are unique in the schema, the partitioned table takes over the current ones.
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", [TABLE])
+        for index, in cursor.fetchall():
+            cursor.execute("ALTER INDEX {} RENAME TO {}".format(qn(index), qn('{}_initial'.format(index))))
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [TABLE])
+        sequence = cursor.fetchone()[0]
+        cursor.execute("ALTER TABLE {} RENAME TO {}".format(qn(TABLE), qn(INITIAL_PARTITION)))
+
+        cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+                       "PARTITION BY RANGE (time)".format(qn(TABLE), qn(INITIAL_PARTITION)))
+        cursor.execute("ALTER TABLE {} ADD PRIMARY KEY (id, time)".format(qn(TABLE)))
+        cursor.execute("ALTER SEQUENCE {} OWNED BY {}.id".format(sequence, qn(TABLE)))
+        cursor.execute("ALTER TABLE {} ADD FOREIGN KEY (item_id) REFERENCES {} (id) DEFERRABLE INITIALLY DEFERRED"
+                       .format(qn(TABLE), qn(Item._meta.db_table)))
+        with connection.schema_editor(atomic=False) as editor:
+            for sql in editor._model_indexes_sql(Value):
+                editor.execute(sql)
+
+        cursor.execute("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (MINVALUE) TO (%s)".format(
+            qn(TABLE), qn(INITIAL_PARTITION)), [bound])
+        cursor.execute("CREATE TABLE {} PARTITION OF {} DEFAULT".format(qn(DEFAULT_PARTITION), qn(TABLE)))
+        add_partition(cursor, bound)
+    return bound
+
+
+def create_partitions(now, ahead):
+    """Create the missing partitions from the month of ``now`` to ``ahead`` months later.
+
+    Months covered by the initial partition are skipped. Returns the names
+    of the created partitions.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        months = get_months(cursor)
+        month = truncate_time(now, RESOLUTION_MONTH)
+        created = []
+        for _ in range(ahead + 1):
+            if months and month >= months[0] and month not in months:
+                created.append(add_partition(cursor, month))
+            month += relativedelta(months=1)
+    return created
+
+
+def detach_partitions(before, drop=False):
+    """Detach, or drop, partitions holding only values older than ``before``.
+
+    Rollups of their months are rebuilt first, so downsampled history is
+    kept, and the value counters of items are recomputed afterwards.
+    Returns the names of the removed partitions.
+    """
+    qn = connection.ops.quote_name
+    removed = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        partitions = get_partitions(cursor)
+        months = get_months(cursor)
+        candidates = [(get_partition_name(month), month, month + relativedelta(months=1)) for month in months]
+        if INITIAL_PARTITION in partitions and months:
+            candidates.insert(0, (INITIAL_PARTITION, None, months[0]))
+        for name, start, end in candidates:
+            if end > before:
+                break
+            Rollup.objects.rebuild(start=start, end=end)
+            cursor.execute("ALTER TABLE {} DETACH PARTITION {}".format(qn(TABLE), qn(name)))
+            if drop:
+                cursor.execute("DROP TABLE {}".format(qn(name)))
+            removed.append(name)
+        if removed:
+            Item.objects.refresh_counters()
+    return removed
@@ -0,0 +1,15 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import invalidate_all
+from .models import Graph, Item
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+@receiver(post_save, sender=Graph)
+@receiver(post_delete, sender=Graph)
+@receiver(m2m_changed, sender=Graph.items.through)
+def invalidate_responses(sender, **kwargs):
+    """Drop cached responses when visibility, names or members of items and graphs change."""
+    invalidate_all()
@@ -0,0 +1,162 @@
+from collections import OrderedDict
+
+from django.utils.translation import ugettext as _
+
+from .collection import load_metric
+from .models import Item, Value
+from .settings import STAT_METRICS
+from .utils import VALUE_MAX, VALUE_MIN, is_value
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+TOTAL_TIME_KEY = 'stats.collect_time'
+QUERIES_KEY = 'stats.update_metric.queries'
+DB_TIME_KEY = 'stats.update_metric.db_time'
+
+
+def get_time_key(key):
+    return '{}.{}'.format(TOTAL_TIME_KEY, key)
+
+
+def get_sub_key(key, sub_key):
+    return '{}.{}'.format(key, sub_key)
+
+
+def register_items(defaults):
+    """Create items missing from ``defaults`` (key -> field values) in one INSERT.
+
+    Returns the ids of all items by key and the number of items created.
+    """
+    ids = dict(Item.objects.filter(key__in=list(defaults)).values_list('key', 'id'))
+    missing = [key for key in defaults if key not in ids]
+    if missing:
+        Item.objects.bulk_create([Item(key=key, **defaults[key]) for key in missing])
+        ids.update(Item.objects.filter(key__in=missing).values_list('key', 'id'))
+    return ids, len(missing)
+
+
+class MetricRegistry(object):
+    """Collectors of ``metrics`` (key -> import path or callable), resolved once, and the ids of their items."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.collectors = OrderedDict()
+        self.errors = OrderedDict()
+        for key, import_path in sorted(metrics.items()):
+            try:
+                self.collectors[key] = load_metric(import_path)
+            except ImportError as e:
+                self.errors[key] = e
+        self.item_ids = {}
+
+    def get_sub_item_defaults(self, key, sub_keys):
+        name = getattr(self.collectors[key], 'name', key)
+        return OrderedDict((get_sub_key(key, sub_key), {
+            'name': "{}: {}".format(name, sub_key),
+            'description': _("Value {} of metric {}.").format(sub_key, key)}) for sub_key in sub_keys)
+
+    def get_item_defaults(self):
+        """Return name and description of every item the collectors write to, by key.
+
+        Collectors returning a mapping of sub-keys to values may declare
+        the sub-keys as ``sub_keys`` to have them registered up front instead
+        of the item of their own key.
+        """
+        defaults = OrderedDict()
+        for key, f in self.collectors.items():
+            name = getattr(f, 'name', key)
+            if hasattr(f, 'sub_keys'):
+                defaults.update(self.get_sub_item_defaults(key, f.sub_keys))
+            else:
+                defaults[key] = {'name': name, 'description': getattr(f, 'description', self.metrics[key])}
+            defaults[get_time_key(key)] = {
+                'name': _("Time to calculate {}").format(name),
+                'description': _("Time (milliseconds) in which metric {} was collected.").format(key)}
+        defaults[TOTAL_TIME_KEY] = {
+            'name': _("Time to calculate statistics"),
+            'description': _("Time (seconds) in which metric statistical information was collected.")}
+        defaults[QUERIES_KEY] = {
+            'name': _("Queries to calculate statistics"),
+            'description': _("Number of database queries made while statistical information was collected.")}
+        defaults[DB_TIME_KEY] = {
+            'name': _("Database time to calculate statistics"),
+            'description': _("Time (milliseconds) spent in the database while statistical information was "
+                             "collected.")}
+        return defaults
+
+    def register(self):
+        """Create missing items with one INSERT and remember the ids of all. Returns the number created."""
+        self.item_ids, created = register_items(self.get_item_defaults())
+        return created
+
+    def check_result(self, result):
+        """Mark a successful result as failed if its value, or a value of its sub-keys, cannot be stored.
+
+        Values are integers within the range of the value column. A collector
+        declaring ``sub_keys`` must return a mapping.
+        """
+        if not result.ok:
+            return
+        if isinstance(result.value, Mapping):
+            invalid = sorted("{}={!r}".format(sub_key, value) for sub_key, value in result.value.items()
+                             if not is_value(value))
+            if invalid:
+                result.error = "Expected integers between {} and {}, got {}.".format(VALUE_MIN, VALUE_MAX,
+                                                                                   ", ".join(invalid))
+        elif hasattr(self.collectors.get(result.key), 'sub_keys'):
+            result.error = "Expected a mapping of sub-keys to values, got {!r}.".format(result.value)
+        elif not is_value(result.value):
+            result.error = "Expected an integer between {} and {}, got {!r}.".format(VALUE_MIN, VALUE_MAX,
+                                                                                   result.value)
+
+    def get_values(self, results, time):
+        """Return values of successful results and the collect time of every result.
+
+        A mapping returned by a collector gives a value for every sub-key,
+        items of sub-keys seen for the first time are created in bulk.
+        Results are checked with :meth:`check_result` first.
+        """
+        values = []
+        new_defaults = OrderedDict()
+        for result in results:
+            self.check_result(result)
+        for result in results:
+            if result.ok and isinstance(result.value, Mapping):
+                for sub_key in result.value:
+                    if get_sub_key(result.key, sub_key) not in self.item_ids:
+                        new_defaults.update(self.get_sub_item_defaults(result.key, [sub_key]))
+        if new_defaults:
+            self.item_ids.update(register_items(new_defaults)[0])
+
+        for result in results:
+            if result.ok and isinstance(result.value, Mapping):
+                values.extend(Value(item_id=self.item_ids[get_sub_key(result.key, sub_key)], time=time, value=value)
+                              for sub_key, value in sorted(result.value.items()))
+            elif result.ok:
+                values.append(Value(item_id=self.item_ids[result.key], time=time, value=result.value))
+            values.append(Value(item_id=self.item_ids[get_time_key(result.key)], time=time,
+                                value=int(result.duration * 1000)))
+        return values
+
+    def get_total_value(self, duration, time):
+        return Value(item_id=self.item_ids[TOTAL_TIME_KEY], time=time, value=int(duration))
+
+    def get_measurement_values(self, measurement, time):
+        """Return values of a :class:`~metric.instrumentation.Measurement` of the collection."""
+        return [Value(item_id=self.item_ids[QUERIES_KEY], time=time, value=measurement.query_count),
+                Value(item_id=self.item_ids[DB_TIME_KEY], time=time, value=int(measurement.db_time * 1000))]
+
+
+_registries = {}
+
+
+def get_registry(metrics=None):
+    """Return the registry of ``metrics``, ``STAT_METRICS`` by default, built once per process."""
+    metrics = STAT_METRICS if metrics is None else metrics
+    cache_key = frozenset(metrics.items())
+    if cache_key not in _registries:
+        _registries[cache_key] = MetricRegistry(metrics)
+    return _registries[cache_key]
@@ -0,0 +1,122 @@
+import threading
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS
+
+from .cache import get_cache
+from .settings import STAT_CACHE_ALIAS, STAT_REPLICA_DATABASE, STAT_REPLICA_LAG
+
+WRITTEN_KEY = 'metric:replica:written'
+MARK_ATTEMPTS = 5
+
+_state = threading.local()
+
+
+def get_read_database():
+    """Return the database reads of metric models are sent to in this thread, ``None`` for the default."""
+    return getattr(_state, 'database', None)
+
+
+@contextmanager
+def use_database(database):
+    previous = get_read_database()
+    _state.database = database
+    try:
+        yield
+    finally:
+        _state.database = previous
+
+
+def mark_written(times):
+    """Remember the earliest of ``times`` for ``STAT_REPLICA_LAG`` seconds after the last write.
+
+    Views of periods ending after it read from the default database until
+    the replica has caught up. Requires the cache of ``STAT_CACHE_ALIAS``
+    shared by the processes collecting and serving metrics.
+
+    The cache has no compare-and-set, so the earliest time is added if none
+    is kept, otherwise set and read back until no later time of a concurrent
+    writer replaced it.
+    """
+    if STAT_REPLICA_DATABASE is None or STAT_CACHE_ALIAS is None or not times:
+        return
+    cache = get_cache()
+    earliest = min(times)
+    for _ in range(MARK_ATTEMPTS):
+        if cache.add(WRITTEN_KEY, earliest, STAT_REPLICA_LAG):
+            return
+        written = cache.get(WRITTEN_KEY)
+        if written is None:
+            continue
+        earliest = min(earliest, written)
+        cache.set(WRITTEN_KEY, earliest, STAT_REPLICA_LAG)
+        written = cache.get(WRITTEN_KEY)
+        if written is not None and written <= earliest:
+            return
+
+
+def get_written():
+    if STAT_CACHE_ALIAS is None:
+        return None
+    return get_cache().get(WRITTEN_KEY)
+
+
+class ReplicaRouter(object):
+    """Send reads of metric models made by :class:`ReplicaMixin` views to ``STAT_REPLICA_DATABASE``.
+
+    Add ``'metric.replica.ReplicaRouter'`` to ``DATABASE_ROUTERS``. Writes
+    and every other read are left to the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'metric':
+            return get_read_database()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, STAT_REPLICA_DATABASE}
+        if STAT_REPLICA_DATABASE and obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaMixin(object):
+    """Read metric models from ``STAT_REPLICA_DATABASE`` if it is set.
+
+    Periods ending after values written in the last ``STAT_REPLICA_LAG``
+    seconds are read from the default database instead, so a dashboard
+    shows what was just collected. Streaming responses are read from the
+    same database while their content is consumed. The database used is
+    kept as ``read_database``, None for the default. Requires ``end_time``
+    of :class:`~metric.views.TimeMixin`.
+    """
+    read_database = None
+
+    def get_database(self):
+        if STAT_REPLICA_DATABASE is None:
+            return None
+        written = get_written()
+        if written is not None and self.end_time > written:
+            return None
+        return STAT_REPLICA_DATABASE
+
+    def dispatch(self, request, *args, **kwargs):
+        database = self.read_database = self.get_database()
+        if database is None:
+            return super(ReplicaMixin, self).dispatch(request, *args, **kwargs)
+        with use_database(database):
+            response = super(ReplicaMixin, self).dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+        if response.streaming:
+            response.streaming_content = self.read_stream(response.streaming_content, database)
+        return response
+
+    def read_stream(self, content, database):
+        content = iter(content)
+        while True:
+            with use_database(database):
+                chunk = next(content, None)
+            if chunk is None:
+                return
+            yield chunk
@@ -0,0 +1,90 @@
+from datetime import timedelta
+from fnmatch import fnmatchcase
+
+from dateutil.relativedelta import relativedelta
+from django.db import transaction
+from django.db.models import F
+
+from .cache import invalidate_all
+from .models import Item, Rollup, Value, ValueBlock
+from .settings import STAT_RETENTION
+from .utils import RESOLUTION_MONTH, RESOLUTION_RAW, ROLLUP_RESOLUTIONS, truncate_time
+
+
+def get_policy(key, retention=None):
+    """Return days to keep per resolution for an item key, None meaning forever.
+
+    ``STAT_RETENTION`` maps key patterns (``fnmatch`` style) to policies,
+    more specific (longer) patterns override shorter ones.
+    """
+    retention = STAT_RETENTION if retention is None else retention
+    policy = {}
+    for pattern in sorted(retention, key=len):
+        if fnmatchcase(key, pattern):
+            policy.update(retention[pattern])
+    return policy
+
+
+def delete_chunked(qs, chunk_size, item=None, count_values=None):
+    """Delete rows of ``qs`` in separate transactions of at most ``chunk_size`` rows.
+
+    Returns the number of values removed, one per row unless ``count_values``
+    counts them for the queryset of a chunk. With an ``item`` they are
+    subtracted from its ``value_count`` in the transaction of their chunk,
+    so an interrupted run leaves the counter right.
+    """
+    count = 0
+    while True:
+        ids = list(qs.values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return count
+        chunk = qs.model.objects.filter(pk__in=ids)
+        with transaction.atomic():
+            removed = count_values(chunk) if count_values else None
+            deleted = chunk.delete()[0]
+            removed = deleted if removed is None else removed
+            if item is not None and removed:
+                Item.objects.filter(pk=item.pk).update(value_count=F('value_count') - removed)
+            count += removed
+
+
+def count_block_values(blocks):
+    return sum(blocks.values_list('count', flat=True))
+
+
+def prune_item(item, now, chunk_size=5000, retention=None):
+    """Downsample and delete old values of an item according to its policy.
+
+    Raw values, archived ones included, are kept up to the start of the month
+    containing the cut-off, so every rollup is rebuilt from all of its values
+    before they are removed.
+    Returns a dict of deleted rows per resolution.
+    """
+    policy = get_policy(item.key, retention)
+    deleted = {}
+    if policy.get(RESOLUTION_RAW) is not None:
+        cutoff = truncate_time(now - timedelta(days=policy[RESOLUTION_RAW]), RESOLUTION_MONTH)
+        old_values = Value.objects.filter(item=item, time__lt=cutoff)
+        old_blocks = ValueBlock.objects.filter(item=item, end__lte=cutoff)
+        firsts = [old_values.order_by('time').values_list('time', flat=True).first(),
+                  old_blocks.order_by('start').values_list('start', flat=True).first()]
+        firsts = [first for first in firsts if first is not None]
+        month = truncate_time(min(firsts), RESOLUTION_MONTH) if firsts else cutoff
+        deleted[RESOLUTION_RAW] = 0
+        while month < cutoff:
+            end = month + relativedelta(months=1)
+            with transaction.atomic():
+                Rollup.objects.rebuild(items=[item], start=month, end=end)
+            deleted[RESOLUTION_RAW] += delete_chunked(old_values.filter(time__lt=end), chunk_size, item=item)
+            month = end
+        deleted[RESOLUTION_RAW] += delete_chunked(old_blocks, chunk_size, item=item, count_values=count_block_values)
+        if deleted[RESOLUTION_RAW]:
+            Item.objects.filter(pk=item.pk).refresh_first_value_time()
+    for resolution in ROLLUP_RESOLUTIONS:
+        if policy.get(resolution) is not None:
+            cutoff = now - timedelta(days=policy[resolution])
+            qs = Rollup.objects.filter(item=item, resolution=resolution, time__lt=cutoff)
+            deleted[resolution] = delete_chunked(qs, chunk_size)
+    if any(deleted.values()):
+        invalidate_all()
+    return deleted
@@ -0,0 +1,141 @@
+import heapq
+from collections import OrderedDict
+
+from .utils import RESOLUTION_RAW, epoch_label, to_epoch
+
+
+def value_rows(qs, resolution):
+    """Yield ``(item_id, time, value)`` of a Value or Rollup queryset without building model instances."""
+    if resolution == RESOLUTION_RAW:
+        for row in qs.values_list('item_id', 'time', 'value').iterator():
+            yield row
+    else:
+        for item_id, time, total, count in qs.values_list('item_id', 'time', 'sum', 'count').iterator():
+            yield item_id, time, float(total) / count if count else None
+
+
+def align(axis, times, values):
+    """Spread sorted ``times``/``values`` over ``axis``, which contains every time, leaving gaps as None."""
+    result = [None] * len(axis)
+    position = 0
+    for time, value in zip(times, values):
+        while axis[position] != time:
+            position += 1
+        result[position] = value
+    return result
+
+
+def column_scales(columns):
+    """Return the value range of every column, so columns of different magnitude weigh the same."""
+    scales = []
+    for column in columns:
+        values = [value for value in column if value is not None]
+        scales.append((float(max(values) - min(values)) or 1.0) if values else 1.0)
+    return scales
+
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    return float(sum(values)) / len(values) if values else None
+
+
+def lttb(times, columns, threshold):
+    """Return indices of ``times`` keeping the visual shape of all ``columns``, at most ``threshold`` of them.
+
+    Largest-Triangle-Three-Buckets over a shared axis: of every bucket the
+    point forming the largest triangles with the previous selected point
+    and the average of the next bucket, summed over the columns, is kept.
+    """
+    count = len(times)
+    if threshold >= count or threshold < 3:
+        return list(range(count))
+    scales = column_scales(columns)
+    every = float(count - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for bucket in range(threshold - 2):
+        start, end = int(bucket * every) + 1, int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, count)
+        next_time = mean(times[end:next_end])
+        next_values = [mean(column[end:next_end]) for column in columns]
+        best, best_area = start, -1
+        for index in range(start, end):
+            area = 0
+            for column, next_value, scale in zip(columns, next_values, scales):
+                value_a, value = column[a], column[index]
+                if value_a is None or value is None or next_value is None:
+                    continue
+                area += abs((times[a] - next_time) * (value - value_a) -
+                            (times[a] - times[index]) * (next_value - value_a)) / scale
+            if area > best_area:
+                best, best_area = index, area
+        selected.append(best)
+        a = best
+    selected.append(count - 1)
+    return selected
+
+
+class SeriesSet(object):
+    """Values of several items as columns aligned on a shared, sorted time axis of epoch seconds."""
+
+    def __init__(self, items, rows):
+        self.items = list(items)
+        self.series = OrderedDict((item.pk, ([], [])) for item in self.items)
+        for item_id, time, value in rows:
+            times, values = self.series[item_id]
+            times.append(to_epoch(time))
+            values.append(value)
+        self.align()
+
+    def align(self):
+        self.times = []
+        for time in heapq.merge(*[times for times, _ in self.series.values()]):
+            if not self.times or self.times[-1] != time:
+                self.times.append(time)
+        self.columns = [align(self.times, times, values) for times, values in self.series.values()]
+
+    def subset(self, items):
+        """Return a set of some of the ``items`` on their own time axis, without querying again."""
+        subset = SeriesSet(items, [])
+        subset.series = OrderedDict((item.pk, self.series[item.pk]) for item in subset.items)
+        subset.align()
+        return subset
+
+    def downsample(self, max_points):
+        """Return a set of at most ``max_points`` times chosen by :func:`lttb`, without querying again."""
+        indices = lttb(self.times, self.columns, max_points)
+        result = SeriesSet(self.items, [])
+        result.times = [self.times[i] for i in indices]
+        result.columns = [[column[i] for i in indices] for column in self.columns]
+        result.series = OrderedDict()
+        for item, column in zip(self.items, result.columns):
+            points = [(time, value) for time, value in zip(result.times, column) if value is not None]
+            result.series[item.pk] = ([time for time, _ in points], [value for _, value in points])
+        return result
+
+    @classmethod
+    def from_queryset(cls, items, qs, resolution=RESOLUTION_RAW, archived=()):
+        """Build from a single query of the values of all ``items``, ordered by item and time.
+
+        ``archived`` rows, ordered the same way, are merged in.
+        """
+        items = list(items)
+        qs = qs.filter(item__in=items).order_by('item_id', 'time')
+        return cls(items, heapq.merge(value_rows(qs, resolution), archived))
+
+    @property
+    def labels(self):
+        return [epoch_label(time) for time in self.times]
+
+    def as_graph(self):
+        datasets = [{'data': column, 'label': item.name} for item, column in zip(self.items, self.columns)]
+        return {'datasets': datasets, 'labels': self.labels}
+
+    def as_table(self):
+        header = [item.as_dict() for item in self.items]
+        keys = [item.key for item in self.items]
+        body = [{'date': str(time),
+                 'label': label,
+                 'row': OrderedDict(zip(keys, row))}
+                for time, label, row in zip(self.times, self.labels, zip(*self.columns))]
+        return {'header': header, 'body': body}
@@ -2,3 +2,59 @@ from django.conf import settings
 
 
 STAT_METRICS = getattr(settings, 'STAT_METRICS', {})
+
+STAT_COLLECT_MODE = getattr(settings, 'STAT_COLLECT_MODE', 'serial')
+
+STAT_COLLECT_WORKERS = getattr(settings, 'STAT_COLLECT_WORKERS', 4)
+
+STAT_COLLECT_TIMEOUT = getattr(settings, 'STAT_COLLECT_TIMEOUT', None)
+
+STAT_DEFAULT_INTERVAL = getattr(settings, 'STAT_DEFAULT_INTERVAL', 60)
+
+STAT_DEFAULT_RESOLUTION = getattr(settings, 'STAT_DEFAULT_RESOLUTION', 'raw')
+
+STAT_ROLLUP_MIN_POINTS = getattr(settings, 'STAT_ROLLUP_MIN_POINTS', 24)
+
+STAT_GRAPH_MAX_POINTS = getattr(settings, 'STAT_GRAPH_MAX_POINTS', None)
+
+STAT_STREAM_CHUNK_SIZE = getattr(settings, 'STAT_STREAM_CHUNK_SIZE', 500)
+
+STAT_DELTA_MAX_ROWS = getattr(settings, 'STAT_DELTA_MAX_ROWS', 1000)
+
+STAT_DELTA_REREAD_IDS = getattr(settings, 'STAT_DELTA_REREAD_IDS', 100)
+
+STAT_CACHE_ALIAS = getattr(settings, 'STAT_CACHE_ALIAS', None)
+
+STAT_CACHE_TIMEOUT = getattr(settings, 'STAT_CACHE_TIMEOUT', 60 * 60)
+
+STAT_CACHE_HISTORY_TIMEOUT = getattr(settings, 'STAT_CACHE_HISTORY_TIMEOUT', 24 * 60 * 60)
+
+STAT_INGEST_TOKENS = getattr(settings, 'STAT_INGEST_TOKENS', [])
+
+STAT_INGEST_BATCH_SIZE = getattr(settings, 'STAT_INGEST_BATCH_SIZE', 1000)
+
+STAT_INGEST_BUFFER_SIZE = getattr(settings, 'STAT_INGEST_BUFFER_SIZE', 100000)
+
+STAT_INGEST_MAX_DELAY = getattr(settings, 'STAT_INGEST_MAX_DELAY', 0)
+
+STAT_INGEST_CREATE_ITEMS = getattr(settings, 'STAT_INGEST_CREATE_ITEMS', False)
+
+STAT_INGEST_MAX_RETRIES = getattr(settings, 'STAT_INGEST_MAX_RETRIES', 5)
+
+STAT_RETENTION = getattr(settings, 'STAT_RETENTION', {})
+
+STAT_ARCHIVE_AFTER = getattr(settings, 'STAT_ARCHIVE_AFTER', 90)
+
+STAT_ARCHIVE_PERIOD = getattr(settings, 'STAT_ARCHIVE_PERIOD', 'day')
+
+STAT_INSTRUMENT = getattr(settings, 'STAT_INSTRUMENT', False)
+
+STAT_INSTRUMENT_HEADER = getattr(settings, 'STAT_INSTRUMENT_HEADER', False)
+
+STAT_PARTITION_AHEAD = getattr(settings, 'STAT_PARTITION_AHEAD', 3)
+
+STAT_PARTITION_DETACH_AFTER = getattr(settings, 'STAT_PARTITION_DETACH_AFTER', None)
+
+STAT_REPLICA_DATABASE = getattr(settings, 'STAT_REPLICA_DATABASE', None)
+
+STAT_REPLICA_LAG = getattr(settings, 'STAT_REPLICA_LAG', 5)
@@ -11,7 +11,7 @@ register = template.Library()
 
 @register.filter()
 def join_attr(values, attr):
-    values = [getattr(o, attr) for o in values]
+    values = [o[attr] if isinstance(o, dict) else getattr(o, attr) for o in values]
     values = [str(o) if isinstance(o, six.integer_types) else '"{}"'.format(conditional_escape(o))
               for o in values]
     return mark_safe(", ".join(values))
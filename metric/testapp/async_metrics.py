@@ -0,0 +1,15 @@
+import asyncio
+
+
+async def constant():
+    await asyncio.sleep(0.1)
+    return 7
+
+
+async def failing():
+    raise ValueError("Broken metric.")
+
+
+async def hanging():
+    await asyncio.sleep(5)
+    return 1
@@ -0,0 +1,38 @@
+import time
+
+
+def constant():
+    return 42
+
+
+constant.name = "Constant"
+constant.description = "Always returns the same value."
+constant.interval = 3600
+
+
+def failing():
+    raise ValueError("Broken metric.")
+
+
+def hanging():
+    time.sleep(5)
+    return 1
+
+
+def frequent():
+    return 1
+
+
+frequent.interval = 0.05
+
+
+def per_status():
+    return {'ok': 3, 'failed': 1}
+
+
+per_status.name = "Per status"
+per_status.sub_keys = ('ok', 'failed')
+
+
+def per_kind():
+    return {'a': 1, 'b': 2}
@@ -51,7 +51,13 @@ SECRET_KEY = ''.join([random.choice(string.ascii_letters) for x in range(40)])
 
 # Database specific
 
-DATABASES = {'default': env.db(default="sqlite:///")}
+DATABASES = {'default': env.db(default="sqlite:///"),
+             'replica': env.db('REPLICA_DATABASE_URL', default="sqlite:///")}
+
+DATABASE_ROUTERS = ['metric.replica.ReplicaRouter']
+
+# Tests run in one process, so the default local memory cache is shared by writes and views.
+STAT_CACHE_ALIAS = 'default'
 
 USE_TZ = True
 
@@ -1,23 +1,54 @@
+import json
 import re
-from datetime import datetime
+import threading
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta
 from unittest import skipUnless
 
 
-from dateutil.rrule import MONTHLY, WEEKLY
+import factory.fuzzy
+from dateutil.relativedelta import relativedelta
+from dateutil.rrule import DAILY, HOURLY, MONTHLY, WEEKLY
+from django.contrib.auth import get_user_model
 from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.http.response import HttpResponse
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import DatabaseError, OperationalError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils.timezone import utc
 
 
-from .factories import ItemFactory, ValueFactory
-from .utils import DATE_FORMAT_MONTHLY, DATE_FORMAT_WEEKLY, GapFiller
+from . import checks, encoding, ingest, instrumentation, partitioning, replica
+from . import cache as cache_module
+from .collection import MODE_ASYNCIO, MODE_PROCESS, MODE_SERIAL, MODE_THREAD, MODES, collect
+from .factories import GraphFactory, ItemFactory, ValueFactory
+from .archive import archive_item
+from .models import Item, Rollup, RollupQueryset, Value, ValueBlock
+from .registry import MetricRegistry, get_registry
+from .retention import get_policy, prune_item
+from .series import SeriesSet, lttb
+from .utils import (DATE_FORMAT_DAILY, DATE_FORMAT_HOURLY, DATE_FORMAT_MONTHLY, DATE_FORMAT_WEEKLY, RESOLUTION_DAY,
+                    RESOLUTION_HOUR, RESOLUTION_MONTH, RESOLUTION_RAW, SECONDS_IN_A_DAY, GapFiller,
+                    choose_resolution, start_of_day, to_epoch)
 
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+TEST_METRICS = {'test.constant': 'metric.testapp.metrics.constant',
+                'test.failing': 'metric.testapp.metrics.failing'}
+
+
+def streaming_json(response):
+    return json.loads(b''.join(response.streaming_content).decode('utf-8'))
+
 
 def polyfill_http_response_json():
     try:
@@ -138,9 +169,35 @@ class GapFillerTestCase(TestCase):
         ]
         self.assertEqual(result, expected)
 
+    def test_daily_and_hourly_gaps(self):
+        qs = [{'date': "2015-01-30", 'param': 1}, {'date': "2015-02-02", 'param': 2}]
+        result = GapFiller(qs, DAILY, self.date_key, DATE_FORMAT_DAILY).fill_gaps()
+        self.assertEqual([row['date'] for row in result], ["2015-01-30", "2015-01-31", "2015-02-01", "2015-02-02"])
+
+        qs = [{'date': "2015-01-31 23", 'param': 1}, {'date': "2015-02-01 01", 'param': 2}]
+        result = GapFiller(qs, HOURLY, self.date_key, DATE_FORMAT_HOURLY).fill_gaps()
+        self.assertEqual(result[1], {'date': "2015-02-01 00", 'param': 0})
+
+    def test_epoch_dates(self):
+        qs = [{'date': 1420070400, 'param': 1}, {'date': 1420070400 + 3 * 3600, 'param': 2}]
+        result = GapFiller(qs, HOURLY, self.date_key).fill_gaps()
+        self.assertEqual([row['date'] for row in result], [1420070400 + h * 3600 for h in range(4)])
+
+        qs = [{'date': 1420070400, 'param': 1}, {'date': 1427846400, 'param': 2}]  # 2015-01-01, 2015-04-01
+        result = GapFiller(qs, MONTHLY, self.date_key).fill_gaps()
+        self.assertEqual([row['date'] for row in result], [1420070400, 1422748800, 1425168000, 1427846400])
+
+    def test_consumes_iterator_lazily(self):
+        def rows():
+            for day in range(0, 10 ** 6, 2):
+                yield {'date': day * SECONDS_IN_A_DAY, 'param': day}
+        result = iter(GapFiller(rows(), DAILY, self.date_key))
+        self.assertEqual([next(result)['param'] for _ in range(4)], [0, 0, 2, 0])
+
 
 class ValueBrowseListViewTestCase(TestCase):
     def setUp(self):
+        cache.clear()
         self.obj = ItemFactory()
         self.values = ValueFactory.create_batch(size=10, item=self.obj)
         self.url = reverse('metric:item_detail', kwargs={'key': self.obj.key,
@@ -197,15 +254,879 @@ class JSONValueListViewTestCase(TestCase):
         self.assertEqual(response.status_code, 200, "Invalid status code on '{}'".format(self.url))
 
     def test_output_contains_values(self):
-        response = self.client.get(self.url).json()
+        response = streaming_json(self.client.get(self.url))
         sorted(self.values, key=lambda x: x.time)
         self.assertEqual(response['values'][0]['value'], self.values[0].value)
 
     def test_output_contains_item_name(self):
-        response = self.client.get(self.url).json()
+        response = streaming_json(self.client.get(self.url))
         self.assertEqual(response['item']['name'], self.obj.name)
 
 
+class ExportRangeTestCase(TestCase):
+    def setUp(self):
+        self.item = ItemFactory(public=True, last_updated=datetime(2017, 3, 1, tzinfo=utc))
+        for month, value in ((1, 10), (2, 20), (3, 30), (5, 50)):
+            ValueFactory(item=self.item, time=datetime(2017, month, 15, tzinfo=utc), value=value)
+
+    def test_json_export_of_date_range(self):
+        url = reverse('metric:item_detail_json', kwargs={'key': self.item.key})
+        response = self.client.get(url, {'start': '2017-02-01', 'end': '2017-04-30'})
+        self.assertTrue(response.streaming)
+        self.assertEqual([row['value'] for row in streaming_json(response)['values']], [20, 30])
+
+    def test_csv_export_of_date_range(self):
+        url = reverse('metric:item_detail_csv', kwargs={'key': self.item.key})
+        response = self.client.get(url, {'start': '2017-01-01', 'end': '2017-12-31'})
+        self.assertIn('{}-20170101-20171231.csv'.format(self.item.key), response['Content-Disposition'])
+        rows = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(rows), 5)
+        self.assertTrue(rows[1].startswith('{},{},'.format(self.item.key, self.item.name)))
+        self.assertTrue(rows[-1].endswith(',50'))
+
+    def test_invalid_date(self):
+        url = reverse('metric:item_detail_csv', kwargs={'key': self.item.key})
+        self.assertEqual(self.client.get(url, {'start': '2017-13-01'}).status_code, 404)
+
+    def test_end_of_range_is_exclusive(self):
+        ValueFactory(item=self.item, time=start_of_day(date(2017, 4, 1)), value=40)
+        url = reverse('metric:item_detail_json', kwargs={'key': self.item.key, 'month': 3, 'year': 2017})
+        self.assertEqual([row['value'] for row in streaming_json(self.client.get(url))['values']], [30])
+
+    def test_range_is_bounded_by_utc_days(self):
+        ValueFactory(item=self.item, time=datetime(2017, 3, 1, 1, tzinfo=utc), value=31)
+        ValueFactory(item=self.item, time=datetime(2017, 3, 31, 23, tzinfo=utc), value=32)
+        url = reverse('metric:item_detail_json', kwargs={'key': self.item.key, 'month': 3, 'year': 2017})
+        self.assertEqual([row['value'] for row in streaming_json(self.client.get(url))['values']], [31, 30, 32])
+
+
+class EncodingTestCase(TestCase):
+    def test_round_trip(self):
+        series = [('ints', [1488326400, 1488326460, 1488326520, 1488326590, 1488326500], [5, 5, -3, 2 ** 40, 0]),
+                  ('floats', [10, 20, 30, 40], [1.5, 1.5, -0.1, 1e300]),
+                  (u'\u017c', [], [])]
+        self.assertEqual(encoding.decode(encoding.encode(series)), series)
+
+    def test_regular_series_takes_about_a_byte_per_sample(self):
+        times = [1488326400 + 60 * i for i in range(1000)]
+        data = encoding.encode([('key', times, [7] * 1000)])
+        self.assertLess(len(data), 2050)
+
+    def test_invalid_data(self):
+        with self.assertRaises(ValueError):
+            encoding.decode(b'[]')
+
+
+class BinaryExportTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.items = ItemFactory.create_batch(size=2, public=True)
+        for i, item in enumerate(self.items):
+            for day in range(5, 10):
+                ValueFactory(item=item, time=datetime(2017, 3, day, tzinfo=utc), value=day * (i + 1))
+
+    def test_item_export(self):
+        url = reverse('metric:item_detail_bin', kwargs={'key': self.items[0].key, 'month': 3, 'year': 2017})
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        [(key, times, values)] = encoding.decode(response.content)
+        self.assertEqual(key, self.items[0].key)
+        self.assertEqual(times[0], to_epoch(datetime(2017, 3, 5, tzinfo=utc)))
+        self.assertEqual(values, [5, 6, 7, 8, 9])
+
+    def test_filled_daily_export_skips_empty_days(self):
+        item = ItemFactory(public=True)
+        Value.objects.record([Value(item=item, time=datetime(2017, 3, day, tzinfo=utc), value=day) for day in (5, 8)])
+        url = reverse('metric:item_detail_bin', kwargs={'key': item.key, 'month': 3, 'year': 2017})
+        response = self.client.get(url, {'resolution': 'day', 'fill': '1'})
+        self.assertEqual(response.status_code, 200)
+        [(key, times, values)] = encoding.decode(response.content)
+        self.assertEqual(times, [to_epoch(datetime(2017, 3, day, tzinfo=utc)) for day in (5, 8)])
+        self.assertEqual(values, [5.0, 8.0])
+
+    def test_graph_export(self):
+        graph = GraphFactory(items=self.items)
+        url = reverse('metric:graph_detail_bin', kwargs={'pk': graph.pk, 'month': 3, 'year': 2017})
+        series = encoding.decode(self.client.get(url).content)
+        self.assertEqual([key for key, _, _ in series], [item.key for item in self.items])
+        self.assertEqual(series[1][2], [10, 12, 14, 16, 18])
+
+
+class ItemQueryCountTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item = ItemFactory(public=True)
+
+    def assertQueriesPerEndpoint(self, num, **params):
+        for size in (5, 50):
+            Value.objects.record([Value(item=self.item, time=datetime(2017, 3, 10, tzinfo=utc) + timedelta(hours=i),
+                                        value=i) for i in range(size)])
+            for name in ('item_detail', 'item_detail_csv', 'item_detail_json', 'item_detail_bin'):
+                url = reverse('metric:' + name, kwargs={'key': self.item.key, 'month': 3, 'year': 2017})
+                with self.assertNumQueries(num):
+                    response = self.client.get(url, params)
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                self.assertEqual(response.status_code, 200)
+            cache.clear()
+
+    def test_raw_values(self):
+        self.assertQueriesPerEndpoint(3)
+
+    def test_rollups(self):
+        self.assertQueriesPerEndpoint(2, resolution=RESOLUTION_HOUR)
+
+    def test_private_item(self):
+        item = ItemFactory(public=False)
+        url = reverse('metric:item_detail_csv', kwargs={'key': item.key, 'month': 3, 'year': 2017})
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class SeriesSetTestCase(TestCase):
+    def setUp(self):
+        self.items = [ItemFactory(key='a'), ItemFactory(key='b')]
+        self.time = datetime(2017, 3, 1, tzinfo=utc)
+
+    @override_settings(TIME_ZONE='UTC')
+    def test_aligns_items_on_shared_axis(self):
+        rows = [(self.items[0].pk, self.time, 1),
+                (self.items[0].pk, self.time + timedelta(seconds=20), 3),
+                (self.items[1].pk, self.time + timedelta(seconds=10), 2),
+                (self.items[1].pk, self.time + timedelta(seconds=20), 4)]
+        series = SeriesSet(self.items, rows)
+        epoch = 1488326400
+        self.assertEqual(series.times, [epoch, epoch + 10, epoch + 20])
+        self.assertEqual(series.columns, [[1, None, 3], [None, 2, 4]])
+        table = series.as_table()
+        self.assertEqual(table['body'][1]['date'], str(epoch + 10))
+        self.assertEqual(list(table['body'][2]['row'].items()), [('a', 3), ('b', 4)])
+        self.assertEqual(series.as_graph()['labels'][0], "2017-03-01 00:00:00")
+
+    def test_subset(self):
+        rows = [(self.items[0].pk, self.time, 1),
+                (self.items[1].pk, self.time + timedelta(seconds=10), 2)]
+        subset = SeriesSet(self.items, rows).subset(self.items[1:])
+        self.assertEqual(subset.times, [1488326410])
+        self.assertEqual(subset.columns, [[2]])
+
+    def test_empty(self):
+        series = SeriesSet(self.items, [])
+        self.assertEqual(series.as_table()['body'], [])
+        self.assertEqual(series.as_graph()['datasets'][0]['data'], [])
+
+
+class DownsampleTestCase(TestCase):
+    def test_lttb_keeps_peaks_and_ends(self):
+        times = list(range(100))
+        flat = [0] * 100
+        flat[37] = 50
+        noisy = [i % 2 for i in range(100)]
+        indices = lttb(times, [flat, noisy], 10)
+        self.assertEqual(len(indices), 10)
+        self.assertEqual((indices[0], indices[-1]), (0, 99))
+        self.assertIn(37, indices)
+        self.assertEqual(lttb(times, [flat], 200), times)
+
+    def test_graph_max_points(self):
+        cache.clear()
+        items = ItemFactory.create_batch(size=2, public=True)
+        for item in items:
+            ValueFactory.create_batch(size=30, item=item, time=factory.fuzzy.FuzzyDateTime(
+                datetime(2017, 3, 1, tzinfo=utc), datetime(2017, 3, 31, tzinfo=utc)))
+        graph = GraphFactory(items=items)
+        url = reverse('metric:graph_detail_json', kwargs={'pk': graph.pk, 'month': 3, 'year': 2017})
+        data = json.loads(self.client.get(url, {'max_points': 20}).content.decode('utf-8'))
+        self.assertEqual(len(data['body']), 20)
+        self.assertEqual(self.client.get(url, {'max_points': 'x'}).status_code, 404)
+        for max_points in (2, 0, -1):
+            self.assertEqual(self.client.get(url, {'max_points': max_points}).status_code, 404)
+
+
+class JSONGraphDetailViewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.items = ItemFactory.create_batch(size=3, public=True)
+        for item in self.items:
+            ValueFactory.create_batch(size=5, item=item, time=factory.fuzzy.FuzzyDateTime(
+                datetime(2017, 3, 1, tzinfo=utc), datetime(2017, 3, 31, tzinfo=utc)))
+        self.graph = GraphFactory(items=self.items)
+        self.url = reverse('metric:graph_detail_json', kwargs={'pk': self.graph.pk, 'month': 3, 'year': 2017})
+
+    def test_queries_do_not_depend_on_items(self):
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([col['key'] for col in data['header']], sorted(item.key for item in self.items))
+        self.assertEqual(sum(value is not None for row in data['body'] for value in row['row'].values()), 15)
+
+
+@mock.patch('metric.views.STAT_DELTA_REREAD_IDS', 0)
+class GraphDeltaViewTestCase(TestCase):
+    def setUp(self):
+        self.items = ItemFactory.create_batch(size=2, public=True)
+        self.graph = GraphFactory(items=self.items)
+        self.time = datetime(2017, 3, 10, tzinfo=utc)
+        self.first = ValueFactory(item=self.items[0], time=self.time, value=1)
+        self.url = reverse('metric:graph_detail_delta', kwargs={'pk': self.graph.pk})
+
+    def get(self, **params):
+        return json.loads(self.client.get(self.url, params).content.decode('utf-8'))
+
+    def test_since_and_cursor(self):
+        ValueFactory(item=self.items[1], time=self.time + timedelta(minutes=1), value=2)
+        data = self.get(since=to_epoch(self.time))
+        self.assertEqual([list(row['row'].values()) for row in data['body']], [[None, 2]])
+
+        late = ValueFactory(item=self.items[0], time=self.time - timedelta(days=1), value=3)
+        with self.assertNumQueries(3):
+            data = self.get(cursor=self.first.pk)
+        self.assertEqual(data['cursor'], late.pk)
+        self.assertEqual(len(data['body']), 2)
+        self.assertEqual(self.get(cursor=late.pk), {'header': data['header'], 'body': [], 'cursor': late.pk})
+
+    def test_server_sent_event(self):
+        response = self.client.get(self.url, {'cursor': 0}, HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        lines = response.content.decode('utf-8').splitlines()
+        self.assertEqual(lines[:2], ['retry: 5000', 'id: {}'.format(self.first.pk)])
+        self.assertEqual(json.loads(lines[2][len('data: '):])['cursor'], self.first.pk)
+        response = self.client.get(self.url, {'format': 'sse'}, HTTP_LAST_EVENT_ID=str(self.first.pk))
+        self.assertIn('"body": []', response.content.decode('utf-8'))
+
+    def test_requires_cursor(self):
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertEqual(self.client.get(self.url, {'cursor': 'x'}).status_code, 404)
+
+    def test_invalid_since(self):
+        for since in ('1e20', '1e400', 'inf', 'nan'):
+            self.assertEqual(self.client.get(self.url, {'since': since}).status_code, 404)
+        self.assertEqual(self.client.get(self.url, {'cursor': 2 ** 64}).status_code, 404)
+
+    @mock.patch('metric.views.STAT_DELTA_MAX_ROWS', 2)
+    def test_rows_are_capped(self):
+        values = [ValueFactory(item=self.items[1], time=self.time + timedelta(minutes=i), value=i) for i in range(3)]
+        data = self.get(cursor=self.first.pk)
+        self.assertEqual(data['cursor'], values[1].pk)
+        self.assertEqual([row['row'][self.items[1].key] for row in data['body']], [0, 1])
+        data = self.get(cursor=data['cursor'])
+        self.assertEqual(data['cursor'], values[2].pk)
+        self.assertEqual([row['row'][self.items[1].key] for row in data['body']], [2])
+
+    def test_values_committed_late_are_sent(self):
+        skipped = ValueFactory(item=self.items[1], time=self.time, value=2)
+        sent = ValueFactory(item=self.items[1], time=self.time + timedelta(minutes=1), value=3)
+        skipped_pk = skipped.pk
+        skipped.delete()
+        cursor = self.get(cursor=self.first.pk)['cursor']
+        self.assertEqual(cursor, sent.pk)
+        Value.objects.create(pk=skipped_pk, item=self.items[1], time=self.time, value=2)
+        with mock.patch('metric.views.STAT_DELTA_REREAD_IDS', 5):
+            data = self.get(cursor=cursor)
+        self.assertEqual(data['cursor'], sent.pk)
+        self.assertEqual([row['row'][self.items[1].key] for row in data['body']], [2, 3])
+
+
+class GraphBatchViewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.items = ItemFactory.create_batch(size=4, public=True)
+        for i, item in enumerate(self.items):
+            ValueFactory(item=item, time=datetime(2017, 3, 10 + i, tzinfo=utc), value=i)
+        self.graphs = [GraphFactory(items=self.items[i:i + 2]) for i in range(3)]
+        self.url = reverse('metric:graph_batch_json', kwargs={'month': 3, 'year': 2017})
+
+    def test_queries_do_not_depend_on_graphs(self):
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url, {'graph': [graph.pk for graph in reversed(self.graphs)]})
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([graph['id'] for graph in data['graphs']], [graph.pk for graph in reversed(self.graphs)])
+        table = data['graphs'][-1]
+        self.assertEqual([col['key'] for col in table['header']], [item.key for item in self.items[0:2]])
+        self.assertEqual([list(row['row'].values()) for row in table['body']], [[0, None], [None, 1]])
+
+    def test_unknown_graph(self):
+        self.assertEqual(self.client.get(self.url, {'graph': [self.graphs[0].pk, 0]}).status_code, 404)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+class LastValueTestCase(TestCase):
+    def setUp(self):
+        self.item = ItemFactory()
+        self.other = ItemFactory()
+        self.time = datetime(2017, 3, 1, tzinfo=utc)
+        self.values = [ValueFactory(item=self.item, time=self.time + timedelta(days=day), value=value)
+                       for day, value in ((2, 20), (5, 50), (1, 10))]
+
+    def test_get_last_value(self):
+        with self.assertNumQueries(1):
+            result = Value.objects.get_last_value(Item.objects.all())
+        self.assertEqual(result, {self.item.pk: 50, self.other.pk: None})
+
+    def test_update_last_values_keeps_newer(self):
+        Item.objects.update_last_values(self.values[:2])
+        Item.objects.update_last_values(self.values[2:])
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.last_value, self.item.last_value_time), (50, self.time + timedelta(days=5)))
+        self.assertIsNotNone(self.item.last_updated)
+
+    def test_refresh_last_value(self):
+        Item.objects.refresh_last_value()
+        self.item.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual(self.item.last_value, 50)
+        self.assertIsNone(self.other.last_value)
+
+    def test_record_updates_item(self):
+        Value.objects.record([Value(item=self.other, time=self.time, value=7)])
+        self.other.refresh_from_db()
+        self.assertEqual((self.other.last_value, self.other.last_value_time), (7, self.time))
+
+
+class ResponseCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.today = datetime.now(utc)
+        self.item = ItemFactory(public=True)
+        self.hidden = ItemFactory(public=False)
+        self.graph = GraphFactory(items=[self.item, self.hidden])
+
+    def get_url(self, time):
+        return reverse('metric:graph_detail_json', kwargs={'pk': self.graph.pk, 'month': time.month,
+                                                           'year': time.year})
+
+    def get_table(self, url, **kwargs):
+        return json.loads(self.client.get(url, **kwargs).content.decode('utf-8'))
+
+    def test_current_period_invalidated_by_write(self):
+        url = self.get_url(self.today)
+        Value.objects.record([Value(item=self.item, time=self.today, value=1)])
+        self.assertEqual(len(self.get_table(url)['body']), 1)
+        with self.assertNumQueries(0):
+            self.get_table(url)
+        Value.objects.record([Value(item=self.item, time=self.today - timedelta(seconds=1), value=2)])
+        self.assertEqual(len(self.get_table(url)['body']), 2)
+
+    def test_past_period_kept_until_backdated_write(self):
+        past = self.today - timedelta(days=80)
+        url = self.get_url(past)
+        Value.objects.record([Value(item=self.item, time=past, value=1)])
+        self.assertEqual(len(self.get_table(url)['body']), 1)
+        Value.objects.record([Value(item=self.item, time=self.today, value=2)])
+        with self.assertNumQueries(0):
+            self.get_table(url)
+        Value.objects.record([Value(item=self.item, time=past + timedelta(seconds=1), value=3)])
+        self.assertEqual(len(self.get_table(url)['body']), 2)
+
+    def test_item_and_graph_changes_drop_past_pages(self):
+        past = self.today - timedelta(days=80)
+        url = self.get_url(past)
+        Value.objects.record([Value(item=self.item, time=past, value=1)])
+        self.assertEqual(len(self.get_table(url)['header']), 1)
+        self.item.public = False
+        self.item.save()
+        self.assertEqual(len(self.get_table(url)['header']), 0)
+        Item.objects.filter(pk=self.item.pk).update(public=True)
+        self.graph.items.remove(self.item)
+        self.assertEqual(len(self.get_table(url)['header']), 0)
+
+    def test_prune_drops_past_pages(self):
+        past = self.today - timedelta(days=80)
+        url = self.get_url(past)
+        Value.objects.record([Value(item=self.item, time=past, value=1)])
+        self.assertEqual(len(self.get_table(url)['body']), 1)
+        prune_item(self.item, self.today + timedelta(days=62), retention={'*': {'raw': 1}})
+        self.assertEqual(len(self.get_table(url)['body']), 0)
+
+    def test_local_cache_check(self):
+        self.assertEqual([warning.id for warning in checks.stat_cache_alias_check(None)], ['metric.W001'])
+        with mock.patch('metric.checks.STAT_CACHE_ALIAS', None):
+            self.assertEqual(checks.stat_cache_alias_check(None), [])
+
+    def test_visibility_is_part_of_key(self):
+        url = self.get_url(self.today)
+        self.assertEqual(len(self.get_table(url)['header']), 1)
+        staff = get_user_model().objects.create_user('staff', password='pass', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(len(self.get_table(url)['header']), 2)
+
+
+@mock.patch('metric.replica.STAT_REPLICA_DATABASE', 'replica')
+class ReplicaTestCase(TransactionTestCase):
+    multi_db = True
+
+    def setUp(self):
+        cache.clear()
+        self.item = ItemFactory(public=True)
+        self.item.save(using='replica')
+        self.url = reverse('metric:item_detail_json', kwargs={'key': self.item.key, 'month': 3, 'year': 2017})
+
+    def get_values(self, url):
+        return [row['value'] for row in streaming_json(self.client.get(url))['values']]
+
+    def test_router(self):
+        self.assertEqual(Value.objects.all().db, 'default')
+        with replica.use_database('replica'):
+            self.assertEqual(Value.objects.all().db, 'replica')
+            self.assertEqual(get_user_model().objects.all().db, 'default')
+
+    def test_reads_replica_except_after_recent_write(self):
+        Value.objects.record([Value(item=self.item, time=datetime(2017, 3, 15, tzinfo=utc), value=1)])
+        self.assertEqual(self.get_values(self.url), [1])
+        february = reverse('metric:item_detail_json', kwargs={'key': self.item.key, 'month': 2, 'year': 2017})
+        ValueFactory(item=self.item, time=datetime(2017, 2, 15, tzinfo=utc), value=2)
+        self.assertEqual(self.get_values(february), [])
+
+        cache.delete(replica.WRITTEN_KEY)
+        self.assertEqual(self.get_values(self.url), [])
+        Value.objects.using('replica').create(item=self.item, time=datetime(2017, 3, 15, tzinfo=utc), value=1)
+        self.assertEqual(self.get_values(self.url), [1])
+
+    def test_current_period_from_replica_is_not_cached(self):
+        graph = GraphFactory(items=[self.item])
+        graph.save(using='replica')
+        graph.items.through.objects.using('replica').create(graph_id=graph.pk, item_id=self.item.pk)
+        today = date.today()
+        url = reverse('metric:graph_detail_json', kwargs={'pk': graph.pk, 'month': today.month, 'year': today.year})
+        self.assertEqual(json.loads(self.client.get(url).content.decode('utf-8'))['body'], [])
+        Value.objects.using('replica').create(item=self.item, time=start_of_day(today.replace(day=1)), value=1)
+        self.assertEqual(len(json.loads(self.client.get(url).content.decode('utf-8'))['body']), 1)
+
+    def test_mark_written_keeps_earliest(self):
+        replica.mark_written([datetime(2017, 3, 15, tzinfo=utc)])
+        replica.mark_written([datetime(2017, 3, 20, tzinfo=utc)])
+        self.assertEqual(replica.get_written(), datetime(2017, 3, 15, tzinfo=utc))
+        replica.mark_written([datetime(2017, 3, 10, tzinfo=utc), datetime(2017, 3, 30, tzinfo=utc)])
+        self.assertEqual(replica.get_written(), datetime(2017, 3, 10, tzinfo=utc))
+
+    def test_shared_cache_check(self):
+        with mock.patch('metric.checks.STAT_REPLICA_DATABASE', 'replica'):
+            self.assertEqual([error.id for error in checks.stat_replica_database_check(None)], ['metric.E004'])
+            with mock.patch('metric.checks.is_local_cache', return_value=False):
+                self.assertEqual(checks.stat_replica_database_check(None), [])
+        self.assertEqual(checks.stat_replica_database_check(None), [])
+
+
+@mock.patch('metric.views.STAT_INGEST_TOKENS', ['secret'])
+class IngestViewTestCase(TestCase):
+    def setUp(self):
+        ingest.key_cache.clear()
+        self.item = ItemFactory(key='ingest.a')
+        self.url = reverse('metric:ingest')
+
+    def post(self, data, content_type='text/plain', token='secret'):
+        return self.client.post(self.url, data, content_type=content_type,
+                                HTTP_AUTHORIZATION='Token {}'.format(token))
+
+    def test_requires_token(self):
+        self.assertEqual(self.post("ingest.a 1", token='wrong').status_code, 401)
+        self.assertFalse(Value.objects.exists())
+
+    def test_line_protocol(self):
+        response = self.post("# comment\ningest.a 5 1488326400\n\ningest.a 7\n")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(list(Value.objects.values_list('value', flat=True)), [5, 7])
+        self.assertEqual(Value.objects.get(value=5).time, datetime(2017, 3, 1, tzinfo=utc))
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.last_value, 7)
+
+    def test_json(self):
+        data = json.dumps({'values': [{'key': 'ingest.a', 'value': 3, 'time': 1488326400}]})
+        self.assertEqual(self.post(data, content_type='application/json').status_code, 202)
+        self.assertEqual(Value.objects.get().value, 3)
+
+    def test_key_cache_avoids_lookups(self):
+        self.post("ingest.a 1")
+        with self.assertNumQueries(0):
+            ingest.key_cache.resolve(['ingest.a'])
+
+    def test_rejects_unknown_key_and_bad_value(self):
+        self.assertEqual(self.post("ingest.missing 1").status_code, 400)
+        self.assertEqual(self.post("ingest.a 1.5").status_code, 400)
+        self.assertEqual(self.post("ingest.a 99999999999999999999").status_code, 400)
+        self.assertEqual(self.post("ingest.a 2147483648").status_code, 400)
+        self.assertFalse(Value.objects.exists())
+
+    def test_rejects_out_of_range_times(self):
+        for time in ('1e20', 'inf', 'nan', '-1e20'):
+            self.assertEqual(self.post("ingest.a 1 {}".format(time)).status_code, 400)
+        self.assertFalse(Value.objects.exists())
+
+    @mock.patch('metric.ingest.STAT_INGEST_CREATE_ITEMS', True)
+    def test_creates_items(self):
+        self.assertEqual(self.post("ingest.new 1").status_code, 202)
+        self.assertEqual(Item.objects.get(key='ingest.new').last_value, 1)
+
+    def test_batches_and_back_pressure(self):
+        with mock.patch('metric.ingest.buffer', ingest.IngestBuffer(batch_size=2, max_size=3, max_delay=60)):
+            self.assertEqual(self.post("ingest.a 1\ningest.a 2\ningest.a 3").json()['written'], 2)
+            self.assertEqual(len(ingest.buffer), 1)
+            response = self.post("ingest.a 4\ningest.a 5\ningest.a 6")
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+            self.assertEqual(ingest.buffer.flush(force=True), 1)
+        self.assertEqual(Value.objects.count(), 3)
+
+    def test_leftover_values_keep_their_age(self):
+        buffer = ingest.IngestBuffer(batch_size=2, max_size=10, max_delay=60)
+        with mock.patch('metric.ingest.monotonic', return_value=100):
+            buffer.add([Value(item=self.item, value=value) for value in (1, 2, 3)])
+        with mock.patch('metric.ingest.monotonic', return_value=130):
+            self.assertEqual(buffer.flush(), 2)
+        with mock.patch('metric.ingest.monotonic', return_value=165):
+            self.assertEqual(buffer.flush(), 1)
+
+    def test_failed_batch_is_kept(self):
+        buffer = ingest.IngestBuffer(batch_size=2, max_size=10)
+        buffer.add([Value(item=self.item, value=value) for value in (1, 2, 3)])
+        with mock.patch.object(Value.objects, 'record', side_effect=OperationalError("Down.")):
+            with self.assertRaises(OperationalError):
+                buffer.flush()
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(sorted(Value.objects.values_list('value', flat=True)), [1, 2, 3])
+
+    def test_batch_is_dropped_after_retries(self):
+        buffer = ingest.IngestBuffer(batch_size=2, max_size=10, max_retries=1)
+        buffer.add([Value(item=self.item, value=value) for value in (1, 2)])
+        with mock.patch.object(Value.objects, 'record', side_effect=OperationalError("Down.")):
+            with self.assertRaises(OperationalError):
+                buffer.flush()
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(len(buffer), 0)
+
+    def test_poison_batch_does_not_block_ingestion(self):
+        with mock.patch('metric.ingest.buffer', ingest.IngestBuffer(batch_size=1, max_size=10)):
+            ingest.buffer.add([Value(item=self.item, value=10 ** 20, time=datetime(2017, 3, 1, tzinfo=utc))])
+            response = self.post("ingest.a 1")
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(len(ingest.buffer), 0)
+        self.assertEqual(list(Value.objects.values_list('value', flat=True)), [1])
+
+    def test_write_failure_is_retried_by_client(self):
+        with mock.patch('metric.ingest.buffer', ingest.IngestBuffer(batch_size=1, max_size=10)):
+            with mock.patch.object(Value.objects, 'record', side_effect=OperationalError("Down.")):
+                response = self.post("ingest.a 1")
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+            self.assertEqual(len(ingest.buffer), 0)
+            self.assertEqual(self.post("ingest.a 1").status_code, 202)
+        self.assertEqual(Value.objects.count(), 1)
+
+
+class RetentionTestCase(TestCase):
+    retention = {'*': {'raw': 30, 'hour': 90},
+                 'stats.*': {'raw': 7}}
+
+    def setUp(self):
+        self.item = ItemFactory(key='retention')
+        self.now = datetime(2017, 6, 20, tzinfo=utc)
+        for day in range(0, 150, 10):
+            Value.objects.record([Value(item=self.item, time=self.now - timedelta(days=day, hours=1), value=day)])
+
+    def test_get_policy(self):
+        self.assertEqual(get_policy('stats.collect_time', self.retention), {'raw': 7, 'hour': 90})
+        self.assertEqual(get_policy('other', self.retention), {'raw': 30, 'hour': 90})
+        self.assertEqual(get_policy('other', {}), {})
+
+    def test_prune_keeps_rollups_of_deleted_values(self):
+        daily = sorted(Rollup.objects.filter(resolution=RESOLUTION_DAY).values_list('time', 'sum'))
+        deleted = prune_item(self.item, self.now, chunk_size=2, retention=self.retention)
+        self.assertEqual(deleted['raw'], 10)
+        self.assertFalse(Value.objects.filter(time__lt=datetime(2017, 5, 1, tzinfo=utc)).exists())
+        self.assertEqual(Value.objects.count(), 5)
+        self.assertEqual(sorted(Rollup.objects.filter(resolution=RESOLUTION_DAY).values_list('time', 'sum')), daily)
+        self.assertFalse(Rollup.objects.filter(resolution=RESOLUTION_HOUR,
+                                               time__lt=self.now - timedelta(days=90)).exists())
+        self.assertEqual(Rollup.objects.get(resolution=RESOLUTION_MONTH, time=datetime(2017, 2, 1, tzinfo=utc)).count, 2)
+
+    def test_command(self):
+        out = StringIO()
+        with mock.patch('metric.retention.STAT_RETENTION', self.retention):
+            call_command('prune_metric', stdout=out)
+        self.assertIn("Pruned retention: 15 hour, 15 raw.", out.getvalue())
+        self.assertEqual(Rollup.objects.filter(resolution=RESOLUTION_DAY).count(), 15)
+
+
+class AggregateViewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item = ItemFactory(key='aggregate', public=True)
+        self.times = [datetime(2017, 3, 6, 10, tzinfo=utc), datetime(2017, 3, 6, 10, 30, tzinfo=utc),
+                      datetime(2017, 3, 7, 10, tzinfo=utc), datetime(2017, 3, 14, 10, tzinfo=utc)]
+        Value.objects.record([Value(item=self.item, time=time, value=value)
+                              for time, value in zip(self.times, (10, 20, 30, 40))])
+        self.url = reverse('metric:aggregate')
+
+    def get(self, **params):
+        params = dict({'key': self.item.key, 'start': '2017-03-05', 'end': '2017-03-20'}, **params)
+        return self.client.get(self.url, params)
+
+    def get_data(self, **params):
+        response = self.get(**params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    def day(self, day):
+        return to_epoch(datetime(2017, 3, day, tzinfo=utc))
+
+    def test_daily_average_from_rollups(self):
+        data = self.get_data(bucket='day', agg='avg')
+        self.assertEqual(data['source'], 'rollup')
+        self.assertEqual(data['series'][0]['key'], self.item.key)
+        self.assertEqual(data['series'][0]['data'], [[self.day(6), 15], [self.day(7), 30], [self.day(14), 40]])
+
+    def test_minute_sum_in_database(self):
+        data = self.get_data(bucket='minute', agg='sum')
+        self.assertEqual(data['source'], 'database')
+        self.assertEqual([value for _, value in data['series'][0]['data']], [10, 20, 30, 40])
+        self.assertEqual(data['series'][0]['data'][1][0], to_epoch(self.times[1]))
+
+    def test_weekly_percentile_in_python(self):
+        data = self.get_data(bucket='week', agg='p50')
+        self.assertEqual(data['source'], 'python')
+        self.assertEqual(data['series'][0]['data'], [[self.day(6), 20], [self.day(13), 40]])
+
+    def test_unaligned_range_reads_values(self):
+        Value.objects.record([Value(item=self.item, time=datetime(2017, 3, 2, tzinfo=utc), value=1000),
+                              Value(item=self.item, time=datetime(2017, 3, 25, tzinfo=utc), value=2000)])
+        data = self.get_data(bucket='month', agg='sum')
+        self.assertEqual(data['source'], 'database')
+        self.assertEqual(data['series'][0]['data'], [[to_epoch(datetime(2017, 3, 1, tzinfo=utc)), 100]])
+        data = self.get_data(bucket='month', agg='sum', start='2017-03-01', end='2017-03-31')
+        self.assertEqual(data['source'], 'rollup')
+        self.assertEqual(data['series'][0]['data'], [[to_epoch(datetime(2017, 3, 1, tzinfo=utc)), 3100]])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.get(bucket='year').status_code, 400)
+        self.assertEqual(self.get(agg='p101').status_code, 400)
+        self.assertEqual(self.get(key='missing').status_code, 404)
+        private = ItemFactory(public=False)
+        self.assertEqual(self.get(key=private.key).status_code, 404)
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item = ItemFactory(public=True)
+        self.now = datetime(2017, 6, 20, 12, tzinfo=utc)
+        Value.objects.record([Value(item=self.item, time=datetime(2017, 3, day, hour, tzinfo=utc), value=day + hour)
+                              for day in (10, 11, 20) for hour in (1, 2)])
+        ValueFactory(item=self.item, time=datetime(2017, 3, 10, 3, tzinfo=utc), value=100, comment="Kept")
+        ValueFactory(item=self.item, time=datetime(2017, 6, 19, tzinfo=utc), value=1)
+
+    def test_archive_moves_old_values_into_blocks(self):
+        self.assertEqual(archive_item(self.item, self.now - timedelta(days=30), period=RESOLUTION_DAY), 6)
+        self.assertEqual(Value.objects.filter(item=self.item).count(), 2)
+        blocks = ValueBlock.objects.filter(item=self.item)
+        self.assertEqual([block.count for block in blocks], [2, 2, 2])
+        self.assertEqual(blocks[0].samples(), [(datetime(2017, 3, 10, 1, tzinfo=utc), 11),
+                                               (datetime(2017, 3, 10, 2, tzinfo=utc), 12)])
+
+        ValueFactory(item=self.item, time=datetime(2017, 3, 10, 4, tzinfo=utc), value=14, comment='')
+        archive_item(self.item, self.now - timedelta(days=30), period=RESOLUTION_DAY)
+        self.assertEqual(ValueBlock.objects.filter(item=self.item).first().count, 3)
+
+    def test_views_merge_archived_values(self):
+        call_command('archive_metric', '--days', '30', '--period', 'week', stdout=StringIO())
+        self.assertEqual(ValueBlock.objects.count(), 2)
+        url = reverse('metric:item_detail_json', kwargs={'key': self.item.key, 'month': 3, 'year': 2017})
+        values = streaming_json(self.client.get(url, {'start': '2017-03-01', 'end': '2017-03-31'}))['values']
+        self.assertEqual([row['value'] for row in values], [11, 12, 100, 12, 13, 21, 22])
+        self.assertEqual([row['comment'] for row in values if row['comment']], ["Kept"])
+
+        graph = GraphFactory(items=[self.item])
+        url = reverse('metric:graph_detail_json', kwargs={'pk': graph.pk, 'month': 3, 'year': 2017})
+        body = json.loads(self.client.get(url, {'start': '2017-03-01', 'end': '2017-03-31'}).content.decode('utf-8'))
+        self.assertEqual(len(body['body']), 7)
+
+        data = json.loads(self.client.get(reverse('metric:aggregate'), {
+            'key': self.item.key, 'start': '2017-03-01', 'end': '2017-03-31', 'bucket': 'minute', 'agg': 'max'
+        }).content.decode('utf-8'))
+        self.assertEqual(data['source'], 'python')
+        self.assertEqual(len(data['series'][0]['data']), 7)
+
+    def test_rebuild_and_prune_include_archived_values(self):
+        archive_item(self.item, self.now - timedelta(days=30), period=RESOLUTION_DAY)
+        Rollup.objects.rebuild(items=[self.item])
+        self.assertEqual(Rollup.objects.get(resolution=RESOLUTION_MONTH, time=datetime(2017, 3, 1, tzinfo=utc)).count, 7)
+        deleted = prune_item(self.item, self.now, retention={'*': {'raw': 30}})
+        self.assertEqual(deleted['raw'], 7)
+        self.assertFalse(ValueBlock.objects.exists())
+
+    def test_prune_rebuilds_months_only_archived(self):
+        archive_item(self.item, self.now - timedelta(days=30), period=RESOLUTION_DAY)
+        Value.objects.filter(item=self.item, time__lt=datetime(2017, 4, 1, tzinfo=utc)).delete()
+        Rollup.objects.all().delete()
+        prune_item(self.item, self.now, retention={'*': {'raw': 30}})
+        self.assertEqual(Rollup.objects.get(resolution=RESOLUTION_MONTH, time=datetime(2017, 3, 1, tzinfo=utc)).count, 6)
+
+
+class ItemCountersTestCase(TestCase):
+    def setUp(self):
+        self.item = ItemFactory()
+        self.now = datetime(2017, 6, 20, 12, tzinfo=utc)
+        Value.objects.record([Value(item=self.item, time=datetime(2017, 3, day, tzinfo=utc), value=day)
+                              for day in (10, 11, 20)])
+
+    def test_record_maintains_counters(self):
+        Value.objects.record([Value(item=self.item, time=datetime(2017, 3, 1, tzinfo=utc), value=1)])
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.value_count, 4)
+        self.assertEqual(self.item.first_value_time, datetime(2017, 3, 1, tzinfo=utc))
+
+    def test_prune_and_archive(self):
+        archive_item(self.item, datetime(2017, 3, 15, tzinfo=utc), period=RESOLUTION_DAY)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.value_count, 3)
+        Value.objects.record([Value(item=self.item, time=datetime(2017, 4, 5, tzinfo=utc), value=5)])
+        prune_item(self.item, datetime(2017, 5, 12, tzinfo=utc), retention={'*': {'raw': 30}})
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.value_count, self.item.first_value_time),
+                         (1, datetime(2017, 4, 5, tzinfo=utc)))
+
+    def test_interrupted_prune_keeps_count(self):
+        Value.objects.record([Value(item=self.item, time=datetime(2017, 4, 5, tzinfo=utc), value=5)])
+        with mock.patch.object(Rollup.objects, 'rebuild', side_effect=[None, DatabaseError]):
+            with self.assertRaises(DatabaseError):
+                prune_item(self.item, datetime(2017, 6, 12, tzinfo=utc), chunk_size=2, retention={'*': {'raw': 30}})
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.value_count, Value.objects.filter(item=self.item).count())
+
+    def test_reconcile_command(self):
+        archive_item(self.item, datetime(2017, 3, 25, tzinfo=utc), period=RESOLUTION_DAY)
+        ValueFactory(item=self.item, time=datetime(2017, 4, 1, tzinfo=utc), value=5)
+        Item.objects.update(value_count=0, first_value_time=None, last_value=None, last_value_time=None)
+        out = StringIO()
+        call_command('reconcile_metric', stdout=out)
+        self.assertIn("Reconciled 1 items.", out.getvalue())
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.value_count, self.item.first_value_time, self.item.last_value),
+                         (4, datetime(2017, 3, 10, tzinfo=utc), 5))
+
+        Value.objects.filter(item=self.item).delete()
+        Item.objects.update(last_value=None, last_value_time=None)
+        call_command('reconcile_metric', '--key', self.item.key, stdout=StringIO())
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.value_count, self.item.last_value), (3, 20))
+
+    def test_admin_changelist_reads_counters(self):
+        ItemFactory.create_batch(3)
+        get_user_model().objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        url = reverse('admin:metric_item_changelist')
+        self.client.get(url)
+        with self.assertNumQueries(6):
+            response = self.client.get(url)
+        self.assertContains(response, '<td class="field-value_count">3</td>', html=True)
+
+
+class PartitioningTestCase(TestCase):
+    def test_partition_names(self):
+        month = datetime(2017, 3, 1, tzinfo=utc)
+        self.assertEqual(partitioning.get_partition_name(month), 'metric_value_y2017m03')
+        self.assertEqual(partitioning.get_month('metric_value_y2017m03'), month)
+        self.assertIsNone(partitioning.get_month(partitioning.DEFAULT_PARTITION))
+
+    @skipUnless(not partitioning.is_supported(), "degrades only without PostgreSQL 11+")
+    def test_command_does_nothing_without_postgresql(self):
+        ValueFactory()
+        out = StringIO()
+        call_command('partition_metric', '--convert', '--detach-after', '1', stdout=out)
+        self.assertIn("Nothing to do.", out.getvalue())
+        self.assertEqual(Value.objects.count(), 1)
+
+    @skipUnless(partitioning.is_supported(), "partitioning requires PostgreSQL 11+")
+    def test_convert_create_and_detach(self):
+        item = ItemFactory()
+        Value.objects.record([Value(item=item, time=datetime(2017, 1, 15, tzinfo=utc), value=1)])
+        now = datetime(2017, 2, 10, tzinfo=utc)
+        self.assertEqual(partitioning.convert(now), datetime(2017, 3, 1, tzinfo=utc))
+        self.assertEqual(partitioning.create_partitions(now + relativedelta(months=1), 1),
+                         ['metric_value_y2017m04'])
+        Value.objects.record([Value(item=item, time=datetime(2017, 3, 2, tzinfo=utc), value=3),
+                              Value(item=item, time=datetime(2017, 6, 2, tzinfo=utc), value=6)])
+        self.assertEqual(Value.objects.filter(item=item).count(), 3)
+        self.assertEqual(partitioning.create_partitions(datetime(2017, 6, 1, tzinfo=utc), 0),
+                         ['metric_value_y2017m06'])
+
+        removed = partitioning.detach_partitions(datetime(2017, 4, 1, tzinfo=utc), drop=True)
+        self.assertEqual(removed, [partitioning.INITIAL_PARTITION, 'metric_value_y2017m03'])
+        self.assertEqual(list(Value.objects.filter(item=item).values_list('value', flat=True)), [6])
+        self.assertEqual(Rollup.objects.get(item=item, resolution=RESOLUTION_MONTH,
+                                            time=datetime(2017, 1, 1, tzinfo=utc)).sum, 1)
+        item.refresh_from_db()
+        self.assertEqual(item.value_count, 1)
+
+
+@mock.patch('metric.instrumentation.STAT_INSTRUMENT', True)
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item = ItemFactory(public=True)
+        ValueFactory.create_batch(size=4, item=self.item, time=datetime(2017, 3, 10, tzinfo=utc))
+
+    def get_csv(self):
+        url = reverse('metric:item_detail_csv', kwargs={'key': self.item.key, 'month': 3, 'year': 2017})
+        response = self.client.get(url)
+        b''.join(response.streaming_content)
+
+    def test_counters_of_streamed_response(self):
+        self.get_csv()
+        self.get_csv()
+        counters = instrumentation.take_counters()['CSVValueListView']
+        self.assertEqual(counters['requests'], 2)
+        self.assertEqual(counters['queries'], 6)
+        self.assertEqual(counters['rows'], 8)
+        self.assertEqual(instrumentation.take_counters()['CSVValueListView']['requests'], 0)
+
+    def test_counters_are_not_taken_twice_at_once(self):
+        self.get_csv()
+        cache.add(instrumentation.TAKE_LOCK_KEY, 1)
+        self.assertEqual(instrumentation.take_counters(), {})
+        cache.delete(instrumentation.TAKE_LOCK_KEY)
+        self.assertEqual(instrumentation.take_counters()['CSVValueListView']['requests'], 1)
+
+    def test_queries_are_counted_past_the_end_of_the_log(self):
+        measurement = instrumentation.Measurement()
+        connection = measurement.connection
+        log = connection.queries_log
+        connection.queries_log = deque(maxlen=2)
+        try:
+            measurement.start()
+            for _ in range(5):
+                list(Item.objects.all())
+            measurement.stop()
+            self.assertEqual(measurement.query_count, 5)
+            self.assertEqual(len(connection.queries_log), 2)
+        finally:
+            connection.queries_log = log
+
+    @mock.patch('metric.checks.STAT_INSTRUMENT', True)
+    def test_shared_cache_check(self):
+        self.assertEqual([error.id for error in checks.stat_instrument_check(None)], ['metric.E003'])
+        with mock.patch('metric.checks.STAT_CACHE_ALIAS', None):
+            self.assertEqual([error.id for error in checks.stat_instrument_check(None)], ['metric.E003'])
+        with mock.patch('metric.checks.is_local_cache', return_value=False):
+            self.assertEqual(checks.stat_instrument_check(None), [])
+
+    @mock.patch('metric.instrumentation.STAT_INSTRUMENT_HEADER', True)
+    def test_debug_header(self):
+        graph = GraphFactory(items=[self.item])
+        url = reverse('metric:graph_detail_json', kwargs={'pk': graph.pk, 'month': 3, 'year': 2017})
+        header = self.client.get(url)[instrumentation.HEADER]
+        self.assertTrue(header.startswith("queries=4; db="))
+        self.assertTrue(header.endswith("rows=4"))
+
+    @mock.patch('metric.management.commands.update_metric.STAT_METRICS', TEST_METRICS)
+    def test_update_metric_writes_counters(self):
+        self.get_csv()
+        call_command('update_metric', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Value.objects.get(item__key='stats.view.CSVValueListView.requests').value, 1)
+        self.assertEqual(Value.objects.get(item__key='stats.view.CSVValueListView.rows').value, 4)
+        self.assertGreater(Value.objects.get(item__key='stats.update_metric.queries').value, 0)
+
+
 class TestManagementCommand(TestCase):
     def test_command_no_raises_exception(self):
         call_command('update_metric')
@@ -216,3 +1137,266 @@ class TestManagementCommand(TestCase):
         output = out.getvalue()
         self.assertTrue(re.search("Registered .* new items", output))
         self.assertTrue(re.search("Registered .* values.", output))
+
+    @mock.patch('metric.management.commands.update_metric.STAT_METRICS', TEST_METRICS)
+    def test_command_isolates_failing_metric(self):
+        err = StringIO()
+        call_command('update_metric', '--mode', MODE_THREAD, stdout=StringIO(), stderr=err)
+        self.assertIn("test.failing", err.getvalue())
+        self.assertEqual(Value.objects.get(item__key='test.constant').value, 42)
+        self.assertFalse(Value.objects.filter(item__key='test.failing').exists())
+
+    def test_command_isolates_invalid_values(self):
+        metrics = {'test.constant': 'metric.testapp.metrics.constant',
+                   'test.none': lambda: None,
+                   'test.huge': lambda: 2 ** 40,
+                   'test.flag': lambda: True,
+                   'test.mapping': lambda: {'ok': 1, 'bad': 'x'}}
+        err = StringIO()
+        with mock.patch('metric.management.commands.update_metric.STAT_METRICS', metrics):
+            call_command('update_metric', stdout=StringIO(), stderr=err)
+        for key in ('test.none', 'test.huge', 'test.flag', 'test.mapping'):
+            self.assertIn("Unable to collect {}".format(key), err.getvalue())
+        self.assertEqual(Value.objects.get(item__key='test.constant').value, 42)
+        self.assertFalse(Value.objects.filter(item__key__in=['test.none', 'test.huge', 'test.flag']).exists())
+        self.assertFalse(Value.objects.filter(item__key__startswith='test.mapping.').exists())
+
+    @mock.patch('metric.management.commands.update_metric.STAT_METRICS', TEST_METRICS)
+    def test_command_records_time_per_metric(self):
+        call_command('update_metric', stdout=StringIO(), stderr=StringIO())
+        for key in TEST_METRICS:
+            self.assertTrue(Value.objects.filter(item__key='stats.collect_time.{}'.format(key)).exists())
+        self.assertEqual(Item.objects.get(key='test.constant').name, "Constant")
+
+
+class MetricRegistryTestCase(TestCase):
+    metrics = dict(TEST_METRICS, **{'test.missing': 'metric.testapp.metrics.missing'})
+
+    def test_resolves_once_per_process(self):
+        registry = get_registry(self.metrics)
+        self.assertIs(get_registry(dict(self.metrics)), registry)
+        self.assertEqual(list(registry.collectors), ['test.constant', 'test.failing'])
+        self.assertEqual(list(registry.errors), ['test.missing'])
+
+    def test_register_uses_bulk_queries(self):
+        registry = MetricRegistry(self.metrics)
+        ItemFactory(key='test.constant')
+        with self.assertNumQueries(3):
+            self.assertEqual(registry.register(), 6)
+        self.assertEqual(Item.objects.get(key='stats.collect_time.test.failing').pk,
+                         registry.item_ids['stats.collect_time.test.failing'])
+        with self.assertNumQueries(1):
+            self.assertEqual(registry.register(), 0)
+
+
+class MultiValueMetricTestCase(TestCase):
+    metrics = {'test.status': 'metric.testapp.metrics.per_status',
+               'test.kind': 'metric.testapp.metrics.per_kind'}
+
+    def test_declared_keys_are_registered_up_front(self):
+        registry = MetricRegistry(self.metrics)
+        registry.register()
+        self.assertEqual(Item.objects.get(key='test.status.failed').name, "Per status: failed")
+        self.assertFalse(Item.objects.filter(key='test.status').exists())
+
+    def test_scalar_of_declared_sub_keys_fails(self):
+        def status():
+            return 4
+        status.sub_keys = ('ok', 'failed')
+        registry = MetricRegistry({'test.status': status})
+        registry.register()
+        [result] = collect(registry.collectors)
+        values = registry.get_values([result], datetime(2017, 3, 1, tzinfo=utc))
+        self.assertFalse(result.ok)
+        self.assertIn("Expected a mapping", result.error)
+        self.assertEqual([value.item_id for value in values], [registry.item_ids['stats.collect_time.test.status']])
+
+    def test_update_metric_writes_every_sub_key(self):
+        with mock.patch('metric.management.commands.update_metric.STAT_METRICS', self.metrics):
+            call_command('update_metric', stdout=StringIO(), stderr=StringIO())
+        values = dict(Value.objects.filter(item__key__regex=r'^test\.(status|kind)\.').values_list('item__key', 'value'))
+        self.assertEqual(values, {'test.status.ok': 3, 'test.status.failed': 1, 'test.kind.a': 1, 'test.kind.b': 2})
+
+
+class MetricDaemonTestCase(TestCase):
+    metrics = {'test.constant': 'metric.testapp.metrics.constant',
+               'test.frequent': 'metric.testapp.metrics.frequent'}
+
+    def test_metrics_run_on_own_interval(self):
+        out = StringIO()
+        with mock.patch('metric.management.commands.run_metric_daemon.STAT_METRICS', self.metrics):
+            call_command('run_metric_daemon', '--iterations', '3', stdout=out)
+        self.assertEqual(Value.objects.filter(item__key='test.constant').count(), 1)
+        self.assertEqual(Value.objects.filter(item__key='test.frequent').count(), 3)
+        self.assertEqual(Value.objects.filter(item__key='stats.collect_time.test.frequent').count(), 3)
+        self.assertIn("Registered 4 values of 2 metrics.", out.getvalue())
+
+    def test_failed_round_does_not_stop_daemon(self):
+        err = StringIO()
+        record = Value.objects.record
+        calls = []
+
+        def record_once_failing(values):
+            calls.append(values)
+            if len(calls) == 1:
+                raise DatabaseError("Gone.")
+            return record(values)
+        with mock.patch('metric.management.commands.run_metric_daemon.STAT_METRICS', self.metrics), \
+                mock.patch.object(Value.objects, 'record', side_effect=record_once_failing):
+            call_command('run_metric_daemon', '--iterations', '3', stdout=StringIO(), stderr=err)
+        self.assertIn("Collection round failed", err.getvalue())
+        self.assertEqual(Value.objects.filter(item__key='test.frequent').count(), 2)
+
+
+class CollectTestCase(TestCase):
+    metrics = {'constant': 'metric.testapp.metrics.constant',
+               'failing': 'metric.testapp.metrics.failing',
+               'hanging': 'metric.testapp.metrics.hanging'}
+
+    def test_serial_mode_isolates_errors(self):
+        results = {r.key: r for r in collect({key: self.metrics[key] for key in ('constant', 'failing')},
+                                              mode=MODE_SERIAL)}
+        self.assertEqual(results['constant'].value, 42)
+        self.assertTrue(results['constant'].ok)
+        self.assertIn("Broken metric.", results['failing'].error)
+
+    def test_thread_mode_times_out_hanging_metric(self):
+        results = {r.key: r for r in collect(self.metrics, mode=MODE_THREAD, workers=3, timeout=0.5)}
+        self.assertEqual(results['constant'].value, 42)
+        self.assertFalse(results['failing'].ok)
+        self.assertIn("Timed out", results['hanging'].error)
+
+    def test_process_mode_times_out_hanging_metric(self):
+        results = {r.key: r for r in collect(self.metrics, mode=MODE_PROCESS, workers=3, timeout=0.5)}
+        self.assertEqual(results['constant'].value, 42)
+        self.assertFalse(results['failing'].ok)
+        self.assertIn("Timed out", results['hanging'].error)
+
+    def test_timeout_counts_from_start_of_each_metric(self):
+        metrics = OrderedDict([('hanging', self.metrics['hanging']), ('constant', self.metrics['constant'])])
+        for mode in (MODE_THREAD, MODE_PROCESS):
+            results = collect(metrics, mode=mode, workers=1, timeout=0.3)
+            self.assertIn("Timed out", results[0].error)
+            self.assertEqual(results[1].value, 42)
+
+    @skipUnless(MODE_ASYNCIO in MODES, "asyncio collection requires Python 3.5+")
+    def test_asyncio_mode_mixes_sync_and_async_metrics(self):
+        metrics = dict(self.metrics, **{'async.constant': 'metric.testapp.async_metrics.constant',
+                                        'async.failing': 'metric.testapp.async_metrics.failing',
+                                        'async.hanging': 'metric.testapp.async_metrics.hanging'})
+        results = {r.key: r for r in collect(metrics, mode=MODE_ASYNCIO, workers=6, timeout=0.5)}
+        self.assertEqual(results['constant'].value, 42)
+        self.assertEqual(results['async.constant'].value, 7)
+        self.assertIn("Broken metric.", results['async.failing'].error)
+        self.assertIn("Timed out", results['hanging'].error)
+        self.assertIn("Timed out", results['async.hanging'].error)
+
+    @skipUnless(MODE_ASYNCIO in MODES, "asyncio collection requires Python 3.5+")
+    def test_hanging_metrics_leave_only_daemon_threads(self):
+        for mode in (MODE_THREAD, MODE_ASYNCIO):
+            results = collect({'hanging': self.metrics['hanging']}, mode=mode, timeout=0.1)
+            self.assertIn("Timed out", results[0].error)
+        self.assertEqual([thread for thread in threading.enumerate()
+                          if not thread.daemon and thread is not threading.main_thread()], [])
+
+    @skipUnless(MODE_ASYNCIO in MODES, "asyncio collection requires Python 3.5+")
+    def test_serial_mode_runs_async_metric(self):
+        results = collect({'async': 'metric.testapp.async_metrics.constant'}, mode=MODE_SERIAL)
+        self.assertEqual(results[0].value, 7)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            collect(self.metrics, mode='unknown')
+
+
+class RollupTestCase(TestCase):
+    def setUp(self):
+        self.item = ItemFactory(public=True)
+        self.time = datetime(2017, 3, 4, 10, 30, tzinfo=utc)
+
+    def create_values(self, *values, **kwargs):
+        offset = kwargs.get('offset', 0)
+        return [Value.objects.create(item=self.item, time=self.time + timedelta(minutes=15 * (offset + i)), value=value)
+                for i, value in enumerate(values)]
+
+    def assertRollup(self, resolution, **expected):
+        rollup = Rollup.objects.get(item=self.item, resolution=resolution)
+        self.assertEqual({key: getattr(rollup, key) for key in expected}, expected)
+
+    def test_add_values_is_incremental(self):
+        Rollup.objects.add_values(self.create_values(5, 1))
+        Rollup.objects.add_values(self.create_values(9, offset=-1))
+        self.assertRollup(RESOLUTION_DAY, count=3, sum=15, min=1, max=9, last=1, avg=5.0)
+        self.assertEqual(Rollup.objects.filter(resolution=RESOLUTION_HOUR).count(), 1)
+        self.assertEqual(Rollup.objects.get(resolution=RESOLUTION_MONTH).time, datetime(2017, 3, 1, tzinfo=utc))
+
+    def test_add_values_queries_in_bulk(self):
+        items = ItemFactory.create_batch(5)
+        Rollup.objects.add_values([Value(item=item, time=self.time, value=1) for item in items])
+        values = [Value(item=item, time=self.time + timedelta(days=day), value=2) for item in items for day in (0, 1)]
+        # A lookup, an update and an insert, the latter in a savepoint.
+        with self.assertNumQueries(5):
+            Rollup.objects.add_values(values)
+        self.assertEqual(Rollup.objects.get(item=items[0], resolution=RESOLUTION_MONTH).count, 3)
+        self.assertEqual(Rollup.objects.filter(resolution=RESOLUTION_DAY).count(), 10)
+
+    def test_add_values_joins_rollups_created_concurrently(self):
+        find = RollupQueryset.find
+        month = datetime(2017, 3, 1, tzinfo=utc)
+
+        def create_competing_after_lookup(queryset, keys):
+            found = find(queryset, keys)
+            if not Rollup.objects.exists():
+                Rollup.objects.create(item=self.item, resolution=RESOLUTION_MONTH, time=month, count=1, sum=7,
+                                      min=7, max=7, last=7, last_time=self.time - timedelta(days=1))
+            return found
+        with mock.patch.object(RollupQueryset, 'find', create_competing_after_lookup):
+            Value.objects.record([Value(item=self.item, time=self.time, value=3)])
+        self.assertRollup(RESOLUTION_MONTH, count=2, sum=10, min=3, max=7, last=3)
+        self.assertRollup(RESOLUTION_DAY, count=1, sum=3)
+
+    def test_rebuild_matches_incremental(self):
+        Rollup.objects.add_values(self.create_values(5, 1, 3, 9))
+        expected = sorted((r.resolution, r.time, r.count, r.sum, r.min, r.max, r.last) for r in Rollup.objects.all())
+        Rollup.objects.all().delete()
+        call_command('backfill_metric', stdout=StringIO())
+        result = sorted((r.resolution, r.time, r.count, r.sum, r.min, r.max, r.last) for r in Rollup.objects.all())
+        self.assertEqual(result, expected)
+
+    def test_choose_resolution(self):
+        start = datetime(2017, 3, 1)
+        self.assertEqual(choose_resolution(start, start + timedelta(days=31), 24), RESOLUTION_DAY)
+        self.assertEqual(choose_resolution(start, start + timedelta(days=1), 24), RESOLUTION_HOUR)
+        self.assertEqual(choose_resolution(start, start + timedelta(hours=1), 24), RESOLUTION_RAW)
+
+    def test_json_view_serves_rollups(self):
+        Rollup.objects.add_values(self.create_values(5, 1))
+        url = reverse('metric:item_detail_json', kwargs={'key': self.item.key, 'month': 3, 'year': 2017})
+        response = streaming_json(self.client.get(url, {'resolution': 'auto'}))
+        self.assertEqual(response['resolution'], RESOLUTION_DAY)
+        self.assertEqual([(v['value'], v['count']) for v in response['values']], [(3.0, 2)])
+
+    def test_export_fills_missing_buckets(self):
+        Rollup.objects.add_values(self.create_values(5) + self.create_values(1, offset=4 * 3))
+        url = reverse('metric:item_detail_json', kwargs={'key': self.item.key, 'month': 3, 'year': 2017})
+        response = streaming_json(self.client.get(url, {'resolution': 'hour', 'fill': '1'}))
+        self.assertEqual([v['count'] for v in response['values']], [1, 0, 0, 1])
+
+
+class BenchmarkCommandTestCase(TestCase):
+    def test_reports_endpoints_and_rolls_back(self):
+        out = StringIO()
+        call_command('benchmark_metric', '--items', '2', '--values', '20', '--repeat', '1', '--explain', stdout=out)
+        output = out.getvalue()
+        for name in ('item_detail', 'item_detail_csv', 'item_detail_json', 'graph_detail_json'):
+            self.assertIn(name, output)
+        self.assertIn("metric_value_item_time_value", output)
+        self.assertFalse(Value.objects.exists())
+
+    def test_bypasses_response_cache(self):
+        out = StringIO()
+        with mock.patch('metric.cache.CacheMixin.get_cache_key') as get_cache_key:
+            call_command('benchmark_metric', '--items', '1', '--values', '5', '--repeat', '2', stdout=out)
+        self.assertFalse(get_cache_key.called)
+        self.assertIn("Response caching (default) is on, it was bypassed while measuring.", out.getvalue())
+        self.assertEqual(cache_module.STAT_CACHE_ALIAS, 'default')
@@ -6,18 +6,38 @@ from . import views
 urlpatterns = [
     url(r'^$', views.MetricIndexView.as_view(),
         name="index"),
+    url(r'^~ingest$', views.IngestView.as_view(),
+        name="ingest"),
+    url(r'^~aggregate$', views.AggregateView.as_view(),
+        name="aggregate"),
     url(_(r'^item-(?P<key>[\w\-.]+)/$'), views.ValueBrowseListView.as_view(),
         name="item_detail"),
+    url(_(r'^item-(?P<key>[\w\-.]+)/~csv$'), views.CSVValueListView.as_view(),
+        name="item_detail_csv"),
+    url(_(r'^item-(?P<key>[\w\-.]+)/~json$'), views.JSONValueListView.as_view(),
+        name="item_detail_json"),
+    url(_(r'^item-(?P<key>[\w\-.]+)/~bin$'), views.BinaryValueListView.as_view(),
+        name="item_detail_bin"),
     url(_(r'^item-(?P<key>[\w\-.]+)/(?P<month>\d+)/(?P<year>\d+)/~csv$'), views.CSVValueListView.as_view(),
         name="item_detail_csv"),
     url(_(r'^item-(?P<key>[\w\-.]+)/(?P<month>\d+)/(?P<year>\d+)/~json$'), views.JSONValueListView.as_view(),
         name="item_detail_json"),
+    url(_(r'^item-(?P<key>[\w\-.]+)/(?P<month>\d+)/(?P<year>\d+)/~bin$'), views.BinaryValueListView.as_view(),
+        name="item_detail_bin"),
     url(_(r'^item-(?P<key>[\w\-.]+)/(?P<month>\d+)/(?P<year>\d+)$'), views.ValueBrowseListView.as_view(),
         name="item_detail"),
+    url(_(r'^graphs/~json$'), views.GraphBatchView.as_view(),
+        name="graph_batch_json"),
+    url(_(r'^graphs/(?P<month>\d+)/(?P<year>\d+)/~json$'), views.GraphBatchView.as_view(),
+        name="graph_batch_json"),
     url(_(r'^graph-(?P<pk>\d+)$'), views.GraphDetailView.as_view(),
         name="graph_detail"),
+    url(_(r'^graph-(?P<pk>\d+)/~delta$'), views.GraphDeltaView.as_view(),
+        name="graph_detail_delta"),
     url(_(r'^graph-(?P<pk>\d+)/(?P<month>\d+)/(?P<year>\d+)$'), views.GraphDetailView.as_view(),
         name="graph_detail"),
     url(_(r'^graph-(?P<pk>\d+)/(?P<month>\d+)/(?P<year>\d+)/~json$'), views.JSONGraphDetailView.as_view(),
         name="graph_detail_json"),
+    url(_(r'^graph-(?P<pk>\d+)/(?P<month>\d+)/(?P<year>\d+)/~bin$'), views.BinaryGraphDetailView.as_view(),
+        name="graph_detail_bin"),
 ]
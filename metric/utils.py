@@ -1,68 +1,118 @@
-from datetime import datetime
+import calendar
+from datetime import datetime, timedelta
 
-from dateutil.rrule import MONTHLY, WEEKLY, rrule
+import six
+from dateutil.relativedelta import relativedelta
+from dateutil.rrule import DAILY, HOURLY, MONTHLY, WEEKLY
+from django.conf import settings
+from django.utils.timezone import is_aware, localtime, make_aware, utc
 
 SECONDS_IN_A_DAY = 60 * 60 * 24
 DATE_FORMAT_MONTHLY = "%Y-%m"
 DATE_FORMAT_WEEKLY = "%Y-%W"
+DATE_FORMAT_DAILY = "%Y-%m-%d"
+DATE_FORMAT_HOURLY = "%Y-%m-%d %H"
+
+# Range of the IntegerField of values on every supported database.
+VALUE_MIN = -2 ** 31
+VALUE_MAX = 2 ** 31 - 1
+
+FREQ_STEPS = {MONTHLY: relativedelta(months=1),
+              WEEKLY: relativedelta(weeks=1),
+              DAILY: relativedelta(days=1),
+              HOURLY: relativedelta(hours=1)}
+FREQ_SECONDS = {WEEKLY: SECONDS_IN_A_DAY * 7,
+                DAILY: SECONDS_IN_A_DAY,
+                HOURLY: 60 * 60}
+
+RESOLUTION_AUTO = 'auto'
+RESOLUTION_RAW = 'raw'
+RESOLUTION_MINUTE = 'minute'
+RESOLUTION_HOUR = 'hour'
+RESOLUTION_DAY = 'day'
+RESOLUTION_WEEK = 'week'
+RESOLUTION_MONTH = 'month'
+ROLLUP_RESOLUTIONS = (RESOLUTION_HOUR, RESOLUTION_DAY, RESOLUTION_MONTH)
+RESOLUTIONS = (RESOLUTION_RAW, ) + ROLLUP_RESOLUTIONS
+RESOLUTION_SECONDS = {RESOLUTION_HOUR: 60 * 60,
+                      RESOLUTION_DAY: SECONDS_IN_A_DAY,
+                      RESOLUTION_MONTH: SECONDS_IN_A_DAY * 30}
+RESOLUTION_FREQ = {RESOLUTION_HOUR: HOURLY,
+                   RESOLUTION_DAY: DAILY,
+                   RESOLUTION_MONTH: MONTHLY}
+
+
+def is_value(value):
+    """Return whether ``value`` can be stored as a value: an integer, not a bool, within the column range."""
+    return isinstance(value, six.integer_types) and not isinstance(value, bool) and VALUE_MIN <= value <= VALUE_MAX
 
 
 class GapFiller(object):
-    def __init__(self, qs, freq, date_key, date_format):
-        self.qs = list(qs)
+    """Insert rows with zeroed params for periods missing between consecutive rows.
+
+    Rows are read lazily from any iterable and yielded as they come, so only
+    the previous date is kept in memory. Dates under ``date_key`` are strings
+    in ``date_format`` or, if it is None, unix timestamps.
+    """
+
+    def __init__(self, qs, freq, date_key, date_format=None):
+        if freq not in FREQ_STEPS:
+            raise ValueError("Unsupported frequency: {}".format(freq))
+        self.qs = qs
         self.freq = freq
         self.date_key = date_key
         self.date_format = date_format
+        self.params = None
+        # Fixed-length periods of timestamps are stepped with plain integers.
+        self.seconds = FREQ_SECONDS.get(freq) if date_format is None else None
 
-    def fill_gaps(self):
-        if len(self.qs) == 1:
-            # return [self._convert_date(self.qs[0])]
-            return self.qs
-
-        ans = []
-        params = None
+    def __iter__(self):
+        previous = None
+        for row in self.qs:
+            date = self._parse(row[self.date_key])
+            if previous is None:
+                self.params = [key for key in row if key != self.date_key]
+            else:
+                for missing in self._date_range(previous, date):
+                    yield self._construct(missing)
+            yield row
+            previous = date
 
-        for i, temp in enumerate(self.qs[:-1]):
-            a, b = self.qs[i], self.qs[i + 1]
-            date_range = self._date_range(a, b)
-            params = self._get_params()
+    def fill_gaps(self):
+        return list(self)
 
-            ans.append(a)
-            ans.extend([self._construct(d) for d in date_range[1:-1]])
-            if i == len(self.qs) - 2:  # check if last element
-                ans.append(b)
-        return ans
+    def _parse(self, value):
+        if self.seconds:
+            return value
+        if self.date_format is None:
+            return datetime.utcfromtimestamp(value)
+        if self.freq == WEEKLY:
+            # append weekday to parse date by week number
+            return datetime.strptime(value + "-1", self.date_format + "-%w")
+        return datetime.strptime(value, self.date_format)
 
     def _date_range(self, start, end):
-        if self.freq == MONTHLY:
-            date_format = DATE_FORMAT_MONTHLY
-            start = start[self.date_key]
-            end = end[self.date_key]
-            return list(rrule(
-                freq=self.freq,
-                dtstart=datetime.strptime(start, date_format),
-                until=datetime.strptime(end, date_format)))
-        if self.freq == WEEKLY:
-            date_format = DATE_FORMAT_WEEKLY + "-%w"  # append weekday to parse date by week number
-            start = start[self.date_key] + "-1"
-            end = end[self.date_key] + "-1"
-            return list(rrule(
-                freq=self.freq,
-                dtstart=datetime.strptime(start, date_format),
-                until=datetime.strptime(end, date_format)))
-
-    def _get_params(self):
-        if hasattr(self, 'params'):
-            return self.params
-        else:
-            keys = list(self.qs[0].keys())
-            keys.remove(self.date_key)
-            self.params = keys
-            return self.params
+        """Yield dates strictly between start and end."""
+        n = 1
+        date = self._shift(start, n)
+        while date < end:
+            yield date
+            n += 1
+            date = self._shift(start, n)
+
+    def _shift(self, date, n):
+        if self.seconds:
+            return date + self.seconds * n
+        return date + FREQ_STEPS[self.freq] * n
 
     def _construct(self, date):
         obj = {p: 0 for p in self.params}
-        obj[self.date_key] = date.strftime(self.date_format)
+        if self.seconds:
+            obj[self.date_key] = date
+        elif self.date_format is None:
+            obj[self.date_key] = to_epoch(date)
+        else:
+            obj[self.date_key] = date.strftime(self.date_format)
         return obj
 
 
@@ -74,3 +124,53 @@ def filter_today(qs, field):
 def filter_month(qs, field):
     start = datetime.today().replace(day=1)
     return qs.filter(**{'{}__date__gte'.format(field): start})
+
+
+def to_epoch(time):
+    """Return the unix timestamp of a datetime, naive ones are taken as UTC."""
+    return calendar.timegm(time.utctimetuple())
+
+
+def from_epoch(epoch):
+    """Return the datetime of a unix timestamp, in the current time zone if USE_TZ is set."""
+    time = datetime.fromtimestamp(epoch, utc)
+    return localtime(time) if settings.USE_TZ else time.replace(tzinfo=None)
+
+
+def start_of_day(day):
+    """Return the first moment of a date in UTC, like the rollup buckets, or naive if USE_TZ is unset."""
+    time = datetime(day.year, day.month, day.day)
+    return make_aware(time, utc) if settings.USE_TZ else time
+
+
+def epoch_label(epoch):
+    return from_epoch(epoch).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def truncate_time(time, resolution):
+    """Return the start of the rollup bucket containing ``time``.
+
+    Buckets are aligned to UTC.
+    """
+    if is_aware(time):
+        time = time.astimezone(utc)
+    time = time.replace(second=0, microsecond=0)
+    if resolution == RESOLUTION_MINUTE:
+        return time
+    time = time.replace(minute=0)
+    if resolution in (RESOLUTION_DAY, RESOLUTION_WEEK, RESOLUTION_MONTH):
+        time = time.replace(hour=0)
+    if resolution == RESOLUTION_WEEK:
+        time -= timedelta(days=time.weekday())
+    if resolution == RESOLUTION_MONTH:
+        time = time.replace(day=1)
+    return time
+
+
+def choose_resolution(start, end, min_points):
+    """Return the coarsest resolution giving at least ``min_points`` buckets between start and end."""
+    span = (end - start).total_seconds()
+    for resolution in reversed(ROLLUP_RESOLUTIONS):
+        if span / RESOLUTION_SECONDS[resolution] >= min_points:
+            return resolution
+    return RESOLUTION_RAW
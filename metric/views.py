@@ -1,18 +1,51 @@
 import csv
+import heapq
 import json
-from collections import OrderedDict
-from datetime import datetime
+import math
+from datetime import datetime, timedelta
 
 from braces.views import (JSONResponseMixin)
 from dateutil.relativedelta import relativedelta
-from django.db.models import Prefetch
-from django.http import HttpResponse
+from django.db import DatabaseError
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils.datetime_safe import date
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
+from django.utils.encoding import force_str
 from django.utils.translation import ugettext_lazy as _
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import TemplateView, View
 
-from .models import Item, Value, Graph
+from . import encoding, ingest
+from .aggregation import BUCKETS, aggregate_values, get_reducer, get_source
+from .cache import CacheMixin
+from .instrumentation import InstrumentMixin
+from .models import Item, Value, ValueBlock, Graph, Rollup
+from .replica import ReplicaMixin
+from .series import SeriesSet
+from .settings import (STAT_DEFAULT_RESOLUTION, STAT_DELTA_MAX_ROWS, STAT_DELTA_REREAD_IDS, STAT_GRAPH_MAX_POINTS,
+                       STAT_INGEST_TOKENS, STAT_ROLLUP_MIN_POINTS, STAT_STREAM_CHUNK_SIZE)
+from .utils import (RESOLUTION_AUTO, RESOLUTION_FREQ, RESOLUTION_RAW, RESOLUTIONS, GapFiller, choose_resolution,
+                    from_epoch, start_of_day, to_epoch)
+
+
+class Echo(object):
+    """File-like object handing back what is written, to stream csv.writer output."""
+
+    def write(self, value):
+        return value
+
+
+def chunked(lines, size=STAT_STREAM_CHUNK_SIZE):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
 
 
 class ApiListViewMixin(JSONResponseMixin):
@@ -37,120 +70,410 @@ class TimeMixin(object):
                              month=int(self.kwargs.get('month', str(today.month))),
                              year=int(self.kwargs.get('year', str(today.year))))
 
+    def get_date_param(self, name):
+        value = self.request.GET.get(name)
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value, "%Y-%m-%d").date()
+        except ValueError:
+            raise Http404(_("Invalid date: {}").format(value))
+
     @property
     def start(self):
-        return self.today.replace(day=1)
+        return self.get_date_param('start') or self.today.replace(day=1)
 
     @property
     def end(self):
+        end = self.get_date_param('end')
+        if end:
+            return end + timedelta(days=1)
         return self.today.replace(day=1) + relativedelta(months=1)
 
+    @property
+    def resolution(self):
+        resolution = self.request.GET.get('resolution', STAT_DEFAULT_RESOLUTION)
+        if resolution == RESOLUTION_AUTO:
+            return choose_resolution(self.start, self.end, STAT_ROLLUP_MIN_POINTS)
+        if resolution not in RESOLUTIONS:
+            raise Http404(_("Unknown resolution: {}").format(resolution))
+        return resolution
 
-class ValueListView(TimeMixin):
     @property
-    def item(self):
-        return get_object_or_404(Item.objects.for_user(self.request.user),
-                                 key=self.kwargs['key'])
+    def start_time(self):
+        return start_of_day(self.start)
+
+    @property
+    def end_time(self):
+        return start_of_day(self.end)
+
+    def get_archived_rows(self, items):
+        """Yield ``(item_id, time, value)`` of archived values of the period, empty for rollups."""
+        if self.resolution != RESOLUTION_RAW:
+            return iter(())
+        return ValueBlock.objects.filter(item__in=items).rows(self.start_time, self.end_time)
 
-    def get_queryset(self):
-        return Value.objects.filter(time__lte=self.end, time__gte=self.start).filter(item=self.item).all()
+    def get_series_queryset(self):
+        """Values or rollups of the period, bounded by constants so partitions of other months are skipped."""
+        if self.resolution == RESOLUTION_RAW:
+            qs = Value.objects
+        else:
+            qs = Rollup.objects.filter(resolution=self.resolution)
+        return qs.filter(time__gte=self.start_time, time__lt=self.end_time).all()
 
 
-class ValueBrowseListView(ValueListView, TemplateView):
+class ValueListView(ReplicaMixin, InstrumentMixin, TimeMixin):
+    @property
+    def item(self):
+        if not getattr(self, '_item', None):
+            self._item = get_object_or_404(Item.objects.for_user(self.request.user),
+                                           key=self.kwargs['key'])
+        return self._item
+
+    def get_queryset(self, item=None):
+        return self.get_series_queryset().filter(item_id=(item or self.item).pk).all()
+
+    def get_filename(self, item, extension):
+        if 'start' in self.request.GET or 'end' in self.request.GET:
+            return "{}-{:%Y%m%d}-{:%Y%m%d}.{}".format(item.key, self.start, self.end - timedelta(days=1), extension)
+        return "{}.{}".format(item.key, extension)
+
+    def iter_rows(self, item):
+        """Yield the values of the period as dicts, read from a database cursor and archived blocks."""
+        if self.resolution == RESOLUTION_RAW:
+            fields = ('time', 'value', 'comment')
+        else:
+            fields = ('time', 'min', 'max', 'sum', 'count', 'last')
+        rows = self.get_queryset(item).values_list(*fields).iterator()
+        if self.resolution == RESOLUTION_RAW:
+            archived = ((time, value, '') for _item_id, time, value in self.get_archived_rows([item]))
+            rows = heapq.merge(rows, archived)
+        rows = (dict(zip(fields, row)) for row in rows)
+        if self.resolution == RESOLUTION_RAW:
+            for row in rows:
+                self.instrumented_rows += 1
+                yield row
+            return
+        if self.request.GET.get('fill'):
+            rows = (dict(row, time=to_epoch(row['time'])) for row in rows)
+            rows = (dict(row, time=from_epoch(row['time']))
+                    for row in GapFiller(rows, RESOLUTION_FREQ[self.resolution], 'time'))
+        for row in rows:
+            row['value'] = float(row['sum']) / row['count'] if row['count'] else None
+            self.instrumented_rows += 1
+            yield row
+
+
+class ValueBrowseListView(CacheMixin, ValueListView, TemplateView):
     template_name = "stats/item_details.html"
 
     def get_context_data(self, **kwargs):
         item = self.item
         kwargs['item'] = item
-        kwargs['value_list'] = self.get_queryset()
+        kwargs['value_list'] = list(self.iter_rows(item))
         kwargs['today'], kwargs['start'], kwargs['end'] = self.today, self.start, self.end
+        kwargs['resolution'] = self.resolution
         return super(ValueBrowseListView, self).get_context_data(**kwargs)
 
 
 class CSVValueListView(ValueListView, View):
+    def get_lines(self, item):
+        writer = csv.writer(Echo())
+        yield writer.writerow([force_str(_("Key")), force_str(_("Name")), force_str(_("Time")),
+                               force_str(_("Time (unix)")), force_str(_("Value"))])
+        key, name = force_str(item.key), force_str(item.name)
+        for row in self.iter_rows(item):
+            yield writer.writerow([key, name, row['time'].strftime("%c"), to_epoch(row['time']), row['value']])
+
     def get(self, *args, **kwargs):
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(self.item.key)
-        writer = csv.writer(response)
-        writer.writerow([_("Key"), _("Name"), _("Time"), _("Time (unix)"), _("Value")])
-        for item in self.get_queryset():
-            writer.writerow([self.item.key.encode('utf-8'),
-                             self.item.name.encode('utf-8'),
-                             item.time.strftime("%c"),
-                             item.time.strftime("%s"),
-                             item.value])
+        item = self.item
+        response = StreamingHttpResponse(chunked(self.get_lines(item)), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(self.get_filename(item, 'csv'))
         return response
 
 
 class JSONValueListView(ValueListView, View):
+    def get_lines(self, item):
+        yield '{{"item": {}, "resolution": {}, "values": ['.format(json.dumps(item.as_dict()),
+                                                                 json.dumps(self.resolution))
+        separator = ''
+        for row in self.iter_rows(item):
+            row['time'] = str(to_epoch(row['time']))
+            yield separator + json.dumps(row)
+            separator = ', '
+        yield ']}'
+
     def get(self, *args, **kwargs):
-        response = HttpResponse(content_type='application/json')
-        data = {'item': self.item.as_dict(),
-                'values': [o.as_dict() for o in self.get_queryset()]}
-        json.dump(data, response, indent=4)
+        item = self.item
+        response = StreamingHttpResponse(chunked(self.get_lines(item)), content_type='application/json')
+        response['Content-Disposition'] = 'inline; filename="{}"'.format(self.get_filename(item, 'json'))
         return response
 
 
-class GraphTimeMixin(TimeMixin):
+class BinaryValueListView(ValueListView, View):
+    """Values of the period in the compact format of :mod:`metric.encoding`.
+
+    The format has no null, so periods without values, such as those
+    inserted by ``fill``, are left out and show as gaps between times.
+    """
+
+    def get(self, *args, **kwargs):
+        item = self.item
+        times, values = [], []
+        for row in self.iter_rows(item):
+            if row['value'] is None:
+                continue
+            times.append(to_epoch(row['time']))
+            values.append(row['value'])
+        response = HttpResponse(encoding.encode([(item.key, times, values)]),
+                                content_type='application/octet-stream')
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(self.get_filename(item, 'bin'))
+        return response
+
+
+class GraphTimeMixin(ReplicaMixin, InstrumentMixin, TimeMixin):
     @property
     def object(self):
         if not getattr(self, '_object', None):
-            values_qs = Value.objects.filter(time__lte=self.end, time__gte=self.start).all()
-            prefetch_obj = Prefetch('items__value_set', values_qs)
-            graph_qs = Graph.objects.prefetch_related('items').prefetch_related(prefetch_obj).all()
+            graph_qs = Graph.objects.prefetch_related('items').all()
             self._object = get_object_or_404(graph_qs, pk=self.kwargs['pk'])
         return self._object
 
-    def get_dataset(self, item, times):
-        values = {value.time.strftime("%s"): value.value for value in item.value_set.all()}
-        data = [values.get(time, None) for time in times]
-        label = item.name
-        return {'data': data, 'label': label}
+    @property
+    def max_points(self):
+        """Point budget of the series, None to keep all points. Downsampling keeps the ends, so it is at least 3."""
+        max_points = self.request.GET.get('max_points', STAT_GRAPH_MAX_POINTS)
+        if not max_points:
+            return None
+        try:
+            max_points = int(max_points)
+        except ValueError:
+            raise Http404(_("Invalid max_points: {}").format(max_points))
+        if max_points < 3:
+            raise Http404(_("max_points must be at least 3, got {}").format(max_points))
+        return max_points
+
+    @property
+    def items(self):
+        user = self.request.user
+        return [item for item in self.object.items.all() if user.is_staff or item.public]
 
     @property
-    def times(self):
-        if not getattr(self, '_times', None):
-            self._times = list({value.time.strftime("%s")
-                                for item in self.object.items.all()
-                                for value in item.value_set.all()})
-            self._times = sorted(self._times)
-        return self._times
+    def series(self):
+        if not getattr(self, '_series', None):
+            items = self.items
+            self._series = SeriesSet.from_queryset(items, self.get_series_queryset(), self.resolution,
+                                                   archived=self.get_archived_rows(items))
+            if self.max_points:
+                self._series = self._series.downsample(self.max_points)
+            self.instrumented_rows = sum(len(times) for times, _values in self._series.series.values())
+        return self._series
 
     def get_graph(self):
-        dataset = [self.get_dataset(item, self.times) for item in self.object.items.all()]
-        labels = [str(datetime.fromtimestamp(int(time))) for time in self.times]
-        return {'datasets': dataset, 'labels': labels}
+        return self.series.as_graph()
 
     def get_table(self):
-        header = [item.as_dict() for item in self.object.items.all()]
-        data = {}
-        for item in self.object.items.all():
-            for value in item.value_set.all():
-                if item.key not in data:
-                    data[item.key] = {}
-                data[item.key][value.time.strftime("%s")] = value.value
-        body = []
-        for time in self.times:
-            data_row = OrderedDict((item['key'], data[item['key']].get(time, None)) for item in header)
-            body.append({'date': time,
-                         'label': str(datetime.fromtimestamp(int(time))),
-                         'row': data_row})
-        return {'header': header, 'body': body}
-
-
-class GraphDetailView(GraphTimeMixin, TemplateView):
+        return self.series.as_table()
+
+
+class GraphDetailView(CacheMixin, GraphTimeMixin, TemplateView):
     template_name = "stats/graph_details.html"
 
     def get_context_data(self, **kwargs):
         kwargs['object'] = self.object
         kwargs['today'], kwargs['start'], kwargs['end'] = self.today, self.start, self.end
+        kwargs['resolution'] = self.resolution
         kwargs['graph'] = self.get_graph()
         kwargs['table'] = self.get_table()
         return super(GraphDetailView, self).get_context_data(**kwargs)
 
 
-class JSONGraphDetailView(GraphTimeMixin, View):
+class JSONGraphDetailView(CacheMixin, GraphTimeMixin, View):
     def get(self, *args, **kwargs):
-        response = HttpResponse(content_type='application/json')
-        json.dump(self.get_table(), response, indent=4)
+        return HttpResponse(json.dumps(self.get_table()), content_type='application/json')
+
+
+class BinaryGraphDetailView(CacheMixin, GraphTimeMixin, View):
+    """Values of every item of the graph in the compact format of :mod:`metric.encoding`."""
+
+    def get(self, *args, **kwargs):
+        series = self.series
+        data = [(item.key, ) + series.series[item.pk] for item in series.items]
+        return HttpResponse(encoding.encode(data), content_type='application/octet-stream')
+
+
+class GraphDeltaView(GraphTimeMixin, View):
+    """Values of the graph items written after a ``cursor``, or measured after a ``since`` timestamp.
+
+    The table has the shape of :class:`JSONGraphDetailView` and comes with
+    the cursor to send next, the id of the newest value returned. Cursors
+    also catch values written late with an older time. With
+    ``format=sse`` or an ``Accept: text/event-stream`` header the delta is
+    sent as a single Server-Sent Event, the client reconnects after
+    ``retry`` milliseconds passing the cursor as ``Last-Event-ID``.
+
+    A response holds at most ``STAT_DELTA_MAX_ROWS`` new values, the rest
+    follow on the next poll. Ids are taken before transactions commit, so a
+    value may become visible after one with a greater id was sent. The last
+    ``STAT_DELTA_REREAD_IDS`` ids before a cursor are read again to catch
+    those, values already sent may repeat with their time.
+    """
+    retry = 5000
+    max_id = 2 ** 63 - 1
+
+    def get_cursor(self):
+        """Return the cursor as an id and ``since`` as a datetime, either may be None."""
+        cursor = self.request.GET.get('cursor') or self.request.META.get('HTTP_LAST_EVENT_ID')
+        since = self.request.GET.get('since')
+        try:
+            cursor = int(cursor) if cursor else None
+            if cursor is not None and not 0 <= cursor <= self.max_id:
+                raise ValueError(cursor)
+            since = float(since) if since else None
+            if since is not None and (math.isinf(since) or math.isnan(since)):
+                raise ValueError(since)
+            return cursor, from_epoch(since) if since is not None else None
+        except (ValueError, OverflowError, OSError):
+            raise Http404(_("Invalid cursor."))
+
+    def get_rows(self, items, cursor, since):
+        """Return ``(item_id, time, value)`` of the values to send, by item and time, and set ``last_pk``."""
+        qs = Value.objects.filter(item__in=items)
+        if cursor is not None:
+            reread = min(cursor, STAT_DELTA_REREAD_IDS)
+            qs = qs.filter(pk__gt=cursor - reread)
+        elif since is not None:
+            reread = 0
+            qs = qs.filter(time__gt=since)
+        else:
+            raise Http404(_("Either cursor or since is required."))
+        rows = list(qs.order_by('pk').values_list('pk', 'item_id', 'time', 'value')[:STAT_DELTA_MAX_ROWS + reread])
+        if rows:
+            self.last_pk = max(rows[-1][0], self.last_pk)
+        self.instrumented_rows = len(rows)
+        return sorted((item_id, time, value) for _pk, item_id, time, value in rows)
+
+    def is_event_stream(self):
+        return (self.request.GET.get('format') == 'sse' or
+                'text/event-stream' in self.request.META.get('HTTP_ACCEPT', ''))
+
+    def get(self, request, *args, **kwargs):
+        cursor, since = self.get_cursor()
+        self.last_pk = cursor or 0
+        items = self.items
+        table = SeriesSet(items, self.get_rows(items, cursor, since)).as_table()
+        table['cursor'] = self.last_pk or cursor
+        if not self.is_event_stream():
+            return JsonResponse(table)
+        event = "retry: {}\n".format(self.retry)
+        if table['cursor']:
+            event += "id: {}\n".format(table['cursor'])
+        response = HttpResponse(event + "data: {}\n\n".format(json.dumps(table)), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
         return response
+
+
+class GraphBatchView(CacheMixin, ReplicaMixin, TimeMixin, View):
+    """Pivoted tables of many graphs, given as repeated ``graph`` ids, in one JSON payload.
+
+    Graphs and their items are loaded with one prefetch and the values of all
+    distinct visible items with one query, however many graphs are requested.
+    """
+
+    def get_graphs(self):
+        try:
+            pks = [int(pk) for pk in self.request.GET.getlist('graph')]
+        except ValueError:
+            raise Http404(_("Invalid graph."))
+        graphs = Graph.objects.prefetch_related('items').in_bulk(pks)
+        if not pks or len(graphs) != len(set(pks)):
+            raise Http404(_("Unknown graph."))
+        return [graphs[pk] for pk in pks]
+
+    def get_tables(self, graphs):
+        user = self.request.user
+        visible = [[item for item in graph.items.all() if user.is_staff or item.public] for graph in graphs]
+        items = list({item.pk: item for graph_items in visible for item in graph_items}.values())
+        series = SeriesSet.from_queryset(items, self.get_series_queryset(), self.resolution,
+                                         archived=self.get_archived_rows(items))
+        return [dict(series.subset(graph_items).as_table(), id=graph.pk, name=graph.name)
+                for graph, graph_items in zip(graphs, visible)]
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse({'resolution': self.resolution, 'graphs': self.get_tables(self.get_graphs())})
+
+
+class AggregateView(CacheMixin, ReplicaMixin, TimeMixin, View):
+    """Bucketed statistics of one or more items as JSON.
+
+    Takes repeated ``key``, ``start``, ``end``, ``bucket`` (one of
+    :data:`~metric.aggregation.BUCKETS`) and ``agg`` (avg, min, max, sum,
+    count or a percentile like ``p95``) parameters.
+    """
+
+    def get_items(self):
+        keys = self.request.GET.getlist('key')
+        items = list(Item.objects.for_user(self.request.user).filter(key__in=keys))
+        if not keys or len(items) != len(set(keys)):
+            raise Http404(_("Unknown item."))
+        return sorted(items, key=lambda item: keys.index(item.key))
+
+    def get(self, request, *args, **kwargs):
+        bucket = request.GET.get('bucket', 'day')
+        aggregate = request.GET.get('agg', 'avg')
+        if bucket not in BUCKETS:
+            return JsonResponse({'error': "Unknown bucket: {}.".format(bucket)}, status=400)
+        try:
+            get_reducer(aggregate)
+        except ValueError as e:
+            return JsonResponse({'error': "{}.".format(e)}, status=400)
+        items = self.get_items()
+        start, end = self.start_time, self.end_time
+        source = get_source(items, start, end, bucket, aggregate)
+        data = {item.pk: [] for item in items}
+        for item_id, time, result in aggregate_values(items, start, end, bucket, aggregate, source):
+            data[item_id].append([to_epoch(time), result])
+        return JsonResponse({'bucket': bucket,
+                             'aggregate': aggregate,
+                             'source': source,
+                             'series': [{'key': item.key, 'name': item.name, 'data': data[item.pk]}
+                                        for item in items]})
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class IngestView(View):
+    """Accept pushed values as JSON or as ``key value [timestamp]`` lines.
+
+    Clients authenticate with an ``Authorization: Token <token>`` header
+    listed in ``STAT_INGEST_TOKENS``.
+    """
+    http_method_names = ['post']
+
+    def is_authorized(self):
+        scheme, _, token = self.request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        return scheme.lower() == 'token' and any(constant_time_compare(token.strip(), allowed)
+                                                 for allowed in STAT_INGEST_TOKENS)
+
+    def post(self, request, *args, **kwargs):
+        if not self.is_authorized():
+            response = JsonResponse({'error': "Invalid or missing token."}, status=401)
+            response['WWW-Authenticate'] = 'Token'
+            return response
+        body = request.body.decode(request.encoding or 'utf-8')
+        try:
+            if request.content_type == 'application/json':
+                samples = ingest.parse_json(body)
+            else:
+                samples = ingest.parse_lines(body)
+            written = ingest.ingest(samples)
+        except ingest.IngestError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        except ingest.BufferFull as e:
+            response = JsonResponse({'error': str(e)}, status=503)
+            response['Retry-After'] = '1'
+            return response
+        except DatabaseError:
+            response = JsonResponse({'error': "Values could not be written, try again later."}, status=503)
+            response['Retry-After'] = '1'
+            return response
+        return JsonResponse({'accepted': len(samples), 'written': written}, status=202)